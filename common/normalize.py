@@ -0,0 +1,19 @@
+"""
+Text folding shared by the poppler and LLM services, so an extracted value
+is compared with the applicant's record the same way in both.
+"""
+import re
+import unicodedata
+
+_WHITESPACE = re.compile(r"\s+")
+_PUNCTUATION = re.compile(r"[^\w\s]")
+
+
+def fold_text(value) -> str:
+    """
+    Casefold, strip accents and punctuation and collapse whitespace.
+    """
+    text = unicodedata.normalize("NFKD", str(value))
+    text = "".join(ch for ch in text if not unicodedata.combining(ch))
+    text = _PUNCTUATION.sub(" ", text.casefold())
+    return _WHITESPACE.sub(" ", text).strip()
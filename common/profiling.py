@@ -0,0 +1,262 @@
+"""
+On-demand profiling shared by the poppler, OCR and LLM services. Each
+service's profiling.py creates the profiler with its capture directory and
+the modes it supports.
+"""
+import cProfile
+import collections
+import contextlib
+import datetime
+import hmac
+import logging
+import os
+import re
+import sys
+import threading
+import time
+import uuid
+
+from fastapi import HTTPException
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Replaces the profiles directory next to each service; each service keeps
+# its captures in a subdirectory named after it
+PROFILES_DIR = os.getenv("PROFILES_DIR")
+# Captures kept on disk; the oldest is deleted when a new one arrives
+PROFILE_BUFFER_SIZE = int(os.getenv("PROFILE_BUFFER_SIZE", "20"))
+SAMPLE_INTERVAL = float(os.getenv("PROFILE_SAMPLE_INTERVAL", "0.005"))
+# Bearer token the admins use for the OCR and LLM services' profiling
+# endpoints; unset disables them
+PROFILING_TOKEN = os.getenv("PROFILING_TOKEN", "")
+
+# "torch" captures the PyTorch profiler around OCR model calls instead of
+# whole requests, in services that run the OCR model
+MODES = ("sampling", "cprofile", "torch")
+# Names of the files a capture writes, the only files cleaned up at startup
+CAPTURE_FILE = re.compile(r"^[0-9a-f]{12}\.(prof|folded|trace\.json)$")
+
+
+def profiles_directory(service: str, service_directory: str) -> str:
+    if PROFILES_DIR:
+        return os.path.join(PROFILES_DIR, service)
+    return os.path.join(service_directory, "profiles")
+
+
+class StackSampler:
+    """
+    Wall-clock sampler: records the stack of every thread at a fixed interval
+    as folded stacks ("root;caller;callee count"), the format flamegraph.pl
+    and speedscope read. Unlike cProfile it also sees the work handed to
+    worker threads, such as rasterizing or the Ollama client's calls.
+    """
+
+    def __init__(self, interval: float = SAMPLE_INTERVAL):
+        self.interval = interval
+        self.counts = collections.Counter()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                self.counts[";".join(reversed(stack))] += 1
+
+    def write(self, path: str):
+        with open(path, "w") as f:
+            for stack, count in self.counts.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+class Profiler:
+    """
+    Profiles the next N requests whose path starts with a prefix, one at a
+    time. While disarmed the only cost per request is reading
+    self.remaining.
+
+    "sampling" captures are folded stacks for flamegraph.pl / speedscope;
+    "cprofile" captures are pstats dumps for snakeviz or flameprof. cProfile
+    only sees the event loop thread, so it also counts other requests
+    running concurrently. "torch" captures are taken by torch_section()
+    around the model calls, as a Chrome trace plus folded stacks.
+    """
+
+    def __init__(self, directory: str, modes: tuple = MODES, size: int = PROFILE_BUFFER_SIZE):
+        self.directory = directory
+        self.modes = modes
+        self.size = size
+        self.remaining = 0
+        self.mode = modes[0]
+        self.path_prefix = ""
+        self.captures = collections.deque()
+        self._active = False
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        # Captures of an earlier process are not in the buffer and would never
+        # be removed; anything else in the directory is left alone
+        for name in os.listdir(directory):
+            if CAPTURE_FILE.match(name):
+                try:
+                    os.remove(os.path.join(directory, name))
+                except OSError:
+                    pass
+
+    def arm(self, mode: str, requests: int = 1, path_prefix: str = ""):
+        if mode not in self.modes:
+            raise ValueError(f"Unknown profiling mode {mode}, expected one of {', '.join(self.modes)}")
+        if requests < 1:
+            raise ValueError("requests must be at least 1")
+        with self._lock:
+            self.mode = mode
+            self.remaining = requests
+            self.path_prefix = path_prefix
+        logger.info(f"Profiling the next {requests} requests under '{path_prefix or '/'}' with {mode}")
+
+    def disarm(self):
+        with self._lock:
+            self.remaining = 0
+
+    def _claim(self, path: str, torch_mode: bool = False):
+        with self._lock:
+            if self.remaining <= 0 or self._active or (self.mode == "torch") != torch_mode:
+                return None
+            if not torch_mode and (not path.startswith(self.path_prefix) or "/profiling" in path):
+                return None
+            self.remaining -= 1
+            self._active = True
+            return self.mode
+
+    def _store(self, capture: dict):
+        with self._lock:
+            self.captures.append(capture)
+            while len(self.captures) > self.size:
+                for name in self.captures.popleft()["files"]:
+                    try:
+                        os.remove(os.path.join(self.directory, name))
+                    except OSError:
+                        pass
+
+    async def capture(self, request, call_next):
+        """
+        Run the request under the armed profiler, or as is when this request
+        is not to be profiled.
+        """
+        path = request.url.path
+        mode = self._claim(path)
+        if mode is None:
+            return await call_next(request)
+
+        capture_id = uuid.uuid4().hex[:12]
+        started = datetime.datetime.now(datetime.timezone.utc)
+        start_time = time.perf_counter()
+        if mode == "cprofile":
+            profile = cProfile.Profile()
+            profile.enable()
+        else:
+            sampler = StackSampler()
+            sampler.start()
+        try:
+            return await call_next(request)
+        finally:
+            seconds = time.perf_counter() - start_time
+            if mode == "cprofile":
+                profile.disable()
+                name = f"{capture_id}.prof"
+                profile.dump_stats(os.path.join(self.directory, name))
+            else:
+                sampler.stop()
+                name = f"{capture_id}.folded"
+                sampler.write(os.path.join(self.directory, name))
+            self._store({
+                "id": capture_id,
+                "mode": mode,
+                "target": f"{request.method} {path}",
+                "started": started.isoformat(),
+                "seconds": round(seconds, 3),
+                "files": [name],
+            })
+            with self._lock:
+                self._active = False
+
+    @contextlib.contextmanager
+    def torch_section(self, label: str):
+        """
+        Run the block under torch.profiler when a "torch" capture is armed.
+        """
+        if not self.remaining or self._claim(label, torch_mode=True) is None:
+            yield
+            return
+
+        import torch
+        from torch.profiler import profile, ProfilerActivity
+
+        activities = [ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(ProfilerActivity.CUDA)
+        capture_id = uuid.uuid4().hex[:12]
+        started = datetime.datetime.now(datetime.timezone.utc)
+        start_time = time.perf_counter()
+        try:
+            with profile(activities=activities, record_shapes=True, with_stack=True) as prof:
+                yield
+            if torch.cuda.is_available():
+                torch.cuda.synchronize()
+            trace, stacks = f"{capture_id}.trace.json", f"{capture_id}.folded"
+            prof.export_chrome_trace(os.path.join(self.directory, trace))
+            metric = "self_cuda_time_total" if torch.cuda.is_available() else "self_cpu_time_total"
+            prof.export_stacks(os.path.join(self.directory, stacks), metric)
+            self._store({
+                "id": capture_id,
+                "mode": "torch",
+                "target": label,
+                "started": started.isoformat(),
+                "seconds": round(time.perf_counter() - start_time, 3),
+                "files": [trace, stacks],
+            })
+        finally:
+            with self._lock:
+                self._active = False
+
+    def file_path(self, name: str):
+        """
+        Path of a capture file still in the buffer, or None.
+        """
+        with self._lock:
+            known = any(name in capture["files"] for capture in self.captures)
+        return os.path.join(self.directory, name) if known else None
+
+    def status(self) -> dict:
+        with self._lock:
+            return {
+                "mode": self.mode,
+                "remaining": self.remaining,
+                "path_prefix": self.path_prefix,
+                "captures": list(self.captures),
+            }
+
+
+
+def verify_profiling_token(credentials):
+    if not PROFILING_TOKEN:
+        raise HTTPException(status_code=404, detail="Profiling is disabled")
+    if not hmac.compare_digest(credentials.credentials.encode("utf-8"), PROFILING_TOKEN.encode("utf-8")):
+        raise HTTPException(status_code=403, detail="Admin access required")
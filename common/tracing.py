@@ -0,0 +1,320 @@
+"""
+Tracing shared by the poppler, OCR and LLM services: spans in W3C Trace
+Context, carried between the services in the traceparent header. Each
+service's tracing.py calls configure() with its name and directory.
+
+Show traces from the span files:
+
+    python -m common.tracing poppler/traces.jsonl ocr/traces.jsonl llm/traces.jsonl
+"""
+import argparse
+import collections
+import contextlib
+import contextvars
+import json
+import logging
+import os
+import queue
+import random
+import threading
+import time
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Set by each service's tracing.py through configure()
+SERVICE_NAME = None
+
+# Finished spans are appended as JSON lines to traces.jsonl in the service's
+# directory unless TRACE_FILE is set; merge the services' files with the
+# viewer below
+TRACE_FILE = os.getenv("TRACE_FILE")
+# The file is rotated to TRACE_FILE.1 past this size
+TRACE_FILE_MAX_BYTES = int(os.getenv("TRACE_FILE_MAX_BYTES", str(50 * 1024 * 1024)))
+# Share of new traces recorded; downstream services follow the caller's decision
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "1.0"))
+# Recent traces kept in memory for the admin API of services that have one
+TRACE_BUFFER_SIZE = int(os.getenv("TRACE_BUFFER_SIZE", "500"))
+
+current_span = contextvars.ContextVar("current_span", default=None)
+
+
+class Span:
+    def __init__(self, name: str, trace_id: str, parent_id: str = None, sampled: bool = True, attributes: dict = None):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = f"{random.getrandbits(64):016x}"
+        self.parent_id = parent_id
+        self.sampled = sampled
+        self.start = time.time()
+        self.end = None
+        self.status = "ok"
+        self.attributes = dict(attributes or {})
+
+    @property
+    def traceparent(self) -> str:
+        # W3C Trace Context header
+        return f"00-{self.trace_id}-{self.span_id}-{'01' if self.sampled else '00'}"
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def to_dict(self) -> dict:
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "service": SERVICE_NAME,
+            "name": self.name,
+            "start": self.start,
+            "end": self.end,
+            "duration_ms": round((self.end - self.start) * 1000, 3),
+            "status": self.status,
+            "attributes": self.attributes,
+        }
+
+
+def parse_traceparent(header: str):
+    """
+    (trace_id, parent_id, sampled) from a traceparent header, or None.
+    """
+    parts = (header or "").strip().split("-")
+    if len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None
+    try:
+        sampled = bool(int(parts[3], 16) & 1)
+    except ValueError:
+        return None
+    return parts[1], parts[2], sampled
+
+
+class SpanExporter:
+    """
+    Writes finished spans to a JSON-lines file from a background thread, so
+    requests never wait on the disk, and keeps recent traces in memory.
+    """
+
+    def __init__(self, path: str = TRACE_FILE or "traces.jsonl", max_bytes: int = TRACE_FILE_MAX_BYTES, buffer_size: int = 0):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.buffer_size = buffer_size
+        self.traces = collections.OrderedDict()
+        self._queue = queue.SimpleQueue()
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name="span-exporter", daemon=True)
+        self._thread.start()
+
+    def export(self, record: dict):
+        if self.buffer_size:
+            with self._lock:
+                self.traces.setdefault(record["trace_id"], []).append(record)
+                self.traces.move_to_end(record["trace_id"])
+                while len(self.traces) > self.buffer_size:
+                    self.traces.popitem(last=False)
+        self._queue.put(record)
+
+    def _run(self):
+        while True:
+            record = self._queue.get()
+            try:
+                if os.path.exists(self.path) and os.path.getsize(self.path) > self.max_bytes:
+                    os.replace(self.path, self.path + ".1")
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(record, default=str) + "\n")
+            except OSError as e:
+                logger.error(f"Failed to export span: {e}")
+
+    def trace(self, trace_id: str) -> list:
+        with self._lock:
+            return list(self.traces.get(trace_id, []))
+
+    def roots(self) -> list:
+        """
+        The first span of each trace in memory that started in this service.
+        """
+        with self._lock:
+            spans = [span for spans in self.traces.values() for span in spans]
+        ids = {span["span_id"] for span in spans}
+        return [span for span in spans if span["parent_id"] is None or span["parent_id"] not in ids]
+
+
+exporter = SpanExporter()
+
+
+def configure(service_name: str, directory: str, buffer_size: int = 0):
+    """
+    Name this process's spans and, unless TRACE_FILE is set, write them to
+    traces.jsonl in directory. buffer_size recent traces are kept in memory.
+    """
+    global SERVICE_NAME
+    SERVICE_NAME = service_name
+    exporter.path = TRACE_FILE or os.path.join(directory, "traces.jsonl")
+    exporter.buffer_size = buffer_size
+
+
+def _finish(current: Span):
+    if current.sampled:
+        exporter.export(current.to_dict())
+
+
+@contextlib.contextmanager
+def span(name: str, traceparent: str = None, **attributes):
+    """
+    Record a span around the block, as a child of the current span, of the
+    caller given by a traceparent header, or as the root of a new trace.
+    """
+    remote = parse_traceparent(traceparent) if traceparent else None
+    parent = current_span.get()
+    if remote:
+        trace_id, parent_id, sampled = remote
+    elif parent is not None:
+        trace_id, parent_id, sampled = parent.trace_id, parent.span_id, parent.sampled
+    else:
+        trace_id, parent_id, sampled = f"{random.getrandbits(128):032x}", None, random.random() < TRACE_SAMPLE_RATE
+
+    current = Span(name, trace_id, parent_id, sampled, attributes)
+    token = current_span.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        current.status = "error"
+        current.attributes["error"] = f"{type(e).__name__}: {e}"[:200]
+        raise
+    finally:
+        current.end = time.time()
+        current_span.reset(token)
+        _finish(current)
+
+
+def record_span(name: str, start: float, end: float, parent: Span = None, status: str = "ok", **attributes):
+    """
+    Record a span measured elsewhere, e.g. from timings a backend reports.
+    """
+    parent = parent or current_span.get()
+    if parent is None:
+        return
+    recorded = Span(name, parent.trace_id, parent.span_id, parent.sampled, attributes)
+    recorded.start, recorded.end, recorded.status = start, end, status
+    _finish(recorded)
+
+
+def inject(headers: dict = None) -> dict:
+    """
+    Headers carrying the current trace context to another service.
+    """
+    headers = dict(headers or {})
+    current = current_span.get()
+    if current is not None:
+        headers["traceparent"] = current.traceparent
+    return headers
+
+
+def current_trace_id():
+    current = current_span.get()
+    return current.trace_id if current is not None else None
+
+
+async def trace_request(request, call_next):
+    """
+    HTTP middleware: a server span per request, continuing the caller's trace.
+    """
+    if request.url.path == "/health":
+        return await call_next(request)
+    with span(f"{request.method} {request.url.path}", request.headers.get("traceparent"), kind="server") as current:
+        response = await call_next(request)
+        current.set(status_code=response.status_code)
+        response.headers["X-Trace-Id"] = current.trace_id
+        return response
+
+
+def critical_path(spans: list) -> list:
+    """
+    Span ids on the critical path of a trace: from the root, repeatedly the
+    child that finished last before the parent's cursor, walking backwards.
+    """
+    children = collections.defaultdict(list)
+    ids = {span["span_id"] for span in spans}
+    roots = []
+    for span_record in spans:
+        if span_record["parent_id"] in ids:
+            children[span_record["parent_id"]].append(span_record)
+        else:
+            roots.append(span_record)
+    if not roots:
+        return []
+
+    path = []
+
+    def walk(node):
+        path.append(node["span_id"])
+        cursor = node["end"]
+        for child in sorted(children[node["span_id"]], key=lambda s: s["end"], reverse=True):
+            if child["end"] <= cursor + 1e-6:
+                walk(child)
+                cursor = child["start"]
+
+    walk(max(roots, key=lambda s: s["end"] - s["start"]))
+    return path
+
+
+def load_spans(paths: list, trace_id: str = None) -> list:
+    spans = []
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                record = json.loads(line)
+                if trace_id is None or record["trace_id"] == trace_id:
+                    spans.append(record)
+    return spans
+
+
+def format_trace(spans: list) -> str:
+    """
+    An indented waterfall of one trace, critical path spans marked with *.
+    """
+    if not spans:
+        return "No spans"
+    on_path = set(critical_path(spans))
+    ids = {span_record["span_id"] for span_record in spans}
+    children = collections.defaultdict(list)
+    for span_record in spans:
+        children[span_record["parent_id"] if span_record["parent_id"] in ids else None].append(span_record)
+    origin = min(span_record["start"] for span_record in spans)
+
+    lines = []
+
+    def walk(node, depth):
+        marker = "*" if node["span_id"] in on_path else " "
+        offset = (node["start"] - origin) * 1000
+        lines.append(
+            f"{marker} {offset:9.1f}ms {node['duration_ms']:9.1f}ms  {'  ' * depth}{node['service']}: {node['name']}"
+            + (" [error]" if node["status"] != "ok" else "")
+        )
+        for child in sorted(children[node["span_id"]], key=lambda s: s["start"]):
+            walk(child, depth + 1)
+
+    for root in sorted(children[None], key=lambda s: s["start"]):
+        walk(root, 0)
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Show traces from the services' span files")
+    parser.add_argument("files", nargs="+", help="traces.jsonl files of poppler, ocr and llm")
+    parser.add_argument("--trace", help="Trace id to show (the X-Trace-Id response header)")
+    parser.add_argument("--slowest", type=int, default=10, help="Without --trace, list this many slowest traces")
+    args = parser.parse_args()
+
+    if args.trace:
+        print(format_trace(load_spans(args.files, args.trace)))
+        return
+
+    spans = load_spans(args.files)
+    ids = {span_record["span_id"] for span_record in spans}
+    roots = [span_record for span_record in spans if span_record["parent_id"] not in ids]
+    for root in sorted(roots, key=lambda s: s["duration_ms"], reverse=True)[:args.slowest]:
+        print(f"{root['trace_id']}  {root['duration_ms']:9.1f}ms  {root['service']}: {root['name']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,351 @@
+import copy
+import datetime
+import json
+import logging
+import os
+import re
+import threading
+
+from context import FIELD_PHRASES
+from gemma import extract_entity_compact, extract_entities_compact, json_type, fold_text, llm, small_llm
+from tracing import span
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+TIERS = ["rules", "small", "large"]
+FINAL_TIER = "large"
+
+# Tiers tried in order per document type; the last tier's answer is final.
+# Override with TIER_POLICY='{"aadhaar": ["small", "large"], ...}'
+DEFAULT_TIER_POLICY = {
+    "aadhaar": ["rules", "small", "large"],
+    "birth_certificate": ["rules", "small", "large"],
+    "marksheet": ["small", "large"],
+    "proof_of_class": ["small", "large"],
+    "proof_of_category": ["small", "large"],
+}
+TIER_POLICY = {**DEFAULT_TIER_POLICY, **json.loads(os.getenv("TIER_POLICY", "{}"))}
+
+# An answer below this share of valid, grounded fields escalates
+CONFIDENCE_THRESHOLD = float(os.getenv("CASCADE_CONFIDENCE", "0.8"))
+
+# Documents of one type answered together in a shared model call
+SHARED_BATCH_SIZE = int(os.getenv("SHARED_BATCH_SIZE", "4"))
+
+_DATE_FORMATS = ("%d-%m-%Y", "%d/%m/%Y", "%d.%m.%Y", "%Y-%m-%d", "%Y/%m/%d", "%d %B %Y", "%d %b %Y")
+_RANGE = re.compile(r"(-?\d+(?:\.\d+)?)\s*to\s*(-?\d+(?:\.\d+)?)")
+_DIGITS = re.compile(r"\D")
+
+# Phrases one of which a document must print for the rules tier to accept it
+# as that type; other types, and documents without any, go to a model
+DOCUMENT_ANCHORS = {
+    "aadhaar": ["aadhaar", "आधार", "unique identification authority", "government of india", "भारत सरकार"],
+    "birth_certificate": ["birth certificate", "certificate of birth", "registration of birth", "births and deaths", "जन्म प्रमाण"],
+    "gate_score_card": ["gate", "graduate aptitude test"],
+}
+
+
+def tiers_for(document_type: str, min_tier: str = None) -> list:
+    tiers = [tier for tier in TIER_POLICY.get(document_type, [FINAL_TIER]) if tier in TIERS]
+    if FINAL_TIER not in tiers:
+        tiers.append(FINAL_TIER)
+    if min_tier in TIERS:
+        tiers = [tier for tier in tiers if TIERS.index(tier) >= TIERS.index(min_tier)]
+    return tiers
+
+
+def _is_date_hint(type_hint: str) -> bool:
+    hint = type_hint.lower()
+    return "date" in hint or "dd-mm-yyyy" in hint or "yyyy-mm-dd" in hint
+
+
+def _parse_date(value):
+    for fmt in _DATE_FORMATS:
+        try:
+            return datetime.datetime.strptime(str(value).strip(), fmt).date()
+        except ValueError:
+            continue
+    return None
+
+
+def field_valid(value, type_hint: str, context: str) -> bool:
+    """
+    Whether a non-empty extracted value has the hinted type and can be found
+    in the document text (values made up by the model cannot).
+    """
+    hint = type_hint.lower()
+    if json_type(type_hint) in ("integer", "number"):
+        try:
+            number = float(value)
+        except (TypeError, ValueError):
+            return False
+        bounds = _RANGE.search(hint)
+        if bounds and not float(bounds.group(1)) <= number <= float(bounds.group(2)):
+            return False
+        if "12 digit" in hint and len(_DIGITS.sub("", str(value))) != 12:
+            return False
+        digits = _DIGITS.sub("", str(value).split(".")[0])
+        return digits in _DIGITS.sub("", context)
+
+    if _is_date_hint(type_hint):
+        return _parse_date(value) is not None
+
+    # Text values: most of their words must appear in the document
+    words = fold_text(value).split()
+    folded = fold_text(context)
+    return bool(words) and sum(word in folded for word in words) / len(words) >= 0.5
+
+
+def values_agree(extracted, expected, type_hint: str) -> bool:
+    if _is_date_hint(type_hint):
+        left, right = _parse_date(extracted), _parse_date(expected)
+        if left and right:
+            return left == right
+    if json_type(type_hint) in ("integer", "number"):
+        try:
+            return abs(float(extracted) - float(expected)) < 0.5
+        except (TypeError, ValueError):
+            pass
+    if "12 digit" in type_hint.lower():
+        return _DIGITS.sub("", str(extracted)) == _DIGITS.sub("", str(expected))
+    return sorted(fold_text(extracted).split()) == sorted(fold_text(expected).split())
+
+
+def assess(result: list, json_input: dict, context: str, document_type: str, expected: list = None) -> tuple:
+    """
+    Confidence of an answer and the reason to escalate it, if any.
+
+    Returns:
+        tuple: (confidence, reason) where reason is None when the answer can stand.
+    """
+    if not result or result[0] != document_type:
+        return 0.0, "document_type"
+
+    hints = list(json_input.values())
+    values = result[1:]
+    found = [(value, hint) for value, hint in zip(values, hints) if value not in ("", None)]
+    if not found:
+        return 0.0, "empty"
+    confidence = sum(field_valid(value, hint, context) for value, hint in found) / len(hints)
+    if confidence < CONFIDENCE_THRESHOLD:
+        return confidence, "low_confidence"
+
+    # A disagreement with the applicant's biodata is only reported once the
+    # final tier has seen the document
+    for value, hint, wanted in zip(values, hints, expected or []):
+        if wanted not in ("", None) and value not in ("", None) and not values_agree(value, wanted, hint):
+            return confidence, "mismatch"
+    return confidence, None
+
+
+def anchored(context: str, document_type: str) -> bool:
+    # Whole words for English anchors, so "gate" does not match "aggregate"
+    for anchor in DOCUMENT_ANCHORS.get(document_type, []):
+        pattern = rf"\b{re.escape(anchor)}\b" if anchor.isascii() else re.escape(anchor)
+        if re.search(pattern, context, re.IGNORECASE):
+            return True
+    return False
+
+
+def rule_extract(json_input: dict, context: str, document_type: str):
+    """
+    Labelled-value extraction with regular expressions, the cheapest tier.
+    The type is only confirmed when the text carries one of the type's
+    anchors, "other" otherwise so a model decides.
+    """
+    values = []
+    for field, type_hint in json_input.items():
+        value = ""
+        labels = FIELD_PHRASES.get(field, [field.replace("_", " ")])
+        if "12 digit" in type_hint.lower():
+            match = re.search(r"\b\d{4}\s?\d{4}\s?\d{4}\b", context)
+            value = _DIGITS.sub("", match.group()) if match else ""
+        else:
+            for label in labels:
+                match = re.search(rf"{re.escape(label)}\s*[:\-]?\s*([^\n:]{{2,60}})", context, re.IGNORECASE)
+                if not match:
+                    continue
+                candidate = match.group(1).strip()
+                if _is_date_hint(type_hint):
+                    date_match = re.search(r"\d{1,2}[-/.]\d{1,2}[-/.]\d{4}|\d{4}-\d{2}-\d{2}", candidate)
+                    candidate = date_match.group() if date_match else ""
+                elif json_type(type_hint) in ("integer", "number"):
+                    number_match = re.search(r"\d+(?:\.\d+)?", candidate)
+                    candidate = number_match.group() if number_match else ""
+                if candidate:
+                    value = candidate
+                    break
+        values.append(value)
+    return [document_type if anchored(context, document_type) else "other"] + values
+
+
+class EscalationStats:
+    def __init__(self):
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def record(self, document_type: str, answered_by: str, escalations: list):
+        with self._lock:
+            entry = self._stats.setdefault(document_type, {"requests": 0, "escalated": 0, "answered_by": {}, "escalations": {}})
+            entry["requests"] += 1
+            entry["escalated"] += bool(escalations)
+            entry["answered_by"][answered_by] = entry["answered_by"].get(answered_by, 0) + 1
+            for step in escalations:
+                key = f"{step['from']}:{step['reason']}"
+                entry["escalations"][key] = entry["escalations"].get(key, 0) + 1
+
+    def summary(self) -> dict:
+        with self._lock:
+            return {
+                document_type: {
+                    **copy.deepcopy(entry),
+                    "escalation_rate": entry["escalated"] / entry["requests"] if entry["requests"] else None,
+                }
+                for document_type, entry in self._stats.items()
+            }
+
+
+escalation_stats = EscalationStats()
+
+
+async def extract_cascade(json_input: dict, context: str, document_type: str, expected: list = None, min_tier: str = None) -> dict:
+    """
+    Answer from the cheapest tier the policy allows, escalating on invalid,
+    low-confidence or biodata-mismatching answers.
+
+    Args:
+        expected (list): Applicant values in schema order (None where
+            unknown), so a mismatch escalates before it is reported.
+        min_tier (str): Skip cheaper tiers, used by callers re-checking a
+            non-final answer.
+
+    Returns:
+        dict: result, output_tokens, the tier that answered, whether it is
+            final and the escalations taken.
+    """
+    tiers = tiers_for(document_type, min_tier)
+    escalations = [{"from": "caller", "reason": "recheck"}] if min_tier else []
+    output_tokens = 0
+    for tier in tiers:
+        try:
+            with span(f"cascade.{tier}", document_type=document_type):
+                if tier == "rules":
+                    result = rule_extract(json_input, context, document_type)
+                else:
+                    model = small_llm if tier == "small" else llm
+                    result, tokens = await extract_entity_compact(json_input, context, document_type, model)
+                    output_tokens += tokens or 0
+        except ValueError as e:
+            if tier == tiers[-1]:
+                raise
+            escalations.append({"from": tier, "reason": "malformed"})
+            logger.info(f"Escalating {document_type} from {tier}: {e}")
+            continue
+
+        if tier == tiers[-1]:
+            break
+        confidence, reason = assess(result, json_input, context, document_type, expected)
+        if reason is None:
+            break
+        escalations.append({"from": tier, "reason": reason, "confidence": round(confidence, 3)})
+        logger.info(f"Escalating {document_type} from {tier}: {reason} ({confidence:.2f})")
+
+    escalation_stats.record(document_type, tier, escalations)
+    return {
+        "result": result,
+        "output_tokens": output_tokens,
+        "tier": tier,
+        "final": tier == FINAL_TIER,
+        "escalations": escalations,
+    }
+
+
+async def _answer_group(json_input: dict, contexts: list, document_type: str, model) -> tuple:
+    """
+    Results for a group of documents from one shared call, or per document
+    when the shared answer is malformed. A document whose own answer is also
+    malformed gets its ValueError in place of a result.
+    """
+    if len(contexts) > 1:
+        try:
+            return await extract_entities_compact(json_input, contexts, document_type, model)
+        except ValueError as e:
+            logger.info(f"Shared {document_type} answer malformed, asking per document: {e}")
+    results, output_tokens = [], 0
+    for context in contexts:
+        try:
+            result, tokens = await extract_entity_compact(json_input, context, document_type, model)
+            output_tokens += tokens or 0
+        except ValueError as e:
+            result = e
+        results.append(result)
+    return results, output_tokens
+
+
+async def extract_cascade_batch(json_input: dict, contexts: list, document_type: str, expected: list = None) -> list:
+    """
+    extract_cascade for several documents of one type: each model tier
+    answers the documents still pending in shared calls of up to
+    SHARED_BATCH_SIZE documents, and only documents whose answer does not
+    stand move on to the next tier.
+
+    Args:
+        expected (list): Per document, the applicant values in schema order
+            or None.
+
+    Returns:
+        list: One extract_cascade answer per document, in order, or
+            {"error": ...} for a document no tier could answer.
+    """
+    tiers = tiers_for(document_type)
+    expected = expected or [None] * len(contexts)
+    answers = [None] * len(contexts)
+    escalations = [[] for _ in contexts]
+    output_tokens = [0] * len(contexts)
+    pending = list(range(len(contexts)))
+
+    for tier in tiers:
+        results = {}
+        with span(f"cascade.{tier}", document_type=document_type, documents=len(pending)):
+            if tier == "rules":
+                results = {index: rule_extract(json_input, contexts[index], document_type) for index in pending}
+            else:
+                model = small_llm if tier == "small" else llm
+                for start in range(0, len(pending), SHARED_BATCH_SIZE):
+                    group = pending[start:start + SHARED_BATCH_SIZE]
+                    group_results, tokens = await _answer_group(
+                        json_input, [contexts[index] for index in group], document_type, model
+                    )
+                    results.update(zip(group, group_results))
+                    for index in group:
+                        output_tokens[index] += (tokens or 0) // len(group)
+
+        still_pending = []
+        for index in pending:
+            result = results[index]
+            if isinstance(result, ValueError):
+                if tier == tiers[-1]:
+                    answers[index] = {"error": str(result)}
+                    continue
+                escalations[index].append({"from": tier, "reason": "malformed"})
+                still_pending.append(index)
+                continue
+            if tier != tiers[-1]:
+                confidence, reason = assess(result, json_input, contexts[index], document_type, expected[index])
+                if reason is not None:
+                    escalations[index].append({"from": tier, "reason": reason, "confidence": round(confidence, 3)})
+                    still_pending.append(index)
+                    continue
+            escalation_stats.record(document_type, tier, escalations[index])
+            answers[index] = {
+                "result": result,
+                "output_tokens": output_tokens[index],
+                "tier": tier,
+                "final": tier == FINAL_TIER,
+                "escalations": escalations[index],
+            }
+        pending = still_pending
+        if not pending:
+            break
+    return answers
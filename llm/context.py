@@ -0,0 +1,105 @@
+import os
+import re
+
+# Approximate prompt budget for the document text, in tokens
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "1500"))
+# Lines within this many line heights of a key-phrase match are kept
+NEIGHBOUR_LINE_HEIGHTS = 3.0
+# The top of the first page usually carries the holder's name and the title
+HEADER_LINES = 5
+
+# Extra key phrases for schema fields whose name is not what the document prints
+FIELD_PHRASES = {
+    "name": ["name", "candidate", "student", "नाम"],
+    "date_of_birth": ["date of birth", "dob", "birth", "जन्म"],
+    "aadhaar_number": ["aadhaar", "uid", "आधार"],
+    "address": ["address", "पता", "s/o", "d/o", "c/o", "w/o"],
+    "cgpa": ["cgpa", "cpi", "gpa", "grade point"],
+    "percentage": ["percentage", "%", "marks"],
+    "marks_out_of_100": ["marks out of 100", "marks"],
+    "all_india_rank_in_this_paper": ["all india rank", "air", "rank"],
+    "gate_score": ["gate score", "score"],
+    "year": ["year", "gate"],
+    "passing_year": ["year of passing", "passing", "passed"],
+    "qualification_degree": ["degree", "bachelor", "master", "b.tech", "m.tech", "b.e", "m.e", "ph.d"],
+    "class": ["class", "division", "distinction"],
+    "category": ["category", "caste", "sc", "st", "obc", "ews"],
+    "Date_of_reg": ["registration", "registered"],
+    "title_of_project": ["title", "thesis"],
+    "from_date": ["from", "since", "joined"],
+    "to_date": ["to", "till", "relieved"],
+}
+
+
+def estimate_tokens(text: str) -> int:
+    # Close enough for budgeting: about four characters per token
+    return len(text) // 4 + 1
+
+
+def field_phrases(schema: dict) -> list:
+    phrases = set()
+    for field in schema:
+        phrases.add(field.replace("_", " ").lower())
+        phrases.update(phrase.lower() for phrase in FIELD_PHRASES.get(field, []))
+    return sorted(phrases, key=len, reverse=True)
+
+
+def _matcher(phrases: list):
+    # Whole-word match for short phrases like "air" or "st", substring otherwise
+    parts = [rf"\b{re.escape(phrase)}\b" if phrase.isalpha() and len(phrase) <= 4 else re.escape(phrase) for phrase in phrases]
+    return re.compile("|".join(parts), re.IGNORECASE)
+
+
+def select_context(lines: list, schema: dict, token_budget: int = CONTEXT_TOKEN_BUDGET) -> str:
+    """
+    Keep only the OCR lines near key phrases of the requested schema fields.
+
+    Args:
+        lines (list): OCR lines with "text", "bbox" [x0, y0, x1, y1], "page"
+            and "confidence".
+        schema (dict): Fields being extracted.
+        token_budget (int): Upper bound on the returned text's size.
+
+    Returns:
+        str: The selected lines in reading order, one per line.
+    """
+    if not lines:
+        return ""
+
+    ordered = sorted(lines, key=lambda line: (line.get("page", 1), line["bbox"][1], line["bbox"][0]))
+    matcher = _matcher(field_phrases(schema))
+    matches = [i for i, line in enumerate(ordered) if matcher.search(line["text"])]
+
+    # Rank every line by its distance to the nearest match on the same page,
+    # measured in line heights; header lines always come first
+    ranks = {}
+    for i, line in enumerate(ordered):
+        if i < HEADER_LINES:
+            ranks[i] = 0.0
+            continue
+        height = max(1.0, line["bbox"][3] - line["bbox"][1])
+        for m in matches:
+            match = ordered[m]
+            if match.get("page", 1) != line.get("page", 1):
+                continue
+            distance = abs(match["bbox"][1] - line["bbox"][1]) / height
+            if distance <= NEIGHBOUR_LINE_HEIGHTS:
+                ranks[i] = min(ranks.get(i, distance), distance)
+
+    selected, used = set(), 0
+    for i in sorted(ranks, key=lambda i: (ranks[i], i)):
+        cost = estimate_tokens(ordered[i]["text"])
+        if used + cost > token_budget:
+            continue
+        selected.add(i)
+        used += cost
+
+    return "\n".join(ordered[i]["text"] for i in sorted(selected))
+
+
+def truncate_to_budget(text: str, token_budget: int = CONTEXT_TOKEN_BUDGET) -> str:
+    """
+    Fallback for callers that only send raw text: keep the head of the text
+    so long documents cannot overflow the context window.
+    """
+    return text[: token_budget * 4]
@@ -0,0 +1,81 @@
+import logging
+
+from gemma import extract_entity
+from cascade import extract_cascade, extract_cascade_batch
+from context import select_context, truncate_to_budget, estimate_tokens
+from tracing import span, current_trace_id
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+async def process_request(data: dict) -> dict:
+    """
+    Extract the schema fields from OCR output, the body of /process-data.
+    Poppler's embedded mode calls this in-process with the same payload.
+
+    Raises:
+        ValueError: The payload has no valid schema.
+    """
+    # The trace id ties these log lines to the upload across services
+    request_id = current_trace_id()
+    schema = data.get("schema")
+    raw_text = data.get("raw_text") or ""
+    lines = data.get("lines")
+
+    # Check if schema is a valid JSON
+    if not isinstance(schema, dict):
+        raise ValueError("Invalid schema format")
+
+    logger.info(f"Request received {request_id}")
+
+    # Only the lines around the requested fields go into the prompt
+    with span("select_context", lines=len(lines) if isinstance(lines, list) else 0):
+        context = select_context(lines, schema) if isinstance(lines, list) else ""
+        if not context:
+            context = truncate_to_budget(raw_text)
+    logger.info(f"Prompt context: {estimate_tokens(context)} of {estimate_tokens(raw_text)} tokens")
+
+    if data.get("output") == "compact" and data.get("document_type"):
+        answer = await extract_cascade(
+            schema, context, data["document_type"], data.get("expected"), data.get("min_tier")
+        )
+        logger.info(f"Request {request_id}: {answer['output_tokens']} output tokens from {answer['tier']} tier")
+        return answer
+
+    result = await extract_entity(schema, context)
+    output_tokens = estimate_tokens(result)
+    logger.info(f"Request {request_id}: {output_tokens} output tokens")
+    return {'result': result, 'output_tokens': output_tokens}
+
+
+async def process_batch(data: dict) -> dict:
+    """
+    Extract the schema fields from several documents of one type in shared
+    model calls, the body of /process-batch.
+
+    Raises:
+        ValueError: The payload has no valid schema, document type or documents.
+    """
+    request_id = current_trace_id()
+    schema = data.get("schema")
+    document_type = data.get("document_type")
+    documents = data.get("documents")
+    if not isinstance(schema, dict):
+        raise ValueError("Invalid schema format")
+    if not document_type or not isinstance(documents, list) or not documents:
+        raise ValueError("A document type and a list of documents are required")
+
+    contexts = []
+    with span("select_context", documents=len(documents)):
+        for document in documents:
+            lines = document.get("lines")
+            context = select_context(lines, schema) if isinstance(lines, list) else ""
+            contexts.append(context or truncate_to_budget(document.get("raw_text") or ""))
+
+    answers = await extract_cascade_batch(
+        schema, contexts, document_type, [document.get("expected") for document in documents]
+    )
+    tiers = [answer.get("tier") for answer in answers]
+    logger.info(f"Request {request_id}: {len(documents)} {document_type} documents answered by {tiers}")
+    return {"answers": answers}
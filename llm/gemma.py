@@ -1,11 +1,27 @@
 from langchain_ollama import OllamaLLM
 import logging
+import os
+import json
+import sys
+import time
+from context import estimate_tokens
+from scheduler import scheduler
+from tracing import span, record_span
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common.normalize import fold_text
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-llm = OllamaLLM(model="gemma2:9b", temperature=0)
+LARGE_MODEL = os.getenv("LARGE_MODEL", "gemma2:9b")
+SMALL_MODEL = os.getenv("SMALL_MODEL", "gemma2:2b")
+
+llm = OllamaLLM(model=LARGE_MODEL, temperature=0)
+# First tier of the extraction cascade, see cascade.py
+small_llm = OllamaLLM(model=SMALL_MODEL, temperature=0)
 
 # Define the prompt template for JSON validation
 template = """
@@ -56,6 +72,150 @@ Strict Instructions:
 - Your output should only start from '[' and end with ']'.
 """
 
+# Compact output mode: the model fills a JSON object constrained by a schema
+# derived from the field type hints, with one short positional key per field
+compact_template = """Extract fields from the document text. Reply with JSON only.
+"t": true if the text is a {document_type} document, else false.
+{fields}
+Use null for a field that is not in the text. Give English values, translating if needed.
+
+Text:
+{raw_text}
+"""
+
+def json_type(type_hint):
+    """
+    JSON schema type for a prompt_schema type hint.
+    """
+    hint = str(type_hint).strip().lower()
+    if hint.startswith("integer"):
+        return "integer"
+    if hint.startswith("float"):
+        return "number"
+    return "string"
+
+def build_output_schema(json_input):
+    """
+    JSON schema for compact output: "t" flags the document type, and fields
+    are keyed "1", "2", ... in schema order with typed, nullable values.
+    """
+    properties = {"t": {"type": "boolean"}}
+    for position, type_hint in enumerate(json_input.values(), start=1):
+        properties[str(position)] = {"type": [json_type(type_hint), "null"]}
+    return {"type": "object", "properties": properties, "required": list(properties), "additionalProperties": False}
+
+# Several documents of one type in one call, answered as a list of compact objects
+shared_template = """Extract fields from each of the {count} documents below. Reply with JSON only:
+"documents" holds one object per document, in the order given.
+"t": true if the text is a {document_type} document, else false.
+{fields}
+Use null for a field that is not in the text. Give English values, translating if needed.
+
+{documents}
+"""
+
+def convert_compact_to_list(output, json_input, document_type):
+    """
+    Turn compact output into the array the callers compare:
+    [document_type or "other", value, ...] with "" for missing values.
+    """
+    return compact_values(json.loads(output), json_input, document_type)
+
+def compact_values(data, json_input, document_type):
+    values = []
+    for position in range(1, len(json_input) + 1):
+        value = data.get(str(position))
+        values.append("" if value is None else value)
+    return [document_type if data.get("t") else "other"] + values
+
+async def extract_entity_compact(json_input, raw_text, document_type, model=None):
+    """
+    Extract fields with schema-constrained decoding, on the large model
+    unless another model is given.
+
+    Returns:
+        tuple: The extracted array and the number of generated tokens.
+    """
+    fields = "\n".join(
+        f'"{position}": {key} ({type_hint})' for position, (key, type_hint) in enumerate(json_input.items(), start=1)
+    )
+    formatted_prompt = compact_template.format(document_type=document_type, fields=fields, raw_text=raw_text)
+
+    model = model or llm
+    async with scheduler.slot(estimate_tokens(formatted_prompt)):
+        with span("llm.generate", model=model.model) as current:
+            response = await model.agenerate([formatted_prompt], format=build_output_schema(json_input))
+            generation = response.generations[0][0]
+            info = generation.generation_info or {}
+            output_tokens = info.get("eval_count")
+            current.set(prompt_tokens=info.get("prompt_eval_count"), output_tokens=output_tokens)
+            record_ollama_phases(info)
+    try:
+        result = convert_compact_to_list(generation.text, json_input, document_type)
+    except (json.JSONDecodeError, AttributeError) as e:
+        raise ValueError(f"Malformed compact output: {e}")
+    logger.info(f"Compact extraction: {result}, {output_tokens} output tokens")
+    return result, output_tokens
+
+async def extract_entities_compact(json_input, raw_texts, document_type, model=None):
+    """
+    Extract the same fields from several documents of one type in a single
+    schema-constrained call, sharing the instructions and the model's turn.
+
+    Returns:
+        tuple: One extracted array per document and the number of generated tokens.
+    """
+    fields = "\n".join(
+        f'"{position}": {key} ({type_hint})' for position, (key, type_hint) in enumerate(json_input.items(), start=1)
+    )
+    documents = "\n\n".join(f"Document {number}:\n{raw_text}" for number, raw_text in enumerate(raw_texts, start=1))
+    formatted_prompt = shared_template.format(
+        count=len(raw_texts), document_type=document_type, fields=fields, documents=documents
+    )
+    output_schema = {
+        "type": "object",
+        "properties": {
+            "documents": {
+                "type": "array",
+                "items": build_output_schema(json_input),
+                "minItems": len(raw_texts),
+                "maxItems": len(raw_texts),
+            }
+        },
+        "required": ["documents"],
+    }
+
+    model = model or llm
+    async with scheduler.slot(estimate_tokens(formatted_prompt)):
+        with span("llm.generate", model=model.model, documents=len(raw_texts)) as current:
+            response = await model.agenerate([formatted_prompt], format=output_schema)
+            generation = response.generations[0][0]
+            info = generation.generation_info or {}
+            output_tokens = info.get("eval_count")
+            current.set(prompt_tokens=info.get("prompt_eval_count"), output_tokens=output_tokens)
+            record_ollama_phases(info)
+    try:
+        answers = json.loads(generation.text)["documents"]
+        if len(answers) != len(raw_texts):
+            raise ValueError(f"{len(answers)} answers for {len(raw_texts)} documents")
+        results = [compact_values(answer, json_input, document_type) for answer in answers]
+    except (json.JSONDecodeError, KeyError, TypeError, AttributeError) as e:
+        raise ValueError(f"Malformed shared output: {e}")
+    logger.info(f"Shared extraction of {len(raw_texts)} documents, {output_tokens} output tokens")
+    return results, output_tokens
+
+def record_ollama_phases(info: dict):
+    """
+    Spans for the model load, prompt evaluation and generation phases, laid
+    out backwards from now with the durations (ns) Ollama reports.
+    """
+    end = time.time()
+    for name, key in (("llm.eval", "eval_duration"), ("llm.prompt_eval", "prompt_eval_duration"), ("llm.load", "load_duration")):
+        duration = (info.get(key) or 0) / 1e9
+        if duration:
+            record_span(name, end - duration, end)
+            end -= duration
+
 def convert_extracted_to_list(extracted_string):
     """
     Convert the extracted entity mapping output from a string to a list.
@@ -88,7 +248,7 @@ def compare_values(extracted_values_string, runtime_values):
     results = {"status": "matched", "mismatches": []}
 
     for i, (extracted_value, runtime_value) in enumerate(zip(extracted_values[1:], runtime_values)):
-        if extracted_value.lower() != runtime_value.lower():
+        if fold_text(extracted_value) != fold_text(runtime_value):
             results["status"] = "mismatched"
             results["mismatches"].append({"index": i, "extracted": extracted_value, "runtime": runtime_value})
 
@@ -99,15 +259,15 @@ async def extract_entity(json_input, raw_text):
     array_schema = [f"Obtained {key} here" for key in json_input.keys()]
     formatted_prompt = template.format(json_input, raw_text, ["Obtained document_type here"] + array_schema)
 
-    print("Started streaming...")
-    result = llm.stream(formatted_prompt)
-
-    ans = ""
+    logger.debug("Started streaming...")
+    async with scheduler.slot(estimate_tokens(formatted_prompt)):
+        with span("llm.stream", model=llm.model):
+            ans = ""
 
-    # Stream the result and yield each chunk to the caller
-    for chunk in result:
-        ans += chunk
-        # yield chunk
-        logger.info(ans)
+            # Streamed asynchronously so other requests keep queueing meanwhile
+            async for chunk in llm.astream(formatted_prompt):
+                ans += chunk
+                # yield chunk
+                logger.info(ans)
     
     return ans
\ No newline at end of file
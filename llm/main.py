@@ -1,7 +1,12 @@
-from fastapi import FastAPI, Request, HTTPException
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, Request, HTTPException, Depends
+from fastapi.responses import JSONResponse, FileResponse
+from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 import json
-from gemma import extract_entity
+from cascade import escalation_stats
+from extraction import process_request, process_batch
+from profiling import profiler, verify_profiling_token
+from scheduler import scheduler, run_with_deadline, DeadlineExceeded, DEFAULT_DEADLINE_SECONDS
+from tracing import trace_request
 import uvicorn
 import torch
 import logging
@@ -19,27 +24,31 @@ else:
     exit()
 
 app = FastAPI()
+security = HTTPBearer()
 
-request_id = 1
+@app.middleware("http")
+async def profile_requests(request: Request, call_next):
+    # Disarmed profiling costs one attribute read per request
+    if not profiler.remaining:
+        return await call_next(request)
+    return await profiler.capture(request, call_next)
+
+@app.middleware("http")
+async def trace_requests(request: Request, call_next):
+    # Continues the orchestrator's trace from its traceparent header
+    return await trace_request(request, call_next)
 
 @app.post("/process-data")
 async def process_data(request: Request):
-    global request_id
-    request_id += 1
-
     try:
         data = await request.json()
-        schema = data.get("schema")
-        raw_text = data.get("raw_text")
-
-        # Check if schema is a valid JSON
-        if not isinstance(schema, dict):
-            raise ValueError("Invalid schema format")
-        
-        logger.info(f"Request received {request_id}")
-        result = await extract_entity(schema, raw_text)
-        return JSONResponse(content={'result': result})
+        # Seconds the caller will wait; past that the answer would be thrown away
+        timeout = float(request.headers.get("X-Request-Timeout") or DEFAULT_DEADLINE_SECONDS)
+        return JSONResponse(content=await run_with_deadline(process_request(data), timeout, request.is_disconnected))
 
+    except DeadlineExceeded as e:
+        logger.warning(f"Dropped request: {e}")
+        raise HTTPException(status_code=504, detail=str(e))
     except ValueError as e:
         logger.error(f"ValueError: {e}")
         raise HTTPException(status_code=400, detail=str(e))
@@ -47,5 +56,78 @@ async def process_data(request: Request):
         logger.exception("An error occurred while processing the request.")
         raise HTTPException(status_code=500, detail="An internal server error occurred.")
 
+@app.post("/process-batch")
+async def process_data_batch(request: Request):
+    """
+    Several documents of one type: {"schema", "document_type", "documents":
+    [{"raw_text", "lines", "expected"}, ...]}, answered in shared calls.
+    """
+    try:
+        data = await request.json()
+        timeout = float(request.headers.get("X-Request-Timeout") or DEFAULT_DEADLINE_SECONDS)
+        return JSONResponse(content=await run_with_deadline(process_batch(data), timeout, request.is_disconnected))
+
+    except DeadlineExceeded as e:
+        logger.warning(f"Dropped batch: {e}")
+        raise HTTPException(status_code=504, detail=str(e))
+    except ValueError as e:
+        logger.error(f"ValueError: {e}")
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.exception("An error occurred while processing the batch.")
+        raise HTTPException(status_code=500, detail="An internal server error occurred.")
+
+@app.get("/stats/escalations")
+async def get_escalation_stats():
+    """
+    Per document type: requests, the tier that answered and why answers
+    were escalated.
+    """
+    return escalation_stats.summary()
+
+@app.get("/stats/scheduler")
+async def get_scheduler_stats():
+    """
+    Generation slots in use, queue length, queue wait distribution and the
+    requests dropped for passing their deadline or being abandoned.
+    """
+    return scheduler.stats()
+
+@app.post("/profiling")
+async def start_profiling(request: dict, credentials: HTTPAuthorizationCredentials = Depends(security)):
+    """
+    Profile the next requests: mode "sampling" (folded stacks, default) or
+    "cprofile" (pstats), "requests" to capture and an optional "path_prefix".
+    """
+    verify_profiling_token(credentials)
+    try:
+        profiler.arm(request.get("mode", "sampling"), int(request.get("requests", 1)), request.get("path_prefix", ""))
+    except (TypeError, ValueError) as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return profiler.status()
+
+@app.delete("/profiling")
+async def stop_profiling(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    verify_profiling_token(credentials)
+    profiler.disarm()
+    return profiler.status()
+
+@app.get("/profiling")
+async def get_profiling_status(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    verify_profiling_token(credentials)
+    return profiler.status()
+
+@app.get("/profiling/{file_name}")
+async def download_profile(file_name: str, credentials: HTTPAuthorizationCredentials = Depends(security)):
+    verify_profiling_token(credentials)
+    path = profiler.file_path(file_name)
+    if path is None:
+        raise HTTPException(status_code=404, detail="Capture not found")
+    return FileResponse(path, filename=file_name)
+
+@app.get("/health")
+async def health_check():
+    return {"status": "ok"}
+
 if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=8002)
\ No newline at end of file
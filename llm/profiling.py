@@ -0,0 +1,13 @@
+"""
+Profiling for the LLM service, shared with the other services in
+common/profiling.py.
+"""
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common.profiling import Profiler, profiles_directory, verify_profiling_token
+
+# The model runs in Ollama, so there are no torch sections to capture
+profiler = Profiler(profiles_directory("llm", os.path.dirname(os.path.abspath(__file__))), modes=("sampling", "cprofile"))
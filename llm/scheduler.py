@@ -0,0 +1,197 @@
+import asyncio
+import bisect
+import contextvars
+import heapq
+import itertools
+import logging
+import os
+import time
+from contextlib import asynccontextmanager
+
+from tracing import span
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Generations the Ollama server runs in parallel (its OLLAMA_NUM_PARALLEL).
+# Anything more in flight would only queue inside Ollama, first come first
+# served, where it can no longer be reordered or dropped.
+GENERATION_SLOTS = int(os.getenv("GENERATION_SLOTS", os.getenv("OLLAMA_NUM_PARALLEL", "1")))
+# Prompt tokens a waiting request is credited per second of waiting, so a
+# long prompt overtakes newer short ones after a bounded wait
+AGING_TOKENS_PER_SECOND = float(os.getenv("AGING_TOKENS_PER_SECOND", "200"))
+# Used when the caller does not send X-Request-Timeout
+DEFAULT_DEADLINE_SECONDS = float(os.getenv("DEFAULT_DEADLINE_SECONDS", "60"))
+# How often a running request checks whether its caller disconnected
+DISCONNECT_POLL_SECONDS = 0.5
+
+# Upper bounds (ms) of the queue wait histogram buckets; the last bucket is open
+WAIT_BUCKETS_MS = [10, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000]
+
+# Monotonic deadline of the request being served in the current task
+current_deadline = contextvars.ContextVar("current_deadline", default=None)
+# {"slots": n} of that request, the generation slots it holds right now
+current_slots = contextvars.ContextVar("current_slots", default=None)
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class GenerationScheduler:
+    """
+    Admits generations up to the backend's slot count. Waiters are served
+    shortest prompt first, less AGING_TOKENS_PER_SECOND per second waited;
+    since every waiter ages at the same rate, the order is fixed at enqueue
+    time by tokens + rate * enqueue time. Work whose deadline passes while
+    queued never reaches the model.
+    """
+
+    def __init__(self, slots: int = GENERATION_SLOTS, aging_rate: float = AGING_TOKENS_PER_SECOND):
+        self.slots = slots
+        self.aging_rate = aging_rate
+        self.active = 0
+        self._waiters = []
+        self._sequence = itertools.count()
+        self.completed = 0
+        self.expired = 0
+        self.expired_running = 0
+        self.abandoned = 0
+        self.wait_count = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.wait_buckets = [0] * (len(WAIT_BUCKETS_MS) + 1)
+
+    @property
+    def waiting(self) -> int:
+        return sum(1 for _, _, future in self._waiters if not future.done())
+
+    async def acquire(self, prompt_tokens: int, deadline: float = None):
+        if self.active < self.slots and not self.waiting:
+            self.active += 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (prompt_tokens + self.aging_rate * time.monotonic(), next(self._sequence), future))
+        timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+        try:
+            done, _ = await asyncio.wait({future}, timeout=timeout)
+        except asyncio.CancelledError:
+            self._abandon(future)
+            raise
+        if not done:
+            self._abandon(future)
+            raise DeadlineExceeded("Deadline passed while queued for generation")
+
+    def _abandon(self, future: asyncio.Future):
+        # The slot may have been handed over just before the waiter gave up
+        if future.done() and not future.cancelled():
+            self.release()
+        else:
+            future.cancel()
+
+    def release(self):
+        while self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                future.set_result(None)
+                return
+        self.active -= 1
+
+    def _record_wait(self, seconds: float):
+        self.wait_count += 1
+        self.wait_total += seconds
+        self.wait_max = max(self.wait_max, seconds)
+        self.wait_buckets[bisect.bisect_left(WAIT_BUCKETS_MS, seconds * 1000)] += 1
+
+    @asynccontextmanager
+    async def slot(self, prompt_tokens: int):
+        """
+        Hold a generation slot for a prompt of about prompt_tokens tokens,
+        within the current request's deadline.
+        """
+        start_time = time.monotonic()
+        with span("queue.generation", prompt_tokens=prompt_tokens):
+            await self.acquire(prompt_tokens, current_deadline.get())
+        self._record_wait(time.monotonic() - start_time)
+        held = current_slots.get() or {}
+        held["slots"] = held.get("slots", 0) + 1
+        try:
+            yield
+        finally:
+            held["slots"] -= 1
+            self.release()
+            self.completed += 1
+
+    def wait_percentile(self, percentile: int):
+        """
+        Upper bound (ms) of the bucket holding the percentile, None when it
+        falls in the open last bucket.
+        """
+        rank, seen = self.wait_count * percentile / 100, 0
+        for index, count in enumerate(self.wait_buckets):
+            seen += count
+            if seen >= rank:
+                return WAIT_BUCKETS_MS[index] if index < len(WAIT_BUCKETS_MS) else None
+        return None
+
+    def stats(self) -> dict:
+        return {
+            "slots": self.slots,
+            "active": self.active,
+            "waiting": self.waiting,
+            "completed": self.completed,
+            "expired": self.expired,
+            "expired_running": self.expired_running,
+            "abandoned": self.abandoned,
+            "queue_wait": {
+                "count": self.wait_count,
+                "mean_ms": round(self.wait_total / self.wait_count * 1000, 1) if self.wait_count else None,
+                "max_ms": round(self.wait_max * 1000, 1),
+                "p50_ms": self.wait_percentile(50) if self.wait_count else None,
+                "p95_ms": self.wait_percentile(95) if self.wait_count else None,
+                "buckets": dict(zip([str(bound) for bound in WAIT_BUCKETS_MS] + ["inf"], self.wait_buckets)),
+            },
+        }
+
+
+scheduler = GenerationScheduler()
+
+
+async def run_with_deadline(coroutine, timeout: float, is_disconnected=None):
+    """
+    Run a request's work under a deadline, cancelling it when the deadline
+    passes or the caller disconnects, whether it is queued or generating.
+    Expiries are counted as expired, or expired_running when the work held
+    a generation slot at the time.
+
+    Raises:
+        DeadlineExceeded: The work was dropped.
+    """
+    deadline = time.monotonic() + timeout
+    held = {"slots": 0}
+    token = current_deadline.set(deadline)
+    slots_token = current_slots.set(held)
+    # The task copies the context, deadline included
+    task = asyncio.ensure_future(coroutine)
+    try:
+        while True:
+            remaining = deadline - time.monotonic()
+            done, _ = await asyncio.wait({task}, timeout=max(0.0, min(DISCONNECT_POLL_SECONDS, remaining)))
+            if done:
+                if isinstance(task.exception(), DeadlineExceeded):
+                    scheduler.expired += 1
+                return task.result()
+            if time.monotonic() >= deadline:
+                if held["slots"]:
+                    scheduler.expired_running += 1
+                else:
+                    scheduler.expired += 1
+                raise DeadlineExceeded(f"Deadline of {timeout:.1f}s passed")
+            if is_disconnected is not None and await is_disconnected():
+                scheduler.abandoned += 1
+                raise DeadlineExceeded("Caller disconnected")
+    finally:
+        current_deadline.reset(token)
+        current_slots.reset(slots_token)
+        if not task.done():
+            task.cancel()
@@ -0,0 +1,14 @@
+"""
+Tracing for the LLM service, shared with the other services in
+common/tracing.py.
+"""
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common.tracing import (
+    configure, current_span, current_trace_id, inject, parse_traceparent, record_span, span, trace_request
+)
+
+configure("llm", os.path.dirname(os.path.abspath(__file__)))
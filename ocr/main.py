@@ -1,5 +1,13 @@
-from fastapi import FastAPI, HTTPException, File, UploadFile
-from surya_ocr import extract_text_from_image, load_models_once
+from fastapi import FastAPI, HTTPException, File, UploadFile, Form, Request, Depends
+from fastapi.responses import FileResponse
+from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+from surya_ocr import extract_text_from_image, extract_text_from_images, load_models_once
+from typing import List, Optional
+from script_detect import language_stats
+from templates import template_stats
+from shared_pages import shared_page_images
+from profiling import profiler, verify_profiling_token
+from tracing import trace_request
 import uvicorn
 import os
 import time
@@ -16,9 +24,22 @@ else:
     exit()
 
 app = FastAPI()
+security = HTTPBearer()
 
 load_models_once()
 
+@app.middleware("http")
+async def trace_requests(request: Request, call_next):
+    # Continues the orchestrator's trace from its traceparent header
+    return await trace_request(request, call_next)
+
+@app.middleware("http")
+async def profile_requests(request: Request, call_next):
+    # Disarmed profiling costs one attribute read per request
+    if not profiler.remaining:
+        return await call_next(request)
+    return await profiler.capture(request, call_next)
+
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -27,7 +48,7 @@ logger = logging.getLogger(__name__)
 BASE_DIR = Path(os.getenv("OCR_BASE_DIR", "/home/sumith/Downloads/server/ocr"))
 
 @app.post("/extract-text")
-async def process_data(file: UploadFile = File(...)) -> dict:
+async def process_data(file: UploadFile = File(...), document_type: Optional[str] = Form(None)) -> dict:
     file_path = None
     try:
         # Validate if the file is an image
@@ -53,7 +74,7 @@ async def process_data(file: UploadFile = File(...)) -> dict:
             buffer.write(await file.read())
         
         # Call the extract_text_from_image function with the saved file path
-        result = extract_text_from_image(str(file_path))
+        result = extract_text_from_image(str(file_path), document_type)
         
         # Return the result
         logger.info(f"Extracted text: {result['extracted_text']}")
@@ -74,5 +95,136 @@ async def process_data(file: UploadFile = File(...)) -> dict:
             except Exception as e:
                 logger.error(f"Failed to delete image file {file_path}: {e}")
 
+@app.post("/extract-text-batch")
+async def process_batch(files: List[UploadFile] = File(...), document_types: Optional[List[str]] = Form(None)) -> dict:
+    """
+    OCR several page images in one GPU batch, results are in upload order.
+    document_types, when sent, gives each page's document type ("" if unknown).
+    """
+    if document_types is not None and len(document_types) != len(files):
+        raise HTTPException(status_code=400, detail="document_types must match the number of files.")
+    file_paths = []
+    try:
+        image_dir = BASE_DIR / "image"
+        image_dir.mkdir(parents=True, exist_ok=True)
+        timestamp = int(time.time())
+
+        for index, file in enumerate(files):
+            try:
+                image = Image.open(file.file)
+                image.verify()
+                file.file.seek(0)
+            except Exception as e:
+                logger.error(f"Uploaded file is not a valid image: {e}")
+                raise HTTPException(status_code=400, detail=f"Uploaded file {file.filename} is not a valid image.")
+
+            file_path = image_dir / f"{timestamp}_{index}_{file.filename}"
+            async with aiofiles.open(file_path, "wb") as buffer:
+                await buffer.write(await file.read())
+            file_paths.append(file_path)
+
+        results = extract_text_from_images(
+            [str(file_path) for file_path in file_paths],
+            [document_type or None for document_type in document_types] if document_types else None
+        )
+        return {"results": results}
+
+    except HTTPException as e:
+        raise e
+    except Exception as e:
+        logger.exception("An error occurred while processing the batch.")
+        raise HTTPException(status_code=500, detail="An internal server error occurred.")
+
+    finally:
+        for file_path in file_paths:
+            if file_path.exists():
+                try:
+                    file_path.unlink()
+                except Exception as e:
+                    logger.error(f"Failed to delete image file {file_path}: {e}")
+
+@app.post("/extract-text-shared")
+async def process_shared(request: dict) -> dict:
+    """
+    OCR pages the orchestrator put in shared memory on this host. Each page
+    is a handle {"name", "size": [width, height], "mode"}; the pixels are
+    read in place, nothing is decoded or written to disk. Responds 409 when
+    a segment cannot be found, so the orchestrator falls back to bytes.
+    """
+    handles = request.get("pages")
+    document_types = request.get("document_types")
+    if not isinstance(handles, list) or not handles:
+        raise HTTPException(status_code=400, detail="pages is required.")
+    if document_types is not None and len(document_types) != len(handles):
+        raise HTTPException(status_code=400, detail="document_types must match the number of pages.")
+    try:
+        with shared_page_images(handles) as images:
+            results = extract_text_from_images(images, [document_type or None for document_type in document_types or [None] * len(images)])
+        return {"results": results}
+    except FileNotFoundError as e:
+        logger.error(f"Shared page not found: {e}")
+        raise HTTPException(status_code=409, detail="Shared page not found on this host.")
+    except (KeyError, TypeError, ValueError) as e:
+        logger.error(f"Invalid page handle: {e}")
+        raise HTTPException(status_code=400, detail="Invalid page handle.")
+    except HTTPException as e:
+        raise e
+    except Exception as e:
+        logger.exception("An error occurred while processing shared pages.")
+        raise HTTPException(status_code=500, detail="An internal server error occurred.")
+
+@app.get("/stats/languages")
+async def get_language_stats():
+    """
+    Recognition time per page and mean line confidence per language set.
+    """
+    return language_stats.summary()
+
+@app.get("/stats/templates")
+async def get_template_stats():
+    """
+    Pages read through each layout template and pages that fell back to
+    full-page OCR.
+    """
+    return template_stats.summary()
+
+@app.post("/profiling")
+async def start_profiling(request: dict, credentials: HTTPAuthorizationCredentials = Depends(security)):
+    """
+    Profile the next requests: mode "sampling" (folded stacks, default),
+    "cprofile" (pstats) or "torch" (the PyTorch profiler around the OCR
+    model calls, as a Chrome trace and folded stacks), "requests" to capture
+    and an optional "path_prefix".
+    """
+    verify_profiling_token(credentials)
+    try:
+        profiler.arm(request.get("mode", "sampling"), int(request.get("requests", 1)), request.get("path_prefix", ""))
+    except (TypeError, ValueError) as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return profiler.status()
+
+@app.delete("/profiling")
+async def stop_profiling(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    verify_profiling_token(credentials)
+    profiler.disarm()
+    return profiler.status()
+
+@app.get("/profiling")
+async def get_profiling_status(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    verify_profiling_token(credentials)
+    return profiler.status()
+
+@app.get("/profiling/{file_name}")
+async def download_profile(file_name: str, credentials: HTTPAuthorizationCredentials = Depends(security)):
+    verify_profiling_token(credentials)
+    path = profiler.file_path(file_name)
+    if path is None:
+        raise HTTPException(status_code=404, detail="Capture not found")
+    return FileResponse(path, filename=file_name)
+
+@app.get("/health")
+async def health_check():
+    return {"status": "ok"}
+
 if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=8001)
\ No newline at end of file
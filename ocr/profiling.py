@@ -0,0 +1,12 @@
+"""
+Profiling for the OCR service, shared with the other services in
+common/profiling.py.
+"""
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common.profiling import Profiler, profiles_directory, verify_profiling_token
+
+profiler = Profiler(profiles_directory("ocr", os.path.dirname(os.path.abspath(__file__))))
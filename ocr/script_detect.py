@@ -0,0 +1,111 @@
+import logging
+import threading
+import unicodedata
+from collections import Counter
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Unicode blocks of the scripts on Indian certificates and the surya
+# language code recognized for each
+SCRIPT_BLOCKS = [
+    (0x0900, 0x097F, "hi"),  # Devanagari
+    (0x0980, 0x09FF, "bn"),  # Bengali
+    (0x0A00, 0x0A7F, "pa"),  # Gurmukhi
+    (0x0A80, 0x0AFF, "gu"),  # Gujarati
+    (0x0B00, 0x0B7F, "or"),  # Oriya
+    (0x0B80, 0x0BFF, "ta"),  # Tamil
+    (0x0C00, 0x0C7F, "te"),  # Telugu
+    (0x0C80, 0x0CFF, "kn"),  # Kannada
+    (0x0D00, 0x0D7F, "ml"),  # Malayalam
+    (0x0600, 0x06FF, "ur"),  # Arabic (Urdu)
+]
+
+# A script joins the language set once it covers this share of the letters
+MIN_SCRIPT_SHARE = 0.05
+# Pages whose lines read this badly in the first pass are assumed to hold a
+# script the base set cannot recognize; the Latin pass says nothing about which
+# one, so they are read again with every supported language
+LOW_CONFIDENCE = 0.6
+FALLBACK_LANGS = [lang for _, _, lang in SCRIPT_BLOCKS]
+
+
+def script_of(char: str):
+    code = ord(char)
+    for start, end, lang in SCRIPT_BLOCKS:
+        if start <= code <= end:
+            return lang
+    return None
+
+
+def detect_scripts(text_lines) -> Counter:
+    """
+    Count letters per non-Latin language over recognized text lines.
+    """
+    counts = Counter()
+    for line in text_lines:
+        for char in line.text:
+            lang = script_of(char)
+            if lang:
+                counts[lang] += 1
+            elif unicodedata.category(char).startswith("L"):
+                counts["latin"] += 1
+    return counts
+
+
+def choose_langs(text_lines, base_langs: list) -> list:
+    """
+    The smallest language set for a page, from its first-pass lines.
+
+    Pages read cleanly with only Latin letters keep base_langs; any other
+    script present adds its language, and a page of low-confidence lines with
+    no recognizable script falls back to the full FALLBACK_LANGS list.
+    """
+    if not text_lines:
+        return base_langs
+
+    counts = detect_scripts(text_lines)
+    letters = sum(counts.values())
+    detected = [lang for lang, count in counts.most_common()
+                if lang != "latin" and letters and count / letters >= MIN_SCRIPT_SHARE]
+    if not detected:
+        confidence = sum(getattr(line, "confidence", 1.0) or 0.0 for line in text_lines) / len(text_lines)
+        if confidence >= LOW_CONFIDENCE:
+            return base_langs
+        detected = FALLBACK_LANGS
+    return base_langs + [lang for lang in detected if lang not in base_langs]
+
+
+class LanguageStats:
+    """
+    Per language set: pages, recognition time and mean recognizer line
+    confidence. This is not accuracy; there is no ground truth to measure it.
+    """
+
+    def __init__(self):
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def record(self, langs, seconds: float, predictions):
+        key = "+".join(langs)
+        lines = [line for prediction in predictions for line in prediction.text_lines]
+        with self._lock:
+            entry = self._stats.setdefault(key, {"pages": 0, "seconds": 0.0, "lines": 0, "confidence_sum": 0.0})
+            entry["pages"] += len(predictions)
+            entry["seconds"] += seconds
+            entry["lines"] += len(lines)
+            entry["confidence_sum"] += sum(getattr(line, "confidence", 0.0) or 0.0 for line in lines)
+
+    def summary(self) -> dict:
+        with self._lock:
+            return {
+                key: {
+                    "pages": entry["pages"],
+                    "seconds_per_page": entry["seconds"] / entry["pages"] if entry["pages"] else None,
+                    "mean_confidence": entry["confidence_sum"] / entry["lines"] if entry["lines"] else None,
+                }
+                for key, entry in self._stats.items()
+            }
+
+
+language_stats = LanguageStats()
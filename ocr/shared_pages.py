@@ -0,0 +1,63 @@
+import contextlib
+import logging
+from multiprocessing import resource_tracker, shared_memory
+
+from PIL import Image
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Bytes per pixel. PIL maps RGBX and L buffers in place; RGB would be copied
+MODES = {"RGBX": 4, "L": 1}
+
+
+def attach(name: str):
+    """
+    Open an existing segment without taking ownership: the orchestrator
+    unlinks it once every reader is done.
+    """
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Before Python 3.13 attaching registers the segment with this
+        # process's resource tracker, which would unlink it at exit
+        segment = shared_memory.SharedMemory(name=name)
+        resource_tracker.unregister(segment._name, "shared_memory")
+        return segment
+
+
+def page_image(segment, handle: dict):
+    """
+    A PIL image over the segment's memory, no copy is made.
+    """
+    mode = handle.get("mode", "RGBX")
+    width, height = handle["size"]
+    if mode not in MODES or width <= 0 or height <= 0 or width * height * MODES[mode] > segment.size:
+        raise ValueError(f"Page handle does not match segment {handle.get('name')}")
+    return Image.frombuffer(mode, (width, height), segment.buf, "raw", mode, 0, 1)
+
+
+@contextlib.contextmanager
+def shared_page_images(handles: list):
+    """
+    Attach the segments behind the page handles and yield their images.
+
+    Raises:
+        FileNotFoundError: A segment does not exist on this host.
+        ValueError: A handle is malformed.
+    """
+    segments, images = [], []
+    try:
+        for handle in handles:
+            segment = attach(handle["name"])
+            segments.append(segment)
+            images.append(page_image(segment, handle))
+        yield images
+    finally:
+        images.clear()
+        for segment in segments:
+            try:
+                segment.close()
+            except BufferError:
+                # An image still maps the buffer; the mapping goes with it
+                logger.warning(f"Segment {segment.name} still in use, left to the garbage collector")
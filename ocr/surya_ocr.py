@@ -2,11 +2,15 @@ import os
 import time
 import logging
 from PIL import Image
-from surya.ocr import run_ocr
+from surya.ocr import run_ocr, run_recognition
 from surya.model.detection.model import load_model as load_det_model, load_processor as load_det_processor
 from surya.model.recognition.model import load_model as load_rec_model
 from surya.model.recognition.processor import load_processor as load_rec_processor
 import torch
+from script_detect import choose_langs, language_stats
+from templates import find_template, template_stats
+from profiling import profiler
+from tracing import span
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -15,7 +19,7 @@ logger = logging.getLogger(__name__)
 # Configuration
 detection_batch_size = 30
 recognition_batch_size = 30
-langs = ["en"]  # Supported languages
+langs = ["en"]  # Base language set, extended per page by script detection
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
 if not torch.cuda.is_available():
@@ -40,50 +44,218 @@ def load_models_once():
         rec_model.to(device)
         logger.info("Models loaded successfully.")
 
-def process_image(image, langs, det_model, det_processor, rec_model, rec_processor):
+def process_images(images):
     """
-    Run OCR on the provided image.
+    Run OCR on a batch of images with the smallest language set per page.
+
+    Every page is first recognized with the base languages. Pages whose lines
+    show another script, or read with low confidence, are recognized again
+    with the detected languages over the boxes already found, so detection
+    never runs twice and English-only pages cost what they always did.
+
+    Returns:
+        tuple: The predictions and the language set used for each page.
     """
-    predictions = run_ocr(
-        [image],
-        [langs],
-        det_model,
-        det_processor,
-        rec_model,
-        rec_processor,
-        detection_batch_size=detection_batch_size,
-        recognition_batch_size=recognition_batch_size,
-    )
-    return predictions
+    start_time = time.time()
+    with span("run_ocr", pages=len(images)), profiler.torch_section("run_ocr"):
+        predictions = run_ocr(
+            images,
+            [langs] * len(images),
+            det_model,
+            det_processor,
+            rec_model,
+            rec_processor,
+            detection_batch_size=detection_batch_size,
+            recognition_batch_size=recognition_batch_size,
+        )
+    language_stats.record(langs, time.time() - start_time, predictions)
+
+    page_langs = [choose_langs(prediction.text_lines, langs) for prediction in predictions]
+    reruns = {}
+    for index, chosen in enumerate(page_langs):
+        if chosen != langs:
+            reruns.setdefault(tuple(chosen), []).append(index)
+
+    for chosen, indices in reruns.items():
+        start_time = time.time()
+        with span("run_recognition", pages=len(indices), langs=list(chosen)), profiler.torch_section("run_recognition"):
+            results = run_recognition(
+                [images[i] for i in indices],
+                [list(chosen)] * len(indices),
+                rec_model,
+                rec_processor,
+                bboxes=[[line.bbox for line in predictions[i].text_lines] for i in indices],
+                batch_size=recognition_batch_size,
+            )
+        language_stats.record(chosen, time.time() - start_time, results)
+        logger.info("Re-recognized %d pages with %s", len(indices), list(chosen))
+        for i, result in zip(indices, results):
+            predictions[i] = result
 
-def extract_text_from_image(file_path):
+    return predictions, page_langs
+
+def load_image(file_path):
     """
-    Extract text from an image file.
+    Open an image file and downsize it for OCR.
     """
     if not os.path.exists(file_path):
         raise FileNotFoundError(f"File not found: {file_path}")
     
     try:
         # Open and resize the image
-        image = Image.open(file_path)
-        image.thumbnail((1024, 1024), Image.LANCZOS)  # Use LANCZOS for high-quality downsizing
+        image = prepare_image(Image.open(file_path))
     except Exception as e:
         raise ValueError("Invalid image file.")
+    return image
+
+def prepare_image(image):
+    """
+    Downsize an already decoded page in place for OCR.
+    """
+    image.thumbnail((1024, 1024), Image.LANCZOS)  # Use LANCZOS for high-quality downsizing
+    if image.mode == "RGBX":
+        # Shared-memory pages are padded to four bytes per pixel
+        image = image.convert("RGB")
+    return image
+
+def structured_lines(text_lines, offset=(0, 0), region=None):
+    """
+    Text lines as plain dicts with page coordinates; offset is the top-left
+    corner of the crop the lines were read from.
+    """
+    dx, dy = offset
+    lines = []
+    for line in text_lines:
+        x0, y0, x1, y1 = line.bbox
+        entry = {
+            "text": line.text,
+            "bbox": [round(x0 + dx, 1), round(y0 + dy, 1), round(x1 + dx, 1), round(y1 + dy, 1)],
+            "confidence": round(float(line.confidence or 0.0), 4),
+        }
+        if region:
+            entry["region"] = region
+        lines.append(entry)
+    return lines
+
+def process_template_regions(images, templates):
+    """
+    Recognize only the regions named by each page's layout template, all
+    pages' crops in one batch.
+
+    Returns:
+        list: Per page, the structured lines of its field regions, or None
+            when the page has no template or its anchor phrases were not read.
+    """
+    crops, owners = [], []
+    for index, (image, template) in enumerate(zip(images, templates)):
+        if template is None:
+            continue
+        for region_name, region in template.regions().items():
+            box = template.box(image, region)
+            crops.append(image.crop(box))
+            owners.append((index, region_name, box[:2]))
+
+    pages = [None] * len(images)
+    if not crops:
+        return pages
+
+    predictions, _ = process_images(crops)
+    regions = {}
+    for (index, region_name, offset), prediction in zip(owners, predictions):
+        regions.setdefault(index, {})[region_name] = structured_lines(prediction.text_lines, offset, region_name)
+
+    for index, page_regions in regions.items():
+        template = templates[index]
+        anchor_lines = page_regions.pop("_anchor", [])
+        anchor_text = " ".join(line["text"] for line in anchor_lines)
+        if template.anchored(anchor_text) and all(any(line["text"].strip() for line in lines) for lines in page_regions.values()):
+            template_stats.record(template.name, "hits")
+            pages[index] = [line for lines in page_regions.values() for line in lines]
+        else:
+            template_stats.record(template.name, "fallbacks")
+    return pages
+
+def recognize_pages(images, document_types):
+    """
+    OCR pages, cropping to template regions for known fixed layouts and
+    falling back to the full page everywhere else. document_types holds the
+    prompt_schema document type of each page, or None when unknown.
+
+    Each result carries the page text and its lines with bounding box,
+    confidence and page number (1-based within the request).
+    """
+    templates = [find_template(document_type, image) for image, document_type in zip(images, document_types)]
+    with span("template_regions", pages=sum(template is not None for template in templates)):
+        pages = process_template_regions(images, templates)
+    page_langs = [None] * len(images)
+
+    full_pages = [index for index, lines in enumerate(pages) if lines is None]
+    if full_pages:
+        predictions, chosen = process_images([images[index] for index in full_pages])
+        for index, prediction, langs_used in zip(full_pages, predictions, chosen):
+            pages[index] = structured_lines(prediction.text_lines)
+            page_langs[index] = langs_used
+
+    results = []
+    for index, (lines, langs_used, template) in enumerate(zip(pages, page_langs, templates)):
+        for line in lines:
+            line["page"] = index + 1
+        if index in full_pages:
+            text = " ".join(line["text"] for line in lines)
+        else:
+            # Template pages: one labelled line per field region
+            by_region = {}
+            for line in lines:
+                by_region.setdefault(line["region"], []).append(line["text"])
+            text = "\n".join(f"{name}: {' '.join(texts)}" for name, texts in by_region.items())
+        results.append({
+            "extracted_text": text,
+            "lines": lines,
+            "langs": langs_used,
+            "template": template.name if index not in full_pages else None,
+        })
+    return results
+
+def extract_text_from_images(file_paths, document_types=None):
+    """
+    Extract text from several image files with a single batched OCR run.
+    Decoded PIL images may stand in for file paths, as when the orchestrator
+    runs this engine in-process.
+    """
+    document_types = document_types or [None] * len(file_paths)
+    with span("load_image", pages=len(file_paths)):
+        images = [prepare_image(page) if isinstance(page, Image.Image) else load_image(page) for page in file_paths]
+
+    load_models_once()
+
+    start_time = time.time()
+    results = recognize_pages(images, document_types)
+    execution_time = time.time() - start_time
+    logger.info("Batch of %d pages, execution time: %.2f seconds", len(images), execution_time)
+
+    for result in results:
+        result["execution_time"] = execution_time / len(images)
+    return results
+
+def extract_text_from_image(file_path, document_type=None):
+    """
+    Extract text from an image file.
+    """
+    with span("load_image", pages=1):
+        image = load_image(file_path)
     
     # Load models
     load_models_once()
 
     # Perform OCR
     start_time = time.time()
-    predictions = process_image(image, langs, det_model, det_processor, rec_model, rec_processor)
+    result = recognize_pages([image], [document_type])[0]
     execution_time = time.time() - start_time
     logger.info("Execution time: %.2f seconds", execution_time)
 
-    # Extract text from predictions
-    ans = " ".join([each.text for each in predictions[0].text_lines])
-
-    logger.info("Extracted text:\n%s", ans)
-    return {"extracted_text": ans, "execution_time": execution_time}
+    logger.info("Extracted text:\n%s", result["extracted_text"])
+    result["execution_time"] = execution_time
+    return result
 
 if __name__ == "__main__":
     sample_file_path = "/path/to/your/sample/image.jpg"
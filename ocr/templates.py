@@ -0,0 +1,105 @@
+import logging
+import threading
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class LayoutTemplate:
+    """
+    A fixed document layout: the page aspect ratios it occurs at, key phrases
+    that must be read inside its anchor region, and the field regions to
+    recognize. Regions are (left, top, right, bottom) fractions of the page.
+    """
+
+    def __init__(self, name: str, aspect_range: tuple, anchors: list, anchor_region: tuple, fields: dict):
+        self.name = name
+        self.aspect_range = aspect_range
+        self.anchors = [anchor.casefold() for anchor in anchors]
+        self.anchor_region = anchor_region
+        self.fields = fields
+
+    def matches_aspect(self, image) -> bool:
+        width, height = image.size
+        return self.aspect_range[0] <= width / height <= self.aspect_range[1]
+
+    def regions(self) -> dict:
+        return {"_anchor": self.anchor_region, **self.fields}
+
+    def box(self, image, region: tuple) -> tuple:
+        width, height = image.size
+        left, top, right, bottom = region
+        return int(left * width), int(top * height), int(right * width), int(bottom * height)
+
+    def crop(self, image, region: tuple):
+        return image.crop(self.box(image, region))
+
+    def anchored(self, text: str) -> bool:
+        text = text.casefold()
+        return any(anchor in text for anchor in self.anchors)
+
+
+# Layouts of the highest-volume documents, keyed by prompt_schema document
+# type. Regions are generous so small scan offsets still fall inside; any
+# page that fails the aspect or anchor check is OCR'd in full.
+TEMPLATES = {
+    "aadhaar": [
+        LayoutTemplate(
+            "aadhaar_card",
+            aspect_range=(1.45, 1.75),
+            anchors=["government of india", "भारत सरकार", "aadhaar", "आधार"],
+            anchor_region=(0.0, 0.0, 1.0, 0.25),
+            fields={
+                "details": (0.25, 0.2, 1.0, 0.75),
+                "aadhaar_number": (0.1, 0.7, 0.9, 0.95),
+            },
+        ),
+        LayoutTemplate(
+            "e_aadhaar_letter",
+            aspect_range=(0.65, 0.77),
+            anchors=["unique identification authority", "aadhaar", "आधार"],
+            anchor_region=(0.0, 0.0, 1.0, 0.15),
+            fields={
+                "address": (0.0, 0.1, 1.0, 0.45),
+                "card": (0.0, 0.6, 1.0, 1.0),
+            },
+        ),
+    ],
+    "gate_score_card": [
+        LayoutTemplate(
+            "gate_scorecard",
+            aspect_range=(0.65, 0.77),
+            anchors=["gate", "graduate aptitude test"],
+            anchor_region=(0.0, 0.0, 1.0, 0.15),
+            fields={
+                "candidate": (0.0, 0.12, 1.0, 0.45),
+                "scores": (0.0, 0.4, 1.0, 0.75),
+            },
+        ),
+    ],
+}
+
+
+def find_template(document_type: str, image):
+    for template in TEMPLATES.get(document_type or "", []):
+        if template.matches_aspect(image):
+            return template
+    return None
+
+
+class TemplateStats:
+    def __init__(self):
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def record(self, name: str, outcome: str):
+        with self._lock:
+            entry = self._counts.setdefault(name, {"hits": 0, "fallbacks": 0})
+            entry[outcome] += 1
+
+    def summary(self) -> dict:
+        with self._lock:
+            return {name: dict(entry) for name, entry in self._counts.items()}
+
+
+template_stats = TemplateStats()
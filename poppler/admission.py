@@ -0,0 +1,140 @@
+import asyncio
+import contextvars
+import heapq
+import itertools
+import math
+import os
+import time
+from contextlib import asynccontextmanager
+
+from tracing import span
+
+# Priority classes, lower runs first. Submission-time checks alert the
+# applicant immediately; bulk screening re-verification can wait.
+INTERACTIVE = 0
+BULK = 1
+
+# Priority of the work running in the current task, read by the stage limits
+current_priority = contextvars.ContextVar("current_priority", default=INTERACTIVE)
+
+STAGE_LIMITS = {
+    "rasterize": int(os.getenv("RASTERIZE_CONCURRENCY", "2")),
+    "ocr": int(os.getenv("OCR_CONCURRENCY", "4")),
+    "llm": int(os.getenv("LLM_CONCURRENCY", "2")),
+}
+MAX_IN_FLIGHT = int(os.getenv("MAX_IN_FLIGHT_UPLOADS", "8"))
+MAX_QUEUE = int(os.getenv("MAX_QUEUED_UPLOADS", "16"))
+
+
+class Overloaded(Exception):
+    def __init__(self, retry_after: int):
+        super().__init__(f"Queue is full, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+class PriorityLimiter:
+    """
+    Concurrency limit whose waiters are served by priority, then in arrival
+    order. A released slot is handed directly to the next waiter.
+    """
+
+    def __init__(self, name: str, limit: int):
+        self.name = name
+        self.limit = limit
+        self.active = 0
+        self._waiters = []
+        self._sequence = itertools.count()
+
+    @property
+    def waiting(self) -> int:
+        return sum(1 for _, _, future in self._waiters if not future.done())
+
+    async def acquire(self, priority: int = INTERACTIVE):
+        if self.active < self.limit and not self.waiting:
+            self.active += 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._sequence), future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            # The slot may have been handed over just before the cancellation
+            if future.done() and not future.cancelled():
+                self.release()
+            raise
+
+    def release(self):
+        while self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                future.set_result(None)
+                return
+        self.active -= 1
+
+    @asynccontextmanager
+    async def slot(self, priority: int = None):
+        with span(f"queue.{self.name}"):
+            await self.acquire(current_priority.get() if priority is None else priority)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def stats(self) -> dict:
+        return {"limit": self.limit, "active": self.active, "waiting": self.waiting}
+
+
+class AdmissionController:
+    """
+    Admits uploads up to max_in_flight at once with at most max_queue waiting.
+    Past that, requests fail fast with a Retry-After estimate instead of
+    piling up until everything times out together.
+    """
+
+    def __init__(self, max_in_flight: int = MAX_IN_FLIGHT, max_queue: int = MAX_QUEUE):
+        self.limiter = PriorityLimiter("admission", max_in_flight)
+        self.max_queue = max_queue
+        self.rejected = 0
+        # Moving average of the time an admitted request holds its slot
+        self.service_time = 3.0
+
+    def retry_after(self) -> int:
+        backlog = self.limiter.waiting + self.limiter.active
+        return max(1, math.ceil(backlog * self.service_time / self.limiter.limit))
+
+    @asynccontextmanager
+    async def admit(self, priority: int = INTERACTIVE):
+        if self.limiter.waiting >= self.max_queue:
+            self.rejected += 1
+            raise Overloaded(self.retry_after())
+
+        token = current_priority.set(priority)
+        try:
+            async with self.limiter.slot(priority):
+                start_time = time.perf_counter()
+                try:
+                    yield
+                finally:
+                    elapsed = time.perf_counter() - start_time
+                    self.service_time = 0.8 * self.service_time + 0.2 * elapsed
+        finally:
+            current_priority.reset(token)
+
+    def stats(self) -> dict:
+        return {
+            **self.limiter.stats(),
+            "max_queue": self.max_queue,
+            "rejected": self.rejected,
+            "service_time_seconds": round(self.service_time, 3),
+        }
+
+
+admission = AdmissionController()
+stage_limits = {stage: PriorityLimiter(stage, limit) for stage, limit in STAGE_LIMITS.items()}
+
+
+def stage_slot(stage: str):
+    """
+    Hold one of the stage's slots at the current task's priority.
+    """
+    return stage_limits[stage].slot()
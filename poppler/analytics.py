@@ -0,0 +1,205 @@
+import bisect
+import datetime
+import logging
+import os
+import traceback
+
+from pymongo import ASCENDING
+
+from mongodb_config import verification_results_collection, verification_stats_collection, error_logs_collection
+from tracing import current_trace_id
+from write_behind import write_behind
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Upper bounds (ms) of the latency histogram buckets; the last bucket is open
+LATENCY_BUCKETS_MS = [50, 100, 200, 350, 500, 750, 1000, 1500, 2000, 3000, 5000, 7500, 10000, 15000, 20000, 30000, 60000]
+
+PERCENTILES = (50, 90, 99)
+
+# Error log entries are dropped after this many days
+ERROR_LOG_TTL_DAYS = int(os.getenv("ERROR_LOG_TTL_DAYS", "30"))
+
+
+def ensure_analytics_indexes():
+    verification_results_collection.create_index(
+        [("application_id", ASCENDING), ("user_id", ASCENDING), ("createdAt", ASCENDING)],
+        name="verification_owner",
+    )
+    verification_stats_collection.create_index([("kind", ASCENDING), ("hour", ASCENDING)], name="stats_kind")
+    error_logs_collection.create_index("createdAt", expireAfterSeconds=ERROR_LOG_TTL_DAYS * 24 * 3600, name="error_log_ttl")
+    error_logs_collection.create_index("trace_id", name="error_log_trace")
+
+
+def latency_bucket(milliseconds: float) -> int:
+    return bisect.bisect_left(LATENCY_BUCKETS_MS, milliseconds)
+
+
+def counter_updates(document_type: str, status: str, comparison: dict, timings: dict, cache_hit, now: datetime.datetime) -> list:
+    """
+    The counter increments for one finished upload, as (filter, update)
+    upserts. Every counter document has a fixed key, so dashboards read a
+    bounded number of documents.
+    """
+    hour = now.replace(minute=0, second=0, microsecond=0)
+    updates = [(
+        {"_id": f"document_type:{document_type}"},
+        {"$inc": {"total": 1, status: 1}, "$set": {"kind": "document_type", "document_type": document_type}},
+    )]
+
+    if comparison:
+        mismatched = {mismatch["field"] for mismatch in comparison.get("mismatches", [])}
+        for field in comparison.get("checked", []):
+            updates.append((
+                {"_id": f"field:{document_type}:{field}"},
+                {
+                    "$inc": {"checked": 1, "mismatched": int(field in mismatched)},
+                    "$set": {"kind": "field", "document_type": document_type, "field": field},
+                },
+            ))
+
+    for stage, seconds in (timings or {}).items():
+        milliseconds = seconds * 1000
+        updates.append((
+            {"_id": f"latency:{stage}:{hour.isoformat()}"},
+            {
+                "$inc": {"count": 1, "sum_ms": milliseconds, f"buckets.{latency_bucket(milliseconds)}": 1},
+                "$set": {"kind": "latency", "stage": stage, "hour": hour},
+            },
+        ))
+
+    if cache_hit is not None:
+        updates.append((
+            {"_id": "cache:extraction"},
+            {"$inc": {"hits" if cache_hit else "misses": 1}, "$set": {"kind": "cache", "cache": "extraction"}},
+        ))
+    return updates
+
+
+def record_verification(document_type: str, user_id: str, application_id: str, status: str,
+                        comparison: dict = None, timings: dict = None, cache_hit=None):
+    """
+    Store one upload's verification result and update the dashboard counters,
+    through the write-behind buffer: this only enqueues the writes.
+
+    Args:
+        status (str): "matched", "mismatched" or "error".
+        comparison (dict): DocumentValidator result, if the comparison ran.
+        timings (dict): Seconds spent per pipeline stage.
+        cache_hit (bool): Whether a stored extraction was reused, None if unknown.
+    """
+    now = datetime.datetime.now(datetime.timezone.utc)
+    write_behind.insert(verification_results_collection.name, {
+        "document_type": document_type,
+        "user_id": user_id,
+        "application_id": application_id,
+        "status": status,
+        "mismatches": (comparison or {}).get("mismatches", []),
+        "timings": timings or {},
+        "cache_hit": cache_hit,
+        "createdAt": now,
+    })
+    for filter, update in counter_updates(document_type, status, comparison, timings, cache_hit, now):
+        write_behind.upsert(verification_stats_collection.name, filter, update)
+
+
+class ErrorLogHandler(logging.Handler):
+    """
+    Copies error log records into error_logs through the write-behind
+    buffer, with the trace id so an entry leads to the request's spans.
+    """
+
+    def __init__(self):
+        super().__init__(logging.ERROR)
+
+    def emit(self, record: logging.LogRecord):
+        # The buffer's own complaints would only feed back into it
+        if record.name == "write_behind":
+            return
+        try:
+            entry = {
+                "level": record.levelname,
+                "logger": record.name,
+                "message": record.getMessage()[:2000],
+                "trace_id": current_trace_id(),
+                "createdAt": datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc),
+            }
+            if record.exc_info:
+                entry["exception"] = "".join(traceback.format_exception(*record.exc_info))[-4000:]
+            write_behind.insert(error_logs_collection.name, entry)
+        except Exception:
+            self.handleError(record)
+
+
+def histogram_percentiles(buckets: dict, count: int) -> dict:
+    """
+    Percentiles from a latency histogram, as the upper bound of the bucket
+    holding each rank (None for the open last bucket).
+    """
+    percentiles = {}
+    if not count:
+        return percentiles
+    counts = [int(buckets.get(str(i), 0)) for i in range(len(LATENCY_BUCKETS_MS) + 1)]
+    for percentile in PERCENTILES:
+        rank = count * percentile / 100
+        seen = 0
+        for index, bucket_count in enumerate(counts):
+            seen += bucket_count
+            if seen >= rank:
+                percentiles[f"p{percentile}_ms"] = LATENCY_BUCKETS_MS[index] if index < len(LATENCY_BUCKETS_MS) else None
+                break
+    return percentiles
+
+
+def document_type_stats() -> list:
+    stats = []
+    for entry in verification_stats_collection.find({"kind": "document_type"}, {"_id": 0, "kind": 0}):
+        total = entry.get("total", 0)
+        entry["pass_rate"] = entry.get("matched", 0) / total if total else None
+        entry["mismatch_rate"] = entry.get("mismatched", 0) / total if total else None
+        stats.append(entry)
+    return stats
+
+
+def field_stats(document_type: str = None) -> list:
+    query = {"kind": "field"}
+    if document_type:
+        query["document_type"] = document_type
+    stats = []
+    for entry in verification_stats_collection.find(query, {"_id": 0, "kind": 0}):
+        checked = entry.get("checked", 0)
+        entry["mismatch_rate"] = entry.get("mismatched", 0) / checked if checked else None
+        stats.append(entry)
+    return stats
+
+
+def latency_stats(hours: int = 24) -> list:
+    since = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(hours=hours)
+    stats = []
+    cursor = verification_stats_collection.find({"kind": "latency", "hour": {"$gte": since}}, {"_id": 0}).sort("hour", ASCENDING)
+    for entry in cursor:
+        count = entry.get("count", 0)
+        stats.append({
+            "stage": entry["stage"],
+            "hour": entry["hour"].isoformat(),
+            "count": count,
+            "mean_ms": entry.get("sum_ms", 0) / count if count else None,
+            **histogram_percentiles(entry.get("buckets", {}), count),
+        })
+    return stats
+
+
+def cache_stats(*memory_caches) -> dict:
+    """
+    Hit rates of the stored-extraction cache and of in-process TTL caches,
+    passed as (name, cache) pairs.
+    """
+    stats = {}
+    for entry in verification_stats_collection.find({"kind": "cache"}, {"_id": 0}):
+        hits, misses = entry.get("hits", 0), entry.get("misses", 0)
+        stats[entry["cache"]] = {"hits": hits, "misses": misses, "hit_rate": hits / (hits + misses) if hits + misses else None}
+    for name, cache in memory_caches:
+        total = cache.hits + cache.misses
+        stats[name] = {"hits": cache.hits, "misses": cache.misses, "hit_rate": cache.hits / total if total else None}
+    return stats
@@ -0,0 +1,506 @@
+import asyncio
+import importlib
+import io
+import logging
+import os
+import random
+import sys
+import threading
+import time
+
+import aiofiles
+import httpx
+from fastapi import HTTPException
+
+from tracing import span, inject
+from shared_pages import shared_pages, use_shared_memory
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# "http" sends pages and prompts to the OCR and LLM services, "embedded"
+# runs that engine inside this process (single-node sites)
+OCR_BACKEND = os.getenv("OCR_BACKEND", "http")
+LLM_BACKEND = os.getenv("LLM_BACKEND", "http")
+
+# Comma separated host:port lists of the GPU services
+OCR_REPLICAS = os.getenv("OCR_REPLICAS", "localhost:8001")
+LLM_REPLICAS = os.getenv("LLM_REPLICAS", "localhost:8002")
+
+# Source directories of the embedded engines. They are appended to sys.path,
+# so this service's own tracing and profiling modules serve both engines.
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+EMBEDDED_PATHS = os.getenv("EMBEDDED_PATHS", f"{os.path.join(_ROOT, 'ocr')},{os.path.join(_ROOT, 'llm')}")
+
+# Circuit breaker: consecutive failures that eject a replica, and how long
+# it stays ejected before a health check may bring it back
+FAILURE_THRESHOLD = 3
+EJECTION_SECONDS = 15.0
+HEALTH_CHECK_INTERVAL = 5.0
+
+# Retries and hedges may add at most this fraction of extra requests
+RETRY_BUDGET_RATIO = 0.1
+HEDGE_BUDGET_RATIO = 0.05
+MAX_ATTEMPTS = 3
+
+# Hedge a request still running after this percentile of recent latencies
+HEDGE_PERCENTILE = 0.95
+HEDGE_MIN_DELAY = 0.5
+LATENCY_WINDOW = 200
+
+
+def shed_load(response: httpx.Response) -> bool:
+    """
+    A replica turning work away on purpose: a 504 for a request past its
+    deadline, or a 503 with Retry-After from admission control. The replica
+    is healthy and a retry would only add load, so neither counts as a
+    failure nor is retried.
+    """
+    return response.status_code == 504 or (response.status_code == 503 and "retry-after" in response.headers)
+
+
+class Budget:
+    """
+    Token bucket filled by a fraction of every request; each retry or hedge
+    spends a whole token, so extra traffic stays proportional to real load.
+    """
+
+    def __init__(self, ratio: float, capacity: float = 10.0):
+        self.ratio = ratio
+        self.capacity = capacity
+        self.tokens = capacity
+
+    def deposit(self):
+        self.tokens = min(self.capacity, self.tokens + self.ratio)
+
+    def withdraw(self) -> bool:
+        if self.tokens >= 1.0:
+            self.tokens -= 1.0
+            return True
+        return False
+
+
+class Replica:
+    def __init__(self, address: str):
+        self.base_url = f"http://{address}"
+        self.outstanding = 0
+        self.failures = 0
+        self.ejected_until = 0.0
+
+    @property
+    def healthy(self) -> bool:
+        return self.ejected_until <= time.monotonic()
+
+    def record_success(self):
+        self.failures = 0
+        self.ejected_until = 0.0
+
+    def record_failure(self):
+        self.failures += 1
+        if self.failures >= FAILURE_THRESHOLD:
+            if self.healthy:
+                logger.warning(f"Ejecting {self.base_url} after {self.failures} consecutive failures")
+            self.ejected_until = time.monotonic() + EJECTION_SECONDS
+
+    def stats(self) -> dict:
+        return {"url": self.base_url, "outstanding": self.outstanding, "failures": self.failures, "healthy": self.healthy}
+
+
+class ReplicaPool:
+    """
+    Client for a replicated backend: least-outstanding-requests balancing,
+    circuit breaking per replica, budgeted retries and optional hedging.
+    """
+
+    def __init__(self, name: str, addresses: str, timeout: float = 30.0):
+        self.name = name
+        self.replicas = [Replica(address.strip()) for address in addresses.split(",") if address.strip()]
+        self.timeout = timeout
+        self.retry_budget = Budget(RETRY_BUDGET_RATIO)
+        self.hedge_budget = Budget(HEDGE_BUDGET_RATIO)
+        self.latencies = []
+        self.hedges = 0
+        self.retries = 0
+        self._client = None
+        self._health_task = None
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        # Created lazily so the pool binds to the running event loop
+        if self._client is None:
+            self._client = httpx.AsyncClient(timeout=self.timeout)
+            self._health_task = asyncio.create_task(self._health_checks())
+        return self._client
+
+    def pick(self, exclude=()) -> Replica:
+        candidates = [r for r in self.replicas if r.healthy and r not in exclude]
+        if not candidates:
+            # Every replica is ejected: try the one that is due back first
+            candidates = sorted((r for r in self.replicas if r not in exclude), key=lambda r: r.ejected_until)[:1]
+        if not candidates:
+            raise httpx.ConnectError(f"No {self.name} replica available")
+        fewest = min(r.outstanding for r in candidates)
+        return random.choice([r for r in candidates if r.outstanding == fewest])
+
+    def hedge_delay(self) -> float:
+        if len(self.latencies) < 20:
+            return max(HEDGE_MIN_DELAY, self.timeout / 4)
+        ordered = sorted(self.latencies)
+        return max(HEDGE_MIN_DELAY, ordered[int(len(ordered) * HEDGE_PERCENTILE)])
+
+    async def _send(self, replica: Replica, path: str, timeout=None, headers=None, segments=(), **kwargs) -> httpx.Response:
+        # Each attempt holds its own reference to the shared pages it carries
+        for name in segments:
+            shared_pages.retain(name)
+        replica.outstanding += 1
+        start_time = time.perf_counter()
+        try:
+            # One span per attempt, so retries and hedges show on the trace
+            with span(f"{self.name} POST {path}", replica=replica.base_url) as current:
+                response = await self.client.post(
+                    replica.base_url + path, timeout=timeout or self.timeout, headers=inject(headers), **kwargs
+                )
+                current.set(status_code=response.status_code)
+            if response.status_code >= 500:
+                # Shed load comes from a healthy replica
+                if not shed_load(response):
+                    replica.record_failure()
+            else:
+                replica.record_success()
+                self.latencies.append(time.perf_counter() - start_time)
+                del self.latencies[:-LATENCY_WINDOW]
+            response.raise_for_status()
+            return response
+        except (httpx.TransportError, httpx.TimeoutException):
+            replica.record_failure()
+            raise
+        finally:
+            replica.outstanding -= 1
+            for name in segments:
+                shared_pages.release(name)
+
+    async def _hedged(self, path: str, tried: list, **kwargs) -> httpx.Response:
+        """
+        Send to one replica and, if it is slow, to a second one; both skip
+        the replicas in tried, which receives the replicas used.
+        """
+        first = self.pick(exclude=tried)
+        tried.append(first)
+        primary = asyncio.create_task(self._send(first, path, **kwargs))
+        done, _ = await asyncio.wait({primary}, timeout=self.hedge_delay())
+        spare = [replica for replica in self.replicas if replica not in tried]
+        if done or not spare or not self.hedge_budget.withdraw():
+            return await primary
+
+        self.hedges += 1
+        second = self.pick(exclude=tried)
+        tried.append(second)
+        backup = asyncio.create_task(self._send(second, path, **kwargs))
+        pending = {primary, backup}
+        error = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    for other in pending:
+                        other.cancel()
+                    return task.result()
+                error = task.exception()
+        raise error
+
+    async def post(self, path: str, hedge: bool = False, **kwargs) -> httpx.Response:
+        """
+        POST to the least loaded healthy replica. Connection errors and 5xx
+        responses are retried on another replica while the retry budget lasts;
+        4xx responses and shed load (see shed_load) are returned to the
+        caller as errors immediately.
+        segments names the shared-memory pages the request carries, which
+        every attempt retains until it finishes.
+        """
+        self.retry_budget.deposit()
+        self.hedge_budget.deposit()
+        tried = []
+        for attempt in range(MAX_ATTEMPTS):
+            try:
+                if hedge:
+                    return await self._hedged(path, tried, **kwargs)
+                replica = self.pick(exclude=tried)
+                tried.append(replica)
+                return await self._send(replica, path, **kwargs)
+            except httpx.HTTPStatusError as e:
+                if (e.response.status_code < 500 or shed_load(e.response) or attempt == MAX_ATTEMPTS - 1
+                        or not self.retry_budget.withdraw()):
+                    raise
+            except (httpx.TransportError, httpx.TimeoutException):
+                if attempt == MAX_ATTEMPTS - 1 or not self.retry_budget.withdraw():
+                    raise
+            self.retries += 1
+            if len(tried) >= len(self.replicas):
+                tried = []
+
+    async def _health_checks(self):
+        while True:
+            await asyncio.sleep(HEALTH_CHECK_INTERVAL)
+            for replica in self.replicas:
+                if replica.failures < FAILURE_THRESHOLD:
+                    continue
+                try:
+                    response = await self.client.get(replica.base_url + "/health", timeout=2.0)
+                    if response.status_code == 200:
+                        logger.info(f"{replica.base_url} passed its health check, restoring")
+                        replica.record_success()
+                except httpx.HTTPError:
+                    replica.ejected_until = time.monotonic() + EJECTION_SECONDS
+
+    def stats(self) -> dict:
+        return {
+            "replicas": [replica.stats() for replica in self.replicas],
+            "retries": self.retries,
+            "hedges": self.hedges,
+            "hedge_delay_seconds": round(self.hedge_delay(), 3),
+        }
+
+
+async def _page_file(page) -> tuple:
+    """
+    A page as a multipart file: the PNG on disk, or a decoded page encoded
+    in memory.
+    """
+    if isinstance(page, str):
+        async with aiofiles.open(page, "rb") as f:
+            return os.path.basename(page), await f.read(), "image/png"
+
+    def encode():
+        buffer = io.BytesIO()
+        page.save(buffer, format="PNG")
+        return buffer.getvalue()
+
+    return "page.png", await asyncio.to_thread(encode), "image/png"
+
+
+class HTTPOCRBackend:
+    """
+    OCR through the OCR service replicas. With shared_memory set, decoded
+    pages travel as shared-memory handles; PNG bytes are the fallback.
+    """
+
+    def __init__(self, pool: ReplicaPool, shared_memory: bool = False):
+        self.pool = pool
+        self.shared_memory = shared_memory
+
+    @property
+    def decoded_pages(self) -> bool:
+        # Over shared memory pages go as raw pixels, never as PNG files
+        return self.shared_memory
+
+    async def extract_page(self, page, document_type: str = None) -> dict:
+        if self.shared_memory and not isinstance(page, str):
+            results = await self._extract_shared([page], [document_type], hedge=True)
+            if results is not None:
+                return results[0]
+        try:
+            # Single pages are idempotent, a slow replica gets a hedged twin
+            response = await self.pool.post(
+                "/extract-text",
+                hedge=True,
+                files={"file": await _page_file(page)},
+                data={"document_type": document_type} if document_type else None
+            )
+        except httpx.HTTPStatusError as e:
+            logger.error(f"API Error: {e.response.text}")
+            raise HTTPException(status_code=500, detail="Text extraction API failed")
+        except Exception as e:
+            logger.error(f"HTTP request error: {e}")
+            raise HTTPException(status_code=500, detail="Unable to connect to text extraction API")
+        return response.json()
+
+    async def extract_pages(self, pages: list, document_types: list = None) -> list:
+        if self.shared_memory and not any(isinstance(page, str) for page in pages):
+            results = await self._extract_shared(pages, document_types)
+            if results is not None:
+                return results
+        files = [("files", await _page_file(page)) for page in pages]
+        try:
+            response = await self.pool.post(
+                "/extract-text-batch",
+                files=files,
+                data={"document_types": [document_type or "" for document_type in document_types]} if document_types else None,
+                timeout=30.0 * max(1, len(files))
+            )
+        except httpx.HTTPStatusError as e:
+            logger.error(f"API Error: {e.response.text}")
+            raise HTTPException(status_code=500, detail="Text extraction API failed")
+        except Exception as e:
+            logger.error(f"HTTP request error: {e}")
+            raise HTTPException(status_code=500, detail="Unable to connect to text extraction API")
+        return response.json()["results"]
+
+    async def _extract_shared(self, pages: list, document_types: list = None, hedge: bool = False):
+        """
+        OCR pages passed through shared memory. Returns None when the OCR
+        service cannot attach the segments (it is not on this host after
+        all); shared memory is then switched off and the caller sends bytes.
+        """
+        handles = []
+        try:
+            for page in pages:
+                handles.append(await asyncio.to_thread(shared_pages.share, page))
+            response = await self.pool.post(
+                "/extract-text-shared",
+                hedge=hedge,
+                segments=[handle["name"] for handle in handles],
+                json={"pages": handles, "document_types": document_types or [None] * len(pages)},
+                timeout=30.0 * max(1, len(pages))
+            )
+        except httpx.HTTPStatusError as e:
+            if e.response.status_code == 409:
+                logger.warning("OCR service cannot attach shared memory, falling back to HTTP bytes")
+                self.shared_memory = False
+                return None
+            logger.error(f"API Error: {e.response.text}")
+            raise HTTPException(status_code=500, detail="Text extraction API failed")
+        except OSError as e:
+            # No room in /dev/shm: this request goes as bytes
+            logger.error(f"Shared memory unavailable: {e}")
+            return None
+        except Exception as e:
+            logger.error(f"HTTP request error: {e}")
+            raise HTTPException(status_code=500, detail="Unable to connect to text extraction API")
+        finally:
+            for handle in handles:
+                shared_pages.release(handle["name"])
+        return response.json()["results"]
+
+    def stats(self) -> dict:
+        return {
+            "mode": "http",
+            "transport": "shared_memory" if self.shared_memory else "bytes",
+            "shared_pages": shared_pages.stats(),
+            **self.pool.stats(),
+        }
+
+
+class HTTPLLMBackend:
+    """
+    Field extraction through the LLM service replicas.
+    """
+
+    def __init__(self, pool: ReplicaPool):
+        self.pool = pool
+
+    async def process(self, payload: dict) -> dict:
+        return await self._post("/process-data", payload, self.pool.timeout)
+
+    async def process_batch(self, payload: dict) -> dict:
+        """
+        Several documents of one type, answered in shared model calls.
+        """
+        return await self._post("/process-batch", payload, self.pool.timeout * max(1, len(payload["documents"])))
+
+    async def _post(self, path: str, payload: dict, timeout: float) -> dict:
+        try:
+            # The LLM service drops the request once this client has given up on it
+            response = await self.pool.post(
+                path, json=payload, timeout=timeout, headers={"X-Request-Timeout": str(timeout)}
+            )
+        except httpx.HTTPStatusError as e:
+            logger.error(f"API Error: {e.response.text}")
+            raise HTTPException(status_code=500, detail="Data processing API failed")
+        except Exception as e:
+            logger.error(f"HTTP request error: {e}")
+            raise HTTPException(status_code=500, detail="Unable to connect to data processing API")
+        return response.json()
+
+    def stats(self) -> dict:
+        return {"mode": "http", **self.pool.stats()}
+
+
+def _import_engine(module_name: str):
+    for path in EMBEDDED_PATHS.split(","):
+        if path and path not in sys.path:
+            sys.path.append(path)
+    return importlib.import_module(module_name)
+
+
+class EmbeddedOCRBackend:
+    """
+    OCR with the surya engine loaded in this process. Pages are handed over
+    as decoded images: no PNG encoding, multipart upload or second decode.
+    """
+
+    decoded_pages = True
+
+    def __init__(self):
+        self._engine = None
+        # One batch on the GPU at a time, as in the OCR service
+        self._lock = threading.Lock()
+        self.pages = 0
+
+    @property
+    def engine(self):
+        if self._engine is None:
+            self._engine = _import_engine("surya_ocr")
+            self._engine.load_models_once()
+        return self._engine
+
+    def _run(self, pages: list, document_types: list) -> list:
+        with self._lock:
+            return self.engine.extract_text_from_images(pages, document_types)
+
+    async def extract_page(self, page, document_type: str = None) -> dict:
+        return (await self.extract_pages([page], [document_type]))[0]
+
+    async def extract_pages(self, pages: list, document_types: list = None) -> list:
+        try:
+            results = await asyncio.to_thread(self._run, pages, document_types)
+        except Exception:
+            logger.exception("Embedded text extraction failed")
+            raise HTTPException(status_code=500, detail="Text extraction failed")
+        self.pages += len(pages)
+        return results
+
+    def stats(self) -> dict:
+        return {"mode": "embedded", "pages": self.pages}
+
+
+class EmbeddedLLMBackend:
+    """
+    Field extraction with the LLM service's extraction code in this process;
+    the payload is passed as is, without JSON encoding or a socket hop.
+    """
+
+    def __init__(self):
+        self._extraction = None
+        self.requests = 0
+
+    @property
+    def extraction(self):
+        if self._extraction is None:
+            self._extraction = _import_engine("extraction")
+        return self._extraction
+
+    async def process(self, payload: dict) -> dict:
+        self.requests += 1
+        try:
+            return await self.extraction.process_request(payload)
+        except Exception:
+            logger.exception("Embedded data processing failed")
+            raise HTTPException(status_code=500, detail="Data processing failed")
+
+    async def process_batch(self, payload: dict) -> dict:
+        self.requests += 1
+        try:
+            return await self.extraction.process_batch(payload)
+        except Exception:
+            logger.exception("Embedded data processing failed")
+            raise HTTPException(status_code=500, detail="Data processing failed")
+
+    def stats(self) -> dict:
+        return {"mode": "embedded", "requests": self.requests}
+
+
+ocr_pool = ReplicaPool("ocr", OCR_REPLICAS)
+llm_pool = ReplicaPool("llm", LLM_REPLICAS)
+
+ocr_backend = EmbeddedOCRBackend() if OCR_BACKEND == "embedded" else HTTPOCRBackend(ocr_pool, use_shared_memory(OCR_REPLICAS))
+llm_backend = EmbeddedLLMBackend() if LLM_BACKEND == "embedded" else HTTPLLMBackend(llm_pool)
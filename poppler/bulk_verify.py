@@ -0,0 +1,361 @@
+import argparse
+import asyncio
+import json
+import logging
+import collections
+import os
+import re
+import threading
+import time
+import uuid
+from pathlib import Path
+
+from mongodb_config import applications_collection
+from process_pdf import convert_pdf_to_images, extract_text_from_images, request_extraction, combine_pages
+from schemas import prompt_schema
+from validators import compile_schemas, parse_extracted, application_details
+from cache import fetch_application_details
+from admission import current_priority, BULK
+from backends import ocr_backend
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Stored documents are laid out as <root>/<application_id>/<user_id>/<document_type>.<ext>
+DOCUMENTS_DIR = os.getenv("DOCUMENTS_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "documents"))
+CHECKPOINT_DIR = os.getenv("CHECKPOINT_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "checkpoints"))
+
+SUPPORTED_EXTENSIONS = {".pdf", ".png", ".jpg", ".jpeg"}
+
+# Pipeline sizing, each stage hands over through a queue of this size
+QUEUE_SIZE = 16
+RASTERIZE_WORKERS = 2
+OCR_BATCH_SIZE = 8
+LLM_CONCURRENCY = 2
+PROGRESS_EVERY = 25
+# Applicants whose details a run keeps; documents arrive grouped by
+# application, so only a few are ever needed again
+DETAILS_CACHE_SIZE = 1024
+
+# Run ids become checkpoint file names
+RUN_ID = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+
+_DONE = object()
+
+document_validators = compile_schemas(prompt_schema)
+
+
+def _document(path: Path, application_id: str, user_id: str):
+    document_type = path.stem
+    if path.suffix.lower() not in SUPPORTED_EXTENSIONS or document_type not in prompt_schema:
+        return None
+    return {
+        "key": f"{application_id}/{user_id}/{path.name}",
+        "path": str(path),
+        "document_type": document_type,
+        "application_id": application_id,
+        "user_id": user_id,
+    }
+
+
+def iter_directory(root: str):
+    """
+    Yield every stored document below root.
+    """
+    for path in sorted(Path(root).glob("*/*/*")):
+        document = _document(path, path.parent.parent.name, path.parent.name)
+        if document:
+            yield document
+
+
+def iter_query(query: dict, root: str = DOCUMENTS_DIR):
+    """
+    Yield the stored documents of every application matching a Mongo query,
+    e.g. {"application_id": "<vacancy>"} for all applicants of a vacancy.
+    """
+    cursor = applications_collection.find(query, {"_id": 0, "user_id": 1, "application_id": 1})
+    for application in cursor:
+        folder = Path(root) / str(application["application_id"]) / str(application["user_id"])
+        if not folder.is_dir():
+            continue
+        for path in sorted(folder.iterdir()):
+            document = _document(path, str(application["application_id"]), str(application["user_id"]))
+            if document:
+                yield document
+
+
+class Checkpoint:
+    """
+    Append-only JSON-lines record of finished documents, so a crashed run
+    resumes where it stopped. Failed documents are retried on resume.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.completed = set()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # A torn last line from a crash
+                        continue
+                    if entry.get("status") != "error":
+                        self.completed.add(entry["key"])
+        self._file = open(path, "a", encoding="utf-8")
+        # Stages record from worker threads
+        self._lock = threading.Lock()
+
+    def done(self, key: str) -> bool:
+        return key in self.completed
+
+    def record(self, entry: dict):
+        with self._lock:
+            self._file.write(json.dumps(entry, default=str) + "\n")
+            self._file.flush()
+            if entry.get("status") != "error":
+                self.completed.add(entry["key"])
+
+    def close(self):
+        self._file.close()
+
+
+class BulkVerifier:
+    """
+    Re-verify stored documents through a pipeline of overlapping stages:
+    rasterize -> batched OCR -> LLM extraction -> comparison.
+    """
+
+    def __init__(self, documents, checkpoint_path: str, ocr_batch_size: int = OCR_BATCH_SIZE,
+                 llm_concurrency: int = LLM_CONCURRENCY, queue_size: int = QUEUE_SIZE):
+        self.documents = documents
+        self.checkpoint = Checkpoint(checkpoint_path)
+        self.ocr_batch_size = ocr_batch_size
+        self.llm_concurrency = llm_concurrency
+        self.queue_size = queue_size
+        self.status = "pending"
+        self.counts = {"verified": 0, "matched": 0, "mismatched": 0, "failed": 0, "skipped": 0}
+        self.started_at = None
+        self.finished_at = None
+        self._details = collections.OrderedDict()
+
+    def progress(self) -> dict:
+        elapsed = ((self.finished_at or time.time()) - self.started_at) if self.started_at else 0.0
+        finished = self.counts["verified"] + self.counts["failed"]
+        return {
+            "status": self.status,
+            **self.counts,
+            "elapsed_seconds": round(elapsed, 2),
+            "documents_per_second": round(finished / elapsed, 3) if elapsed else 0.0,
+        }
+
+    async def run(self) -> dict:
+        self.status = "running"
+        self.started_at = time.time()
+        # Stage workers inherit this, interactive uploads go first at every stage
+        current_priority.set(BULK)
+        documents, pages, texts, results = (asyncio.Queue(self.queue_size) for _ in range(4))
+
+        stages = [
+            [asyncio.create_task(self._feed(documents))],
+            [asyncio.create_task(self._rasterize(documents, pages)) for _ in range(RASTERIZE_WORKERS)],
+            [asyncio.create_task(self._ocr(pages, texts))],
+            [asyncio.create_task(self._extract(texts, results)) for _ in range(self.llm_concurrency)],
+            [asyncio.create_task(self._compare(results))],
+        ]
+        outputs = [documents, pages, texts, results, None]
+        consumers = [len(stage) for stage in stages[1:]] + [0]
+
+        try:
+            # When every worker of a stage has drained, end the next stage
+            for workers, output, count in zip(stages, outputs, consumers):
+                await asyncio.gather(*workers)
+                for _ in range(count):
+                    await output.put(_DONE)
+            self.status = "completed"
+        except Exception:
+            self.status = "failed"
+            logger.exception("Bulk verification aborted")
+            for stage in stages:
+                for task in stage:
+                    task.cancel()
+            raise
+        finally:
+            self.finished_at = time.time()
+            self.checkpoint.close()
+            logger.info(f"Bulk verification {self.status}: {self.progress()}")
+        return self.progress()
+
+    async def _feed(self, output: asyncio.Queue):
+        # Advanced in a thread: the source is a Mongo cursor or a directory
+        # walk, whose next batch would otherwise block the API server's loop
+        documents = iter(self.documents)
+        while (document := await asyncio.to_thread(next, documents, None)) is not None:
+            if self.checkpoint.done(document["key"]):
+                self.counts["skipped"] += 1
+                continue
+            await output.put(document)
+
+    async def _rasterize(self, queue: asyncio.Queue, output: asyncio.Queue):
+        while (document := await queue.get()) is not _DONE:
+            try:
+                if document["path"].lower().endswith(".pdf"):
+                    prefix = f"bulk_{uuid.uuid4().hex}"
+                    document["pages"] = await convert_pdf_to_images(document["path"], prefix, ocr_backend.decoded_pages)
+                    document["temporary_pages"] = True
+                else:
+                    document["pages"] = [document["path"]]
+                await output.put(document)
+            except Exception as e:
+                await self._fail(document, "rasterize", e)
+
+    async def _ocr(self, queue: asyncio.Queue, output: asyncio.Queue):
+        finished = False
+        while not finished:
+            # Fill a batch with whatever pages are ready, up to the batch size
+            batch = []
+            item = await queue.get()
+            while item is not _DONE:
+                batch.append(item)
+                if sum(len(document["pages"]) for document in batch) >= self.ocr_batch_size or queue.empty():
+                    break
+                item = await queue.get()
+            finished = item is _DONE
+            if not batch:
+                continue
+
+            page_paths = [page for document in batch for page in document["pages"]]
+            page_types = [document["document_type"] for document in batch for _ in document["pages"]]
+            try:
+                page_results = await extract_text_from_images(page_paths, page_types)
+            except Exception as e:
+                for document in batch:
+                    self._cleanup(document)
+                    await self._fail(document, "ocr", e)
+                continue
+
+            offset = 0
+            for document in batch:
+                count = len(document["pages"])
+                document["raw_text"], document["lines"] = combine_pages(page_results[offset:offset + count])
+                offset += count
+                self._cleanup(document)
+                await output.put(document)
+
+    async def _extract(self, queue: asyncio.Queue, output: asyncio.Queue):
+        while (document := await queue.get()) is not _DONE:
+            try:
+                # The applicant's values let the LLM service escalate a
+                # cheaper tier's mismatching answer before it is recorded
+                details = await self._application_details(document["user_id"], document["application_id"])
+                expected = document_validators[document["document_type"]].expected_fields(details)
+                response = await request_extraction(
+                    document["raw_text"], prompt_schema[document["document_type"]], document.get("lines"),
+                    document["document_type"], expected
+                )
+                document["extracted"] = parse_extracted(response)
+                await output.put(document)
+            except Exception as e:
+                await self._fail(document, "extract", e)
+
+    async def _compare(self, queue: asyncio.Queue):
+        while (document := await queue.get()) is not _DONE:
+            if document["extracted"][0] != document["document_type"]:
+                # Another kind of document, its values are not compared
+                self.counts["verified"] += 1
+                self.counts["mismatched"] += 1
+                await asyncio.to_thread(self.checkpoint.record, {
+                    "key": document["key"],
+                    "document_type": document["document_type"],
+                    "status": "mismatched",
+                    "error": "Document type mismatch",
+                    "extracted_type": document["extracted"][0],
+                })
+                self._report()
+                continue
+            try:
+                details = await self._application_details(document["user_id"], document["application_id"])
+                validator = document_validators[document["document_type"]]
+                comparison = validator.validate(document["extracted"][1:], details)
+            except Exception as e:
+                await self._fail(document, "compare", e)
+                continue
+
+            self.counts["verified"] += 1
+            self.counts[comparison["status"]] += 1
+            await asyncio.to_thread(self.checkpoint.record, {
+                "key": document["key"],
+                "document_type": document["document_type"],
+                "status": comparison["status"],
+                "mismatches": comparison["mismatches"],
+            })
+            self._report()
+
+    async def _application_details(self, user_id: str, application_id: str) -> dict:
+        key = (user_id, application_id)
+        if key in self._details:
+            self._details.move_to_end(key)
+            return self._details[key]
+        details = await asyncio.to_thread(fetch_application_details, user_id, application_id)
+        self._details[key] = details or application_details(None)
+        while len(self._details) > DETAILS_CACHE_SIZE:
+            self._details.popitem(last=False)
+        return self._details[key]
+
+    async def _fail(self, document: dict, stage: str, error: Exception):
+        logger.error(f"Bulk verification of {document['key']} failed at {stage}: {error}")
+        self.counts["failed"] += 1
+        await asyncio.to_thread(
+            self.checkpoint.record, {"key": document["key"], "status": "error", "stage": stage, "error": str(error)}
+        )
+        self._report()
+
+    def _cleanup(self, document: dict):
+        if document.pop("temporary_pages", False):
+            for page in document["pages"]:
+                if isinstance(page, str) and os.path.exists(page):
+                    os.remove(page)
+
+    def _report(self):
+        finished = self.counts["verified"] + self.counts["failed"]
+        if finished % PROGRESS_EVERY == 0:
+            progress = self.progress()
+            logger.info(f"Bulk verification: {finished} documents, {progress['documents_per_second']} documents/s")
+
+
+def checkpoint_path(run_id: str) -> str:
+    """
+    Raises:
+        ValueError: The run id is not a plain name, e.g. "../x".
+    """
+    if not isinstance(run_id, str) or not RUN_ID.match(run_id):
+        raise ValueError("run_id may only hold letters, digits, '-' and '_'")
+    return os.path.join(CHECKPOINT_DIR, f"{run_id}.jsonl")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Re-verify stored application documents in bulk.")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--directory", help="Root of <application_id>/<user_id>/<document_type>.<ext> files")
+    source.add_argument("--query", help="Mongo query on applications, as JSON")
+    parser.add_argument("--documents-dir", default=DOCUMENTS_DIR, help="Document root used with --query")
+    parser.add_argument("--run-id", help="Reuse a run id to resume from its checkpoint")
+    parser.add_argument("--ocr-batch-size", type=int, default=OCR_BATCH_SIZE)
+    parser.add_argument("--llm-concurrency", type=int, default=LLM_CONCURRENCY)
+    args = parser.parse_args()
+
+    run_id = args.run_id or time.strftime("%Y%m%d-%H%M%S")
+    if args.directory:
+        documents = iter_directory(args.directory)
+    else:
+        documents = iter_query(json.loads(args.query), args.documents_dir)
+
+    verifier = BulkVerifier(documents, checkpoint_path(run_id), args.ocr_batch_size, args.llm_concurrency)
+    logger.info(f"Starting bulk verification run {run_id}")
+    print(json.dumps(asyncio.run(verifier.run()), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,208 @@
+import asyncio
+import logging
+import os
+import time
+import uuid
+
+from fastapi import HTTPException
+
+from backends import ocr_backend
+from extraction_store import content_hash, find_extraction, save_extraction
+from process_pdf import (
+    save_file, save_image_file, open_image_file, convert_pdf_to_images, extract_text_deduplicated, combine_pages,
+    request_extraction, request_extraction_batch
+)
+from schemas import prompt_schema
+from tracing import span
+from validators import parse_extracted, consistency_issues
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Pages OCR'd per batch when a whole application is verified at once
+BUNDLE_OCR_BATCH_SIZE = int(os.getenv("BUNDLE_OCR_BATCH_SIZE", "8"))
+# Documents accepted in one bundle
+MAX_BUNDLE_DOCUMENTS = int(os.getenv("MAX_BUNDLE_DOCUMENTS", "16"))
+
+
+async def _load_pages(document: dict, in_memory: bool, temporary: list):
+    file = document["file"]
+    if file.content_type == "application/pdf":
+        pdf_path = await save_file(file, "pdf")
+        temporary.append(pdf_path)
+        document["pages"] = await convert_pdf_to_images(pdf_path, f"bundle_{uuid.uuid4().hex[:8]}", in_memory)
+        temporary.extend(page for page in document["pages"] if isinstance(page, str))
+    elif file.content_type.startswith("image/"):
+        if in_memory:
+            document["pages"] = [await open_image_file(file)]
+        else:
+            page = await save_image_file(file)
+            temporary.append(page)
+            document["pages"] = [page]
+    else:
+        raise HTTPException(status_code=400, detail="Invalid file format. Only PDF or image files are allowed.")
+
+
+def _fail(document: dict, error):
+    detail = error.detail if isinstance(error, HTTPException) else str(error)
+    logger.error(f"Bundle document {document['label']} failed: {detail}")
+    document["error"] = detail
+
+
+async def _extract_type(document_type: str, documents: list, validator, details: dict):
+    """
+    Fields of every pending document of one type, in shared LLM calls when
+    there are several.
+    """
+    schema = prompt_schema[document_type]
+    expected = validator.expected_fields(details)
+    if len(documents) == 1:
+        document = documents[0]
+        answers = [await request_extraction(
+            document["raw_text"], schema, document["lines"], document_type, expected, document.get("min_tier")
+        )]
+    else:
+        answers = await request_extraction_batch(
+            [{"raw_text": document["raw_text"], "lines": document["lines"], "expected": expected} for document in documents],
+            schema, document_type
+        )
+    for document, answer in zip(documents, answers):
+        if "error" in answer:
+            _fail(document, answer["error"])
+        else:
+            document["response"] = answer
+
+
+async def verify_bundle(documents: list, validators: dict, details: dict, timings: dict) -> list:
+    """
+    Verify every document of an application in one pass: pages of all
+    documents are OCR'd together in batches, documents of one type share
+    LLM calls, and each document is compared with the application once.
+
+    Args:
+        documents (list): {"file": UploadFile, "document_type": str} per document.
+        validators (dict): DocumentValidator per document type.
+        details (dict): The application's biodata and education.
+        timings (dict): Receives the seconds spent per stage for the bundle.
+
+    Returns:
+        list: Per document its label, document type, status ("matched",
+            "mismatched" or "error"), comparison, extracted values and
+            whether a stored extraction was reused.
+    """
+    for number, document in enumerate(documents, start=1):
+        document["label"] = f"{number}:{document['file'].filename or document['document_type']}"
+        document["file"].file.seek(0)
+        document["digest"] = content_hash(await document["file"].read())
+        document["response"] = await asyncio.to_thread(
+            find_extraction, document["digest"], prompt_schema[document["document_type"]]
+        )
+        document["cache_hit"] = document["response"] is not None
+        if document["cache_hit"] and validators[document["document_type"]].needs_recheck(document["response"], details):
+            # Stored for another applicant by a cheaper tier, read again by the final one
+            document["response"], document["min_tier"] = None, "large"
+
+    pending = [document for document in documents if document["response"] is None]
+    temporary = []
+    try:
+        start_time = time.perf_counter()
+        in_memory = ocr_backend.decoded_pages
+        loaded = await asyncio.gather(
+            *(_load_pages(document, in_memory, temporary) for document in pending), return_exceptions=True
+        )
+        for document, error in zip(list(pending), loaded):
+            if isinstance(error, Exception):
+                _fail(document, error)
+                pending.remove(document)
+        timings["rasterize"] = time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        pages = [page for document in pending for page in document["pages"]]
+        page_types = [document["document_type"] for document in pending for _ in document["pages"]]
+        try:
+            with span("ocr.bundle", documents=len(pending), pages=len(pages)):
+                page_results = await extract_text_deduplicated(
+                    pages, page_types, BUNDLE_OCR_BATCH_SIZE, return_exceptions=True
+                )
+        except Exception as e:
+            # Hashing the pages failed before any OCR batch ran
+            page_results = [e] * len(pages)
+        offset = 0
+        for document in list(pending):
+            count = len(document["pages"])
+            results = page_results[offset:offset + count]
+            offset += count
+            # Only the documents with a page in a failed OCR batch fail
+            error = next((result for result in results if isinstance(result, Exception)), None)
+            if error is not None:
+                _fail(document, error)
+                pending.remove(document)
+                continue
+            document["raw_text"], document["lines"] = combine_pages(results)
+        timings["ocr"] = time.perf_counter() - start_time
+    finally:
+        for path in temporary:
+            if os.path.exists(path):
+                os.remove(path)
+
+    start_time = time.perf_counter()
+    by_type = {}
+    for document in pending:
+        # A re-check goes to the final tier alone, not into a shared call
+        key = (document["document_type"], document["label"] if document.get("min_tier") else None)
+        by_type.setdefault(key, []).append(document)
+    extracted = await asyncio.gather(
+        *(_extract_type(key[0], group, validators[key[0]], details) for key, group in by_type.items()),
+        return_exceptions=True
+    )
+    for group, error in zip(by_type.values(), extracted):
+        if isinstance(error, Exception):
+            for document in group:
+                _fail(document, error)
+
+    rechecks = [
+        document for document in pending
+        if "error" not in document and not document.get("min_tier")
+        and validators[document["document_type"]].needs_recheck(document["response"], details)
+    ]
+    for document in rechecks:
+        logger.info(f"Re-checking {document['label']} answer from the {document['response'].get('tier')} tier")
+        document["min_tier"] = "large"
+        try:
+            await _extract_type(document["document_type"], [document], validators[document["document_type"]], details)
+        except Exception as e:
+            _fail(document, e)
+    timings["llm"] = time.perf_counter() - start_time
+
+    results = []
+    for document in documents:
+        document_type = document["document_type"]
+        result = {"document": document["label"], "document_type": document_type, "cache_hit": document["cache_hit"]}
+        if "error" in document:
+            results.append({**result, "status": "error", "error": document["error"]})
+            continue
+        try:
+            extracted = parse_extracted(document["response"])
+        except Exception as e:
+            _fail(document, e)
+            results.append({**result, "status": "error", "error": "Error processing the file"})
+            continue
+        if not document["cache_hit"] or document.get("min_tier"):
+            save_extraction(document["digest"], prompt_schema[document_type], document["response"])
+        if extracted[0] != document_type:
+            results.append({**result, "status": "mismatched", "error": "Document type mismatch", "extracted": extracted})
+            continue
+        comparison = validators[document_type].validate(extracted[1:], details)
+        results.append({**result, "status": comparison["status"], "comparison": comparison, "extracted": extracted})
+    return results
+
+
+def bundle_consistency(results: list, validators: dict) -> list:
+    """
+    Cross-document checks over the documents whose type was confirmed.
+    """
+    return consistency_issues(
+        [(result["document"], result["document_type"], result["extracted"][1:])
+         for result in results if "comparison" in result],
+        validators
+    )
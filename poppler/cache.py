@@ -0,0 +1,99 @@
+import threading
+import time
+from collections import OrderedDict
+
+from mongodb_config import applications_collection
+from validators import application_details
+
+# Verified tokens are trusted for at most this long, or until they expire
+TOKEN_CACHE_TTL = 60
+TOKEN_CACHE_SIZE = 4096
+
+# Applicants upload documents in bursts, one read serves the whole burst
+APPLICATION_CACHE_TTL = 300
+APPLICATION_CACHE_SIZE = 2048
+
+
+class TTLCache:
+    """
+    Thread-safe LRU cache whose entries also expire after a TTL.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[1] <= time.time():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value, expires_at: float = None):
+        """
+        Store a value until expires_at or the TTL, whichever comes first.
+        """
+        deadline = time.time() + self.ttl
+        if expires_at is not None:
+            deadline = min(deadline, expires_at)
+        with self._lock:
+            self._entries[key] = (value, deadline)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+token_cache = TTLCache(TOKEN_CACHE_SIZE, TOKEN_CACHE_TTL)
+application_cache = TTLCache(APPLICATION_CACHE_SIZE, APPLICATION_CACHE_TTL)
+
+
+def fetch_application_details(user_id: str, application_id: str):
+    """
+    Read only biodata and education of an application, without the profile
+    picture. Returns None when the application does not exist.
+    """
+    pipeline = [
+        {"$match": {"user_id": user_id, "application_id": application_id}},
+        {"$limit": 1},
+        {"$project": {"_id": 0, "biodata": 1, "education": 1}},
+        {"$unset": "biodata.profilePicture"},
+    ]
+    for application in applications_collection.aggregate(pipeline):
+        return application_details(application)
+    return None
+
+
+def cached_application_details(user_id: str, application_id: str):
+    """
+    Application details cached per (user_id, application_id). The biodata and
+    education routes invalidate the entry when they write.
+    """
+    key = (user_id, application_id)
+    details = application_cache.get(key)
+    if details is None:
+        details = fetch_application_details(user_id, application_id)
+        if details is not None:
+            application_cache.set(key, details)
+    return details
+
+
+def invalidate_application(user_id: str, application_id: str):
+    application_cache.invalidate((user_id, application_id))
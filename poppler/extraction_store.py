@@ -0,0 +1,104 @@
+import datetime
+import hashlib
+import json
+import logging
+import os
+
+from pymongo import ASCENDING
+from pymongo.errors import PyMongoError
+
+from mongodb_config import extractions_collection
+from write_behind import write_behind
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# The models that produce an extraction, read from the same settings as the
+# OCR service and the LLM service's cascade tiers; results stored under other
+# models are not reused and are purged at startup
+OCR_MODEL = os.getenv("OCR_MODEL", "surya")
+SMALL_MODEL = os.getenv("SMALL_MODEL", "gemma2:2b")
+LARGE_MODEL = os.getenv("LARGE_MODEL", "gemma2:9b")
+MODEL_VERSION = f"{OCR_MODEL}/{SMALL_MODEL}/{LARGE_MODEL}"
+
+# Stored extractions are dropped after this many days even if still current
+EXTRACTION_TTL_DAYS = int(os.getenv("EXTRACTION_TTL_DAYS", "90"))
+
+
+def content_hash(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def schema_version(schema: dict) -> str:
+    """
+    Version of a prompt_schema entry; any change to its fields or type hints
+    changes the version and so invalidates stored extractions.
+    """
+    return hashlib.sha256(json.dumps(schema, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+
+
+def ensure_indexes():
+    extractions_collection.create_index(
+        [("content_hash", ASCENDING), ("schema_version", ASCENDING), ("model_version", ASCENDING)],
+        unique=True,
+        name="extraction_key",
+    )
+    extractions_collection.create_index(
+        "createdAt",
+        expireAfterSeconds=EXTRACTION_TTL_DAYS * 24 * 3600,
+        name="extraction_ttl",
+    )
+
+
+def find_extraction(digest: str, schema: dict):
+    """
+    The stored LLM result for this document content and schema, or None.
+    Lookup failures are logged and treated as a miss.
+    """
+    try:
+        entry = extractions_collection.find_one(
+            {"content_hash": digest, "schema_version": schema_version(schema), "model_version": MODEL_VERSION},
+            {"_id": 0, "result": 1},
+        )
+    except PyMongoError as e:
+        logger.error(f"Extraction lookup failed: {e}")
+        return None
+    return entry["result"] if entry else None
+
+
+def save_extraction(digest: str, schema: dict, result):
+    """
+    Store a result through the write-behind writer, off the request path. A
+    cheaper tier's answer is only inserted, so it never replaces a stored
+    one; an answer from the final model tier replaces whatever is stored.
+    """
+    key = {"content_hash": digest, "schema_version": schema_version(schema), "model_version": MODEL_VERSION}
+    created = datetime.datetime.now(datetime.timezone.utc)
+    if isinstance(result, dict) and result.get("final"):
+        write_behind.upsert(
+            extractions_collection.name, key, {"$set": {"result": result}, "$setOnInsert": {"createdAt": created}}
+        )
+    else:
+        # A duplicate key from a concurrent upload is skipped by the writer
+        write_behind.insert(extractions_collection.name, {**key, "result": result, "createdAt": created})
+
+
+def purge_stale_extractions(current_schemas: dict) -> int:
+    """
+    Delete extractions made by another model or for a schema that no longer
+    exists in its stored form.
+    """
+    versions = [schema_version(schema) for schema in current_schemas.values()]
+    try:
+        result = extractions_collection.delete_many({
+            "$or": [
+                {"model_version": {"$ne": MODEL_VERSION}},
+                {"schema_version": {"$nin": versions}},
+            ]
+        })
+    except PyMongoError as e:
+        logger.error(f"Failed to purge stale extractions: {e}")
+        return 0
+    if result.deleted_count:
+        logger.info(f"Purged {result.deleted_count} stale extractions")
+    return result.deleted_count
@@ -0,0 +1,130 @@
+"""
+Load test for upload admission control.
+
+Simulated mode (default) runs the real AdmissionController and stage limits
+against fake backends with fixed service times, and offers 3x the load the
+backends can serve. It prints latency percentiles of admitted requests with
+and without admission control:
+
+    python load_test.py --overload 3
+
+Live mode replays uploads against a running server:
+
+    python load_test.py --url http://localhost:3001 --token <jwt> --application <id> \
+        --file sample.pdf --schema aadhaar --overload 3 --capacity 1.5
+"""
+import argparse
+import asyncio
+import random
+import statistics
+import time
+
+import admission as admission_module
+from admission import AdmissionController, PriorityLimiter, Overloaded, STAGE_LIMITS
+
+# Simulated per-document service time of each stage, in seconds
+SERVICE_TIMES = {"rasterize": 0.05, "ocr": 0.08, "llm": 0.2}
+
+
+def percentiles(latencies: list) -> dict:
+    if not latencies:
+        return {}
+    ordered = sorted(latencies)
+
+    def at(p):
+        return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+    return {"p50": round(at(50), 3), "p90": round(at(90), 3), "p99": round(at(99), 3), "mean": round(statistics.mean(ordered), 3)}
+
+
+async def simulated_upload():
+    for stage, seconds in SERVICE_TIMES.items():
+        async with admission_module.stage_slot(stage):
+            await asyncio.sleep(seconds * random.uniform(0.8, 1.2))
+
+
+def capacity_per_second() -> float:
+    # The slowest stage bounds throughput
+    return min(STAGE_LIMITS[stage] / seconds for stage, seconds in SERVICE_TIMES.items())
+
+
+async def run_simulation(overload: float, duration: float, controlled: bool) -> dict:
+    admission_module.stage_limits = {stage: PriorityLimiter(stage, limit) for stage, limit in STAGE_LIMITS.items()}
+    controller = AdmissionController() if controlled else AdmissionController(max_in_flight=10 ** 6, max_queue=10 ** 6)
+    rate = capacity_per_second() * overload
+    latencies, rejected = [], 0
+
+    async def one():
+        nonlocal rejected
+        start = time.perf_counter()
+        try:
+            async with controller.admit():
+                await simulated_upload()
+        except Overloaded:
+            rejected += 1
+            return
+        latencies.append(time.perf_counter() - start)
+
+    tasks = []
+    deadline = time.perf_counter() + duration
+    while time.perf_counter() < deadline:
+        tasks.append(asyncio.create_task(one()))
+        await asyncio.sleep(random.expovariate(rate))
+    await asyncio.gather(*tasks)
+    return {"offered": len(tasks), "admitted": len(latencies), "rejected": rejected, **percentiles(latencies)}
+
+
+async def run_live(args) -> dict:
+    import httpx
+
+    with open(args.file, "rb") as f:
+        content = f.read()
+    content_type = "application/pdf" if args.file.lower().endswith(".pdf") else "image/png"
+    rate = args.capacity * args.overload
+    latencies, statuses = [], {}
+
+    async with httpx.AsyncClient(timeout=120.0) as client:
+        async def one():
+            start = time.perf_counter()
+            response = await client.post(
+                f"{args.url}/api/application/{args.application}/upload",
+                headers={"Authorization": f"Bearer {args.token}"},
+                files={"file": (args.file, content, content_type)},
+                data={"schema": args.schema},
+            )
+            statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+            if response.status_code != 503:
+                latencies.append(time.perf_counter() - start)
+
+        tasks = []
+        deadline = time.perf_counter() + args.duration
+        while time.perf_counter() < deadline:
+            tasks.append(asyncio.create_task(one()))
+            await asyncio.sleep(random.expovariate(rate))
+        await asyncio.gather(*tasks, return_exceptions=True)
+    return {"offered": len(tasks), "statuses": statuses, **percentiles(latencies)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Upload load test under overload.")
+    parser.add_argument("--overload", type=float, default=3.0, help="Offered load as a multiple of capacity")
+    parser.add_argument("--duration", type=float, default=10.0, help="Seconds of offered load")
+    parser.add_argument("--url", help="Server to load; simulated when omitted")
+    parser.add_argument("--token")
+    parser.add_argument("--application")
+    parser.add_argument("--file")
+    parser.add_argument("--schema", default="aadhaar")
+    parser.add_argument("--capacity", type=float, default=1.0, help="Uploads per second the server sustains")
+    args = parser.parse_args()
+
+    if args.url:
+        print("live", asyncio.run(run_live(args)))
+        return
+
+    print(f"capacity {capacity_per_second():.1f}/s, offered {capacity_per_second() * args.overload:.1f}/s")
+    print("without admission control", asyncio.run(run_simulation(args.overload, args.duration, controlled=False)))
+    print("with admission control   ", asyncio.run(run_simulation(args.overload, args.duration, controlled=True)))
+
+
+if __name__ == "__main__":
+    main()
@@ -3,17 +3,39 @@ import logging
 import uvicorn
 import torch
 from fastapi.middleware.cors import CORSMiddleware
-from mongodb_config import users_collection, jobs_collection, applications_collection
-from fastapi import FastAPI, HTTPException, Depends
+from mongodb_config import users_collection, jobs_collection, applications_collection, admins_collection
+from fastapi import FastAPI, HTTPException, Depends, BackgroundTasks
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from process_pdf import process_pdf_file
 from fastapi.responses import JSONResponse
+from fastapi.encoders import jsonable_encoder
 from pydantic import BaseModel, EmailStr
 import jwt
 import datetime
-from typing import Optional
+import time
+from typing import Optional, List
 from datetime import date
-from fastapi.responses import StreamingResponse
+from fastapi.responses import StreamingResponse, FileResponse
+from schemas import prompt_schema
+from validators import compile_schemas, parse_extracted, application_details
+from bundle import verify_bundle, bundle_consistency, MAX_BUNDLE_DOCUMENTS
+from bulk_verify import BulkVerifier, iter_directory, iter_query, checkpoint_path, DOCUMENTS_DIR
+from extraction_store import ensure_indexes, purge_stale_extractions
+from analytics import (
+    record_verification, ensure_analytics_indexes, document_type_stats, field_stats, latency_stats, cache_stats,
+    ErrorLogHandler
+)
+from write_behind import write_behind
+from pagination import paginate, stream_export, ensure_listing_indexes, DEFAULT_PAGE_SIZE
+from backends import ocr_backend, llm_backend, OCR_BACKEND
+from page_hash import page_index
+from admission import admission, stage_limits, Overloaded, INTERACTIVE
+from cache import token_cache, application_cache, cached_application_details, invalidate_application
+from profiling import profiler
+from tracing import trace_request, exporter, critical_path, format_trace
+from reverification import ensure_document_field_indexes, save_document_fields, reverify_application, document_alerts
+import asyncio
+import uuid
 
 
 
@@ -22,6 +44,14 @@ def clear_torch_cache():
     torch.cuda.ipc_collect()
 
 clear_torch_cache()
+ensure_indexes()
+# Extractions by models or schemas no longer configured can never be reused
+purge_stale_extractions(prompt_schema)
+ensure_listing_indexes()
+ensure_analytics_indexes()
+ensure_document_field_indexes()
+# Errors logged by any module are kept in error_logs
+logging.getLogger().addHandler(ErrorLogHandler())
 
 SECRET_KEY = "SIH"
 
@@ -40,6 +70,18 @@ app.add_middleware(
 from starlette.middleware.base import BaseHTTPMiddleware
 from fastapi import Request
 
+@app.middleware("http")
+async def trace_requests(request: Request, call_next):
+    # Every request is a trace, or continues the caller's
+    return await trace_request(request, call_next)
+
+@app.middleware("http")
+async def profile_requests(request: Request, call_next):
+    # Disarmed profiling costs one attribute read per request
+    if not profiler.remaining:
+        return await call_next(request)
+    return await profiler.capture(request, call_next)
+
 # class LogRequestBodyMiddleware(BaseHTTPMiddleware):
 #     async def dispatch(self, request: Request, call_next):
 #         if request.method == "POST":
@@ -51,71 +93,6 @@ from fastapi import Request
 # # Add the middleware to the FastAPI application
 # app.add_middleware(LogRequestBodyMiddleware)
 
-prompt_schema = {
-    "aadhaar": {
-        "name": "String",
-        "aadhaar_number": "Integer, format: 12 digit number",
-        "date_of_birth": "String format: DD-MM-YYYY",
-        "address": "String"
-    },
-    "birth_certificate": {
-        "name": "String",
-        "date_of_birth": "Date, format: DD-MM-YYYY"
-    },
-    "marksheet": {
-        "name": "String",
-        "date_of_birth": "Date, Format: DD-MM-YYYY"
-    },
-    "degree_certificate": {
-        "name": "String",
-        "university": "String",
-        "date_of_birth": "Date Format (DD-MM-YYYY)",
-        "degree": "String",
-        "cgpa": "Float",
-        "percentage": "Float",
-        "class": "String",
-        "qualification_degree": "String"
-    },
-    "proof_of_class": {
-        "name": "String",
-        "class": "String"
-    },
-    "provisional_certificate": {
-        "name": "String",
-        "degree": "String",
-        "university": "String",
-        "passing_year": "Integer",
-        "qualification_degree": "String"
-    },
-    "experience_certificate": {
-        "from_date": "String Format(YYYY-MM-DD)",
-        "to_date": "String Format(YYYY-MM-DD)"
-    },
-    "gate_score_card": {
-        "name": "String",
-        "year": "Integer(YYYY), Year of the GATE examination",
-        "marks_out_of_100": "Float, 0.0 to 100.0",
-        "all_india_rank_in_this_paper": "Integer",
-        "gate_score": "Integer, 0 to 1000"
-    },
-    "proof_of_category": {
-        "name": "String",
-        "category": "String"
-    },
-    "proof_of_address": {
-        "name": "String",
-        "address": "String"
-    },
-    "phd_certificate": {
-        "name": "String",
-        "university": "String",
-        "Date_of_reg": "String (YYYY-MM-DD)",
-        "title_of_project": "String",
-        "no_of_papers_published": "Integer",
-        "no_of_conference_attended": "Integer"
-    }
-}
-
 # Configure logger
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -123,21 +100,22 @@ logger = logging.getLogger(__name__)
 # Security scheme for HTTPBearer
 security = HTTPBearer()
 
+# Field validators, compiled once from prompt_schema
+document_validators = compile_schemas(prompt_schema)
+
 async def get_user_details(credentials, application_id):
     user_id = verify_jwt_token(credentials)
-    # Fetch the application data for the given user_id and application_id
-    application = applications_collection.find_one(
-        {"user_id": user_id, "application_id": application_id},
-        {'biodata.profilePicture': 0}
-    )
-    
-    biodata = application.get("biodata", {})
-    education = application.get("education", {'degree': [], 'gateDetails': {}})
-    return {"biodata": biodata, "education": education}
+    # Biodata and education only, cached across the applicant's uploads
+    details = cached_application_details(user_id, application_id)
+    if details is None:
+        raise HTTPException(status_code=404, detail="Application not found")
+    return details
     
+
 @app.post("/api/application/{application_id}/upload")
 async def validate(
     application_id: str,
+    background_tasks: BackgroundTasks,
     file: UploadFile = File(...),
     schema: str = Form(...),
     credentials: HTTPAuthorizationCredentials = Depends(security)
@@ -145,30 +123,133 @@ async def validate(
     
     document_type = schema
     userDetails = await get_user_details(credentials, application_id)
-    print(userDetails)
+    user_id = verify_jwt_token(credentials)
     
     if schema is None or schema not in prompt_schema:
         return JSONResponse(content={"error": "Schema is required"}, status_code=400)
     
     schema = prompt_schema[schema]
-    result = await process_pdf_file(file, schema)
+    start_time = time.perf_counter()
+    timings = {}
+
+    def record(status, comparison=None):
+        # Only enqueued here, the write-behind buffer writes them in batches
+        cache_hit = timings.pop("cache_hit", None)
+        timings["total"] = time.perf_counter() - start_time
+        record_verification(document_type, user_id, application_id, status, comparison, timings, cache_hit)
+
+    validator = document_validators[document_type]
+    expected = validator.expected_fields(userDetails)
+
+    try:
+        async with admission.admit(INTERACTIVE):
+            response = await process_pdf_file(file, schema, timings, document_type, expected)
+            if validator.needs_recheck(response, userDetails):
+                logger.info(f"Re-checking {document_type} answer from the {response.get('tier')} tier")
+                response = await process_pdf_file(file, schema, timings, document_type, expected, min_tier="large")
+    except Overloaded as e:
+        logger.warning(f"Upload rejected, {e}")
+        return JSONResponse(
+            content={"detail": "Server is busy, please retry shortly"},
+            status_code=503,
+            headers={"Retry-After": str(e.retry_after)}
+        )
+    except HTTPException as e:
+        record("error")
+        return JSONResponse(content={"detail": e.detail}, status_code=e.status_code)
+
     try:
-        result = eval(result)
+        result = parse_extracted(response)
     except Exception as e:
         logger.error(f"Error evaluating result: {e}")
+        record("error")
         return JSONResponse(content={"error": "Error processing the file"}, status_code=500)
     
     if result[0] != document_type:
+        record("mismatched")
         return JSONResponse(content={"error": "Document type mismatch"}, status_code=400)
     
-    index = 1
-    for key in schema:
-        if schema[key] != result[index]:
-            return JSONResponse(content={"error": f"Field {key} mismatch"}, status_code=400)
-        index += 1
+    comparison = validator.validate(result[1:], userDetails)
+    record(comparison["status"], comparison)
+    # Kept so biodata and education edits can be re-checked without OCR
+    background_tasks.add_task(
+        save_document_fields, user_id, application_id, document_type,
+        dict(zip(validator.fields, result[1:])), comparison
+    )
+    if comparison["status"] != "matched":
+        mismatch = comparison["mismatches"][0]
+        return JSONResponse(
+            content={"error": f"Field {mismatch['field']} mismatch", "mismatches": comparison["mismatches"]},
+            status_code=400
+        )
 
     return JSONResponse(content={"message": "Document is valid"}, status_code=200)
 
+@app.post("/api/application/{application_id}/bundle")
+async def validate_bundle(
+    application_id: str,
+    background_tasks: BackgroundTasks,
+    files: List[UploadFile] = File(...),
+    schemas: List[str] = Form(...),
+    credentials: HTTPAuthorizationCredentials = Depends(security)
+):
+    """
+    Verify all documents of an application in one request, files[i] against
+    schemas[i]: pages are OCR'd together, documents of one type share LLM
+    calls, and the documents are also checked against each other.
+    """
+    if not files or len(files) != len(schemas):
+        return JSONResponse(content={"error": "One schema is required per file"}, status_code=400)
+    if len(files) > MAX_BUNDLE_DOCUMENTS:
+        return JSONResponse(content={"error": f"At most {MAX_BUNDLE_DOCUMENTS} documents per bundle"}, status_code=400)
+    unknown = sorted({schema for schema in schemas if schema not in prompt_schema})
+    if unknown:
+        return JSONResponse(content={"error": f"Unknown schema: {', '.join(unknown)}"}, status_code=400)
+
+    userDetails = await get_user_details(credentials, application_id)
+    user_id = verify_jwt_token(credentials)
+    start_time = time.perf_counter()
+    timings = {}
+    documents = [{"file": file, "document_type": schema} for file, schema in zip(files, schemas)]
+
+    try:
+        async with admission.admit(INTERACTIVE):
+            results = await verify_bundle(documents, document_validators, userDetails, timings)
+    except Overloaded as e:
+        logger.warning(f"Bundle rejected, {e}")
+        return JSONResponse(
+            content={"detail": "Server is busy, please retry shortly"},
+            status_code=503,
+            headers={"Retry-After": str(e.retry_after)}
+        )
+    timings["total"] = time.perf_counter() - start_time
+
+    for result in results:
+        # Stage timings cover the whole bundle, per-document latency is not recorded
+        record_verification(
+            result["document_type"], user_id, application_id, result["status"],
+            result.get("comparison"), None, result["cache_hit"]
+        )
+        if "comparison" in result:
+            validator = document_validators[result["document_type"]]
+            background_tasks.add_task(
+                save_document_fields, user_id, application_id, result["document_type"],
+                dict(zip(validator.fields, result["extracted"][1:])), result["comparison"]
+            )
+
+    consistency = bundle_consistency(results, document_validators)
+    matched = not consistency and all(result["status"] == "matched" for result in results)
+    # Expected values can be dates read from Mongo
+    return JSONResponse(
+        content=jsonable_encoder({
+            "status": "matched" if matched else "mismatched",
+            "documents": [{key: value for key, value in result.items() if key != "extracted"} for result in results],
+            "consistency": consistency,
+            "timings": {stage: round(seconds, 3) for stage, seconds in timings.items()},
+        }),
+        status_code=200 if matched else 400
+    )
+
 # User registration model
 class RegisterModel(BaseModel):
     username: str
@@ -206,14 +287,27 @@ def create_jwt_token(user_id: str) -> str:
 
 # Helper function to verify JWT token
 def verify_jwt_token(credentials: HTTPAuthorizationCredentials):
+    token = credentials.credentials
+    user_id = token_cache.get(token)
+    if user_id is not None:
+        return user_id
     try:
-        payload = jwt.decode(credentials.credentials, SECRET_KEY, algorithms=["HS256"])
+        payload = jwt.decode(token, SECRET_KEY, algorithms=["HS256"])
+        # Never trust a cached token past its own expiry
+        token_cache.set(token, payload["user_id"], expires_at=payload["exp"])
         return payload["user_id"]
     except jwt.ExpiredSignatureError:
         raise HTTPException(status_code=401, detail="Token has expired")
     except jwt.InvalidTokenError:
         raise HTTPException(status_code=401, detail="Invalid token")
 
+# Helper function to verify an admin's JWT token
+def verify_admin_token(credentials: HTTPAuthorizationCredentials):
+    user_id = verify_jwt_token(credentials)
+    if not admins_collection.find_one({"username": user_id}, {"_id": 1}):
+        raise HTTPException(status_code=403, detail="Admin access required")
+    return user_id
+
 # API: /api/register
 @app.post("/api/register")
 async def register(user: RegisterModel):
@@ -269,13 +363,25 @@ async def create_job_post(job: JobPostModel, credentials: HTTPAuthorizationCrede
 
 # API: /api/job (Protected route)
 @app.get("/api/job")
-async def get_job_posts(credentials: HTTPAuthorizationCredentials = Depends(security)):
+async def get_job_posts(
+    limit: Optional[int] = None,
+    after: Optional[str] = None,
+    credentials: HTTPAuthorizationCredentials = Depends(security)
+):
     verify_jwt_token(credentials)
-    # Fetch job posts from MongoDB
-    job_posts = list(jobs_collection.find())
-    for job in job_posts:
-        job["_id"] = str(job["_id"])
-    return {"jobs": job_posts}
+    if limit is None and after is None:
+        # Existing clients get every job post in full, as before pagination
+        job_posts = list(jobs_collection.find())
+        for job in job_posts:
+            job["_id"] = str(job["_id"])
+        return {"jobs": job_posts}
+
+    # Fetch one page of job posts, pass next_cursor as `after` for the next one
+    page = paginate(
+        jobs_collection, {}, {"title": 1, "createdAt": 1, "updatedAt": 1, "createdBy": 1},
+        limit=limit or DEFAULT_PAGE_SIZE, after=after
+    )
+    return {"jobs": page["items"], "next_cursor": page["next_cursor"]}
 
 # API: /api/biodata (Protected route)
 @app.post("/api/biodata")
@@ -301,7 +407,10 @@ async def get_biodata(application_id: str, credentials: HTTPAuthorizationCredent
     user_id = verify_jwt_token(credentials)
     
     # Fetch application details from the applications collection for the user and application_id
-    application = applications_collection.find_one({"user_id": user_id, "application_id": application_id})
+    application = applications_collection.find_one(
+        {"user_id": user_id, "application_id": application_id},
+        {"biodata": 1}
+    )
     if not application:
         # If application not found, create a new application
         new_application = {
@@ -322,6 +431,7 @@ async def get_biodata(application_id: str, credentials: HTTPAuthorizationCredent
 @app.post("/api/application/{application_id}/biodata")
 async def save_application_biodata(application_id: str, biodata: dict, credentials: HTTPAuthorizationCredentials = Depends(security)):
     user_id = verify_jwt_token(credentials)
+    old_details = cached_application_details(user_id, application_id) or application_details(None)
 
     # Update the application with the new biodata
     applications_collection.update_one(
@@ -329,8 +439,13 @@ async def save_application_biodata(application_id: str, biodata: dict, credentia
         {"$set": {"biodata": biodata, "updatedAt": datetime.datetime.now(datetime.timezone.utc)}},
         upsert=True
     )
+    invalidate_application(user_id, application_id)
+
+    # Re-compare only the stored document fields that read the edited keys
+    new_details = application_details({**old_details, "biodata": biodata})
+    reverified = reverify_application(user_id, application_id, old_details, new_details, document_validators)
     
-    return {"message": "Application biodata saved successfully"}
+    return {"message": "Application biodata saved successfully", "reverified": reverified}
 
 
 @app.get("/api/application/{application_id}/education")
@@ -343,7 +458,8 @@ async def get_education_data(application_id: str, credentials: HTTPAuthorization
 
     # Fetch the application data for the given user_id and application_id
     application = applications_collection.find_one(
-        {"user_id": user_id, "application_id": application_id}
+        {"user_id": user_id, "application_id": application_id},
+        {"_id": 0, "education": 1}
     )
 
     if not application:
@@ -362,6 +478,7 @@ async def save_education_data(application_id: str, education: dict, credentials:
     The route is protected and requires JWT token for authentication.
     """
     user_id = verify_jwt_token(credentials)
+    old_details = cached_application_details(user_id, application_id) or application_details(None)
 
     # Update the application with the new education data
     result = applications_collection.update_one(
@@ -369,11 +486,26 @@ async def save_education_data(application_id: str, education: dict, credentials:
         {"$set": {"education": education, "updatedAt": datetime.datetime.now(datetime.timezone.utc)}},
         upsert=True
     )
+    invalidate_application(user_id, application_id)
     
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Application not found")
 
-    return {"message": "Application education data saved successfully"}
+    # Re-compare only the stored document fields that read the edited keys
+    new_details = application_details({**old_details, "education": education})
+    reverified = reverify_application(user_id, application_id, old_details, new_details, document_validators)
+
+    return {"message": "Application education data saved successfully", "reverified": reverified}
+
+
+@app.get("/api/application/{application_id}/verification")
+async def get_verification_status(application_id: str, credentials: HTTPAuthorizationCredentials = Depends(security)):
+    """
+    Status and mismatches of every verified document of an application, kept
+    current as biodata and education are edited.
+    """
+    user_id = verify_jwt_token(credentials)
+    return {"documents": document_alerts(user_id, application_id)}
 
 
 @app.get("/api/application/{application_id}/details")
@@ -385,7 +517,8 @@ async def get_application_details(application_id: str, credentials: HTTPAuthoriz
     user_id = verify_jwt_token(credentials)
     # Fetch the application data for the given user_id and application_id
     application = applications_collection.find_one(
-        {"user_id": user_id, "application_id": application_id}
+        {"user_id": user_id, "application_id": application_id},
+        {"_id": 0, "biodata": 1, "education": 1}
     )
     if not application:
         raise HTTPException(status_code=404, detail="Application not found")
@@ -395,6 +528,191 @@ async def get_application_details(application_id: str, credentials: HTTPAuthoriz
     education = application.get("education", {'degree': [], 'gateDetails': {}})
     return {"biodata": biodata, "education": education}
 
+# Fields listed for admins; biodata beyond the name is fetched per application
+APPLICATION_LISTING_PROJECTION = {
+    "user_id": 1, "application_id": 1, "biodata.name": 1, "createdAt": 1, "updatedAt": 1
+}
+
+@app.get("/api/admin/applications")
+async def list_applications(
+    application_id: Optional[str] = None,
+    limit: int = DEFAULT_PAGE_SIZE,
+    after: Optional[str] = None,
+    credentials: HTTPAuthorizationCredentials = Depends(security)
+):
+    verify_admin_token(credentials)
+    query = {"application_id": application_id} if application_id else {}
+    page = paginate(applications_collection, query, APPLICATION_LISTING_PROJECTION, limit=limit, after=after)
+    return {"applications": page["items"], "next_cursor": page["next_cursor"]}
+
+@app.get("/api/admin/applications/export")
+async def export_applications(
+    application_id: Optional[str] = None,
+    format: str = "ndjson",
+    credentials: HTTPAuthorizationCredentials = Depends(security)
+):
+    """
+    Stream every matching application as NDJSON (default) or a JSON array,
+    without the profile pictures.
+    """
+    verify_admin_token(credentials)
+    if format not in ("ndjson", "json"):
+        raise HTTPException(status_code=400, detail="format must be ndjson or json")
+
+    query = {"application_id": application_id} if application_id else {}
+    media_type = "application/x-ndjson" if format == "ndjson" else "application/json"
+    return StreamingResponse(
+        stream_export(applications_collection, query, {"biodata.profilePicture": 0}, format),
+        media_type=media_type
+    )
+
+# Dashboard analytics, read from pre-aggregated counters
+@app.get("/api/admin/analytics/documents")
+async def get_document_analytics(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    verify_admin_token(credentials)
+    return {"document_types": document_type_stats()}
+
+@app.get("/api/admin/analytics/fields")
+async def get_field_analytics(document_type: Optional[str] = None, credentials: HTTPAuthorizationCredentials = Depends(security)):
+    verify_admin_token(credentials)
+    return {"fields": field_stats(document_type)}
+
+@app.get("/api/admin/analytics/latency")
+async def get_latency_analytics(hours: int = 24, credentials: HTTPAuthorizationCredentials = Depends(security)):
+    verify_admin_token(credentials)
+    return {"latency": latency_stats(min(max(hours, 1), 24 * 31))}
+
+@app.get("/api/admin/analytics/cache")
+async def get_cache_analytics(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    verify_admin_token(credentials)
+    return {"cache": cache_stats(("token", token_cache), ("application", application_cache))}
+
+@app.get("/api/admin/analytics/persistence")
+async def get_persistence_stats(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    """
+    The write-behind buffer: writes queued and written, and batches spilled
+    to disk while Mongo was unreachable.
+    """
+    verify_admin_token(credentials)
+    return {"write_behind": write_behind.stats()}
+
+@app.get("/api/admin/analytics/pages")
+async def get_page_reuse_analytics(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    """
+    How often uploaded pages were copies of pages already OCR'd, within the
+    upload or in earlier ones.
+    """
+    verify_admin_token(credentials)
+    return {"pages": page_index.stats()}
+
+@app.get("/api/admin/admission")
+async def get_admission_stats(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    verify_admin_token(credentials)
+    return {
+        "admission": admission.stats(),
+        "stages": {stage: limiter.stats() for stage, limiter in stage_limits.items()},
+        "backends": {"ocr": ocr_backend.stats(), "llm": llm_backend.stats()}
+    }
+
+@app.post("/api/admin/profiling")
+async def start_profiling(request: dict, credentials: HTTPAuthorizationCredentials = Depends(security)):
+    """
+    Profile the next requests: mode "sampling" (folded stacks, default),
+    "cprofile" (pstats) or, with the OCR engine embedded, "torch"; "requests"
+    to capture and an optional "path_prefix" such as /api/application.
+    """
+    verify_admin_token(credentials)
+    mode = request.get("mode", "sampling")
+    if mode == "torch" and OCR_BACKEND != "embedded":
+        # The OCR model runs in the OCR service, profile it there
+        raise HTTPException(status_code=400, detail="torch mode needs OCR_BACKEND=embedded")
+    try:
+        profiler.arm(mode, int(request.get("requests", 1)), request.get("path_prefix", ""))
+    except (TypeError, ValueError) as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return profiler.status()
+
+@app.delete("/api/admin/profiling")
+async def stop_profiling(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    verify_admin_token(credentials)
+    profiler.disarm()
+    return profiler.status()
+
+@app.get("/api/admin/profiling")
+async def get_profiling_status(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    verify_admin_token(credentials)
+    return profiler.status()
+
+@app.get("/api/admin/profiling/{file_name}")
+async def download_profile(file_name: str, credentials: HTTPAuthorizationCredentials = Depends(security)):
+    verify_admin_token(credentials)
+    path = profiler.file_path(file_name)
+    if path is None:
+        raise HTTPException(status_code=404, detail="Capture not found")
+    return FileResponse(path, filename=file_name)
+
+@app.get("/api/admin/traces")
+async def list_traces(limit: int = 20, credentials: HTTPAuthorizationCredentials = Depends(security)):
+    """
+    The slowest recent requests traced in memory, with their trace ids.
+    """
+    verify_admin_token(credentials)
+    roots = sorted(exporter.roots(), key=lambda root: root["duration_ms"], reverse=True)
+    return {"traces": roots[:max(1, min(limit, 200))]}
+
+@app.get("/api/admin/traces/{trace_id}")
+async def get_trace(trace_id: str, credentials: HTTPAuthorizationCredentials = Depends(security)):
+    """
+    This service's spans of one trace and its critical path. The OCR and LLM
+    spans are in their own traces.jsonl; `python tracing.py <files> --trace
+    <id>` shows all three together.
+    """
+    verify_admin_token(credentials)
+    spans = exporter.trace(trace_id)
+    if not spans:
+        raise HTTPException(status_code=404, detail="Trace not found")
+    return {"spans": spans, "critical_path": critical_path(spans), "waterfall": format_trace(spans)}
+
+# Bulk re-verification runs started from the admin API, by run id
+bulk_runs = {}
+
+@app.post("/api/admin/reverify")
+async def start_reverification(request: dict, credentials: HTTPAuthorizationCredentials = Depends(security)):
+    """
+    Start a bulk re-verification run over a document directory or the
+    applications matching a Mongo query. Passing the run_id of an earlier
+    run resumes it from its checkpoint.
+    """
+    verify_admin_token(credentials)
+
+    run_id = request.get("run_id") or uuid.uuid4().hex
+    if run_id in bulk_runs and bulk_runs[run_id].status == "running":
+        raise HTTPException(status_code=409, detail="Run is already in progress")
+
+    if request.get("directory"):
+        documents = iter_directory(request["directory"])
+    elif isinstance(request.get("query"), dict):
+        documents = iter_query(request["query"], request.get("documents_dir", DOCUMENTS_DIR))
+    else:
+        raise HTTPException(status_code=400, detail="Either directory or query is required")
+
+    try:
+        path = checkpoint_path(run_id)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    # Reading an earlier run's checkpoint is file I/O, kept off the event loop
+    verifier = await asyncio.to_thread(BulkVerifier, documents, path)
+    bulk_runs[run_id] = verifier
+    verifier.task = asyncio.create_task(verifier.run())
+    return {"message": "Re-verification started", "run_id": run_id}
+
+@app.get("/api/admin/reverify/{run_id}")
+async def get_reverification_progress(run_id: str, credentials: HTTPAuthorizationCredentials = Depends(security)):
+    verify_admin_token(credentials)
+    if run_id not in bulk_runs:
+        raise HTTPException(status_code=404, detail="Run not found")
+    return {"run_id": run_id, **bulk_runs[run_id].progress()}
+
 # Main entry point for running the app
 if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=3001)
@@ -0,0 +1,328 @@
+"""
+Near-duplicate page detection, to OCR each distinct page once.
+
+Each page gets two signatures:
+
+- a perceptual hash, the sign pattern of the lowest 16x16 DCT coefficients
+  of the page shrunk to 64x64 grey levels (256 bits). Copies of a page land
+  within a few bits of each other where a byte hash changes completely, so
+  the hash finds candidates quickly, but pages of one form that differ in a
+  name or a mark are just as close.
+- a block grid, the mean grey level of blocks about 8 pixels wide at
+  200 dpi. A candidate is only accepted when no block differs by more than
+  PAGE_BLOCK_TOLERANCE levels: enough for re-rasterizing and JPEG
+  re-encoding, not for a changed digit. Re-scans of the paper move every
+  block and are OCR'd again.
+
+Benchmark on synthetic document bundles, or on a directory of page images:
+
+    python page_hash.py --uploads 200
+    python page_hash.py --pages scans/
+"""
+import argparse
+import copy
+import io
+import logging
+import os
+import random
+import threading
+import time
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageFilter
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Pages whose hashes differ in at most this many of the 256 bits are candidates
+PAGE_HASH_DISTANCE = int(os.getenv("PAGE_HASH_DISTANCE", "24"))
+# Largest grey level difference of any block between two copies of a page
+PAGE_BLOCK_TOLERANCE = int(os.getenv("PAGE_BLOCK_TOLERANCE", "14"))
+# OCR results of recent pages kept for reuse by later uploads, about 60 KB each
+PAGE_INDEX_SIZE = int(os.getenv("PAGE_INDEX_SIZE", "1024"))
+
+SAMPLE_SIZE = 64
+HASH_SIDE = 16
+HASH_BYTES = HASH_SIDE * HASH_SIDE // 8
+# Blocks across an A4 page, about 8 pixels each at 200 dpi
+GRID_WIDTH = 208
+
+# Bits set in each byte value, for Hamming distances over packed hashes
+_POPCOUNT = np.array([bin(value).count("1") for value in range(256)], dtype=np.uint8)
+
+
+def _dct_rows(size: int, rows: int) -> np.ndarray:
+    # The first rows of the orthonormal DCT-II matrix, the low frequencies
+    k = np.arange(rows)[:, None]
+    n = np.arange(size)[None, :]
+    matrix = np.cos(np.pi * (2 * n + 1) * k / (2 * size)) * np.sqrt(2 / size)
+    matrix[0] /= np.sqrt(2)
+    return matrix
+
+
+_DCT = _dct_rows(SAMPLE_SIZE, HASH_SIDE)
+
+
+def _grey(page) -> Image.Image:
+    if isinstance(page, str):
+        with Image.open(page) as image:
+            return image.convert("L")
+    return page.convert("L")
+
+
+def page_signatures(pages: list) -> tuple:
+    """
+    Hashes and block grids of pages (PNG paths or decoded images).
+
+    Returns:
+        tuple: The hashes, one packed row of HASH_BYTES bytes per page, and
+            the list of block grids.
+    """
+    if not pages:
+        return np.zeros((0, HASH_BYTES), dtype=np.uint8), []
+    samples, grids = [], []
+    for page in pages:
+        grey = _grey(page)
+        samples.append(np.asarray(grey.resize((SAMPLE_SIZE, SAMPLE_SIZE), Image.Resampling.BOX), dtype=np.float32))
+        height = max(1, round(grey.height * GRID_WIDTH / grey.width))
+        grids.append(np.asarray(grey.resize((GRID_WIDTH, height), Image.Resampling.BOX), dtype=np.uint8))
+    coefficients = (_DCT @ np.stack(samples) @ _DCT.T).reshape(len(pages), -1)
+    # The DC term only says how dark the page is overall
+    medians = np.median(coefficients[:, 1:], axis=1, keepdims=True)
+    return np.packbits(coefficients > medians, axis=1), grids
+
+
+def hash_distances(hashes: np.ndarray, target: np.ndarray) -> np.ndarray:
+    """
+    Hamming distances from one hash to each row of hashes.
+    """
+    return _POPCOUNT[np.bitwise_xor(hashes, target)].sum(axis=1, dtype=np.int32)
+
+
+def same_grid(left: np.ndarray, right: np.ndarray, tolerance: int = PAGE_BLOCK_TOLERANCE) -> bool:
+    if left.shape != right.shape:
+        return False
+    return int(np.abs(left.astype(np.int16) - right.astype(np.int16)).max()) <= tolerance
+
+
+def duplicate_of(hashes: np.ndarray, grids: list, threshold: int = PAGE_HASH_DISTANCE) -> list:
+    """
+    For each page, the index of the first earlier page it duplicates, or its
+    own index when it is the first of its kind.
+    """
+    distances = _POPCOUNT[np.bitwise_xor(hashes[:, None, :], hashes[None, :, :])].sum(axis=2, dtype=np.int32)
+    representatives = []
+    for index in range(len(hashes)):
+        representative = index
+        for other in np.flatnonzero(distances[index, :index] <= threshold):
+            if representatives[other] == other and same_grid(grids[other], grids[index]):
+                representative = int(other)
+                break
+        representatives.append(representative)
+    return representatives
+
+
+class PageIndex:
+    """
+    OCR results of recently seen pages, in a fixed-size ring searched by
+    hash and confirmed by block grid. A lookup only matches pages OCR'd for
+    the same document type, as the OCR service reads some types through
+    layout templates.
+    """
+
+    def __init__(self, size: int = PAGE_INDEX_SIZE, threshold: int = PAGE_HASH_DISTANCE):
+        self.size = size
+        self.threshold = threshold
+        self._hashes = np.zeros((size, HASH_BYTES), dtype=np.uint8)
+        self._entries = [None] * size
+        self._next = 0
+        self._count = 0
+        self._lock = threading.Lock()
+        self.lookups = 0
+        self.hits = 0
+        self.candidates = 0
+        self.duplicates = 0
+
+    def find(self, page_hash: np.ndarray, grid: np.ndarray, document_type: str = None):
+        """
+        A copy of the stored OCR result of a copy of this page, or None.
+        """
+        with self._lock:
+            self.lookups += 1
+            distances = hash_distances(self._hashes[:self._count], page_hash)
+            nearest = None
+            for index in np.argsort(distances, kind="stable"):
+                if distances[index] > self.threshold:
+                    break
+                stored_type, stored_grid, result = self._entries[index]
+                if stored_type != document_type:
+                    continue
+                if nearest is None:
+                    nearest = index
+                if same_grid(stored_grid, grid):
+                    self.hits += 1
+                    return copy.deepcopy(result)
+            # Close by hash but not a copy: another filled-in form or a re-scan
+            self.candidates += nearest is not None
+        return None
+
+    def record_duplicate(self):
+        with self._lock:
+            self.duplicates += 1
+
+    def add(self, page_hash: np.ndarray, grid: np.ndarray, document_type: str, result: dict):
+        with self._lock:
+            self._hashes[self._next] = page_hash
+            self._entries[self._next] = (document_type, grid, result)
+            self._next = (self._next + 1) % self.size
+            self._count = min(self._count + 1, self.size)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "pages": self._count,
+                "size": self.size,
+                "threshold": self.threshold,
+                "lookups": self.lookups,
+                "hits": self.hits,
+                "hit_rate": self.hits / self.lookups if self.lookups else None,
+                "rejected_candidates": self.candidates,
+                "duplicates_in_upload": self.duplicates,
+            }
+
+
+page_index = PageIndex()
+
+
+def _form_page(template: int, fields: list) -> Image.Image:
+    # A 200 dpi A4 form: a header, a ruled table and filled-in values
+    layout = random.Random(template)
+    image = Image.new("L", (1654, 2339), 255)
+    draw = ImageDraw.Draw(image)
+    draw.rectangle((120, 100, 1534, 300), outline=0, width=5)
+    draw.text((160, 140), f"BOARD OF EXAMINATIONS - FORM {template}", fill=0, font_size=40)
+    rows = layout.randint(8, 18)
+    for row in range(rows):
+        top = 400 + row * 90
+        draw.line((120, top, 1534, top), fill=0, width=2)
+        draw.text((140, top + 25), f"LABEL {layout.randint(100, 999)}", fill=0, font_size=28)
+        value = fields[row % len(fields)] if fields else layout.randint(1000, 9999)
+        draw.text((840, top + 25), str(value), fill=0, font_size=28)
+    for _ in range(layout.randint(5, 15)):
+        top = 460 + rows * 90 + layout.randint(0, 500)
+        draw.text((140, top), " ".join("word" * layout.randint(1, 3) for _ in range(8)), fill=0, font_size=28)
+    return image
+
+
+def _reencode(rng: random.Random, image: Image.Image) -> Image.Image:
+    # The same file exported or photographed-and-saved again
+    buffer = io.BytesIO()
+    image.save(buffer, "JPEG", quality=rng.randint(60, 95))
+    return Image.open(io.BytesIO(buffer.getvalue()))
+
+
+def _rescan(rng: random.Random, image: Image.Image) -> Image.Image:
+    # The same paper through the scanner again
+    image = image.rotate(rng.uniform(-0.5, 0.5), resample=Image.Resampling.BILINEAR, fillcolor=255)
+    image = image.transform(image.size, Image.Transform.AFFINE, (1, 0, rng.randint(-8, 8), 0, 1, rng.randint(-8, 8)), fillcolor=255)
+    image = image.point(lambda value: min(255, int(value * rng.uniform(0.85, 1.0) + rng.randint(0, 20))))
+    return _reencode(rng, image.filter(ImageFilter.GaussianBlur(rng.uniform(0, 1.0))))
+
+
+def synthetic_uploads(uploads: int, seed: int = 7):
+    """
+    Bundle-style uploads as (pages, contents), contents labelling what each
+    page really is so matches can be scored. Applicants fill in the same
+    forms, often include the common instruction page, re-upload documents in
+    later bundles and sometimes put a page in twice or scan it again.
+    """
+    rng = random.Random(seed)
+    documents = {}
+    for _ in range(uploads):
+        user = rng.randrange(max(1, uploads // 4))
+        previous = documents.get(user, [])
+        contents = [("instructions",)] if rng.random() < 0.5 else []
+        for _ in range(rng.randint(1, 3)):
+            if previous and rng.random() < 0.4:
+                contents.append(rng.choice(previous))
+            else:
+                template = rng.randint(1, 5)
+                values = random.Random(rng.random())
+                contents.append((user, template, f"NAME {values.randint(10 ** 5, 10 ** 6)}", values.randint(35, 100)))
+        if rng.random() < 0.2:
+            contents.append(rng.choice(contents))
+        documents[user] = previous + [content for content in contents if content[0] != "instructions"]
+
+        pages = []
+        for content in contents:
+            if content[0] == "instructions":
+                page = _form_page(0, [])
+            else:
+                page = _form_page(content[1], list(content[2:]))
+            pages.append(_rescan(rng, page) if rng.random() < 0.15 else _reencode(rng, page))
+        yield pages, contents
+
+
+def benchmark_synthetic(uploads: int, threshold: int):
+    index = PageIndex(threshold=threshold)
+    pages_total = duplicates = hits = repeats = false_matches = 0
+    seen = set()
+    hash_seconds = 0.0
+    for pages, contents in synthetic_uploads(uploads):
+        start_time = time.perf_counter()
+        hashes, grids = page_signatures(pages)
+        hash_seconds += time.perf_counter() - start_time
+        representatives = duplicate_of(hashes, grids, threshold)
+        for number, content in enumerate(contents):
+            pages_total += 1
+            repeats += content in seen or content in contents[:number]
+            if representatives[number] != number:
+                duplicates += 1
+                false_matches += contents[representatives[number]] != content
+                continue
+            found = index.find(hashes[number], grids[number])
+            if found is not None:
+                hits += 1
+                false_matches += tuple(found) != content
+            else:
+                index.add(hashes[number], grids[number], None, content)
+        seen.update(contents)
+
+    ocr_pages = pages_total - duplicates - hits
+    print(f"Pages: {pages_total} in {uploads} uploads, signatures {hash_seconds / pages_total * 1000:.1f} ms/page")
+    print(f"Pages seen before: {repeats}")
+    print(f"Reused within an upload: {duplicates}, from earlier uploads: {hits}")
+    print(f"Close by hash but not reused: {index.candidates}")
+    print(f"False matches: {false_matches}")
+    print(f"OCR calls: {ocr_pages} instead of {pages_total} ({1 - ocr_pages / pages_total:.1%} saved)")
+
+
+def benchmark_directory(directory: str, threshold: int):
+    names = sorted(name for name in os.listdir(directory) if name.lower().endswith((".png", ".jpg", ".jpeg")))
+    paths = [os.path.join(directory, name) for name in names]
+    start_time = time.perf_counter()
+    hashes, grids = page_signatures(paths)
+    seconds = time.perf_counter() - start_time
+    representatives = duplicate_of(hashes, grids, threshold)
+    print(f"Pages: {len(paths)}, signatures {seconds / max(1, len(paths)) * 1000:.1f} ms/page")
+    print(f"Duplicates: {sum(representative != index for index, representative in enumerate(representatives))}")
+    for index, representative in enumerate(representatives):
+        if representative != index:
+            distance = int(hash_distances(hashes[representative][None, :], hashes[index])[0])
+            print(f"  {names[index]} = {names[representative]} ({distance} bits)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure duplicate page detection")
+    parser.add_argument("--pages", help="Directory of page images to group instead of synthetic uploads")
+    parser.add_argument("--uploads", type=int, default=200, help="Synthetic uploads to generate")
+    parser.add_argument("--threshold", type=int, default=PAGE_HASH_DISTANCE)
+    args = parser.parse_args()
+    if args.pages:
+        benchmark_directory(args.pages, args.threshold)
+    else:
+        benchmark_synthetic(args.uploads, args.threshold)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+import json
+
+from bson import ObjectId
+from bson.errors import InvalidId
+from fastapi import HTTPException
+from pymongo import ASCENDING
+
+from mongodb_config import applications_collection
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+# Documents fetched per round-trip while streaming an export
+EXPORT_BATCH_SIZE = 1000
+
+
+def ensure_listing_indexes():
+    # Keyset pages of one vacancy's applications walk this index in order
+    applications_collection.create_index(
+        [("application_id", ASCENDING), ("_id", ASCENDING)],
+        name="application_listing",
+    )
+    applications_collection.create_index(
+        [("user_id", ASCENDING), ("application_id", ASCENDING)],
+        name="application_owner",
+    )
+
+
+def parse_cursor(after):
+    if not after:
+        return None
+    try:
+        return ObjectId(after)
+    except (InvalidId, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+def serialize(document: dict) -> dict:
+    if "_id" in document:
+        document["_id"] = str(document["_id"])
+    return document
+
+
+def paginate(collection, query: dict, projection: dict, limit: int = DEFAULT_PAGE_SIZE, after: str = None) -> dict:
+    """
+    One page of a collection in _id order, continuing after a cursor.
+
+    Args:
+        collection: Mongo collection to read.
+        query (dict): Filter; an index on its fields followed by _id keeps
+            every page an index range scan.
+        projection (dict): Fields to return.
+        limit (int): Page size, capped at MAX_PAGE_SIZE.
+        after (str): next_cursor of the previous page.
+
+    Returns:
+        dict: The page items and the cursor of the next page, None at the end.
+    """
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    cursor_id = parse_cursor(after)
+    if cursor_id is not None:
+        query = {**query, "_id": {"$gt": cursor_id}}
+
+    # One extra document tells whether another page exists
+    documents = list(collection.find(query, projection).sort("_id", ASCENDING).limit(limit + 1))
+    next_cursor = str(documents[limit - 1]["_id"]) if len(documents) > limit else None
+    return {"items": [serialize(document) for document in documents[:limit]], "next_cursor": next_cursor}
+
+
+def stream_export(collection, query: dict, projection: dict, export_format: str = "ndjson"):
+    """
+    Yield a whole query result as NDJSON lines or as one JSON array, without
+    holding it in memory.
+    """
+    cursor = collection.find(query, projection).sort("_id", ASCENDING).batch_size(EXPORT_BATCH_SIZE)
+    if export_format == "ndjson":
+        for document in cursor:
+            yield json.dumps(serialize(document), default=str) + "\n"
+        return
+
+    yield "["
+    first = True
+    for document in cursor:
+        yield ("" if first else ",") + json.dumps(serialize(document), default=str)
+        first = False
+    yield "]"
@@ -1,7 +1,7 @@
 import aiofiles
+import io
 import time
 from fastapi import File, UploadFile, HTTPException
-import httpx
 import os
 import logging
 from PIL import Image
@@ -9,6 +9,14 @@ import shutil
 from pdf2image import convert_from_path
 from torchvision import transforms
 import concurrent.futures
+import asyncio
+import uuid
+from admission import stage_slot
+from tracing import span
+from backends import ocr_backend, llm_backend
+from extraction_store import content_hash, find_extraction, save_extraction
+from page_hash import page_signatures, duplicate_of, page_index
+from validators import parse_extracted
 
 
 logging.basicConfig(level=logging.INFO)
@@ -17,8 +25,7 @@ logger = logging.getLogger(__name__)
 poppler_path = r"C:\Program Files\Release-24.08.0-0\poppler-24.08.0\Library\bin"
 IMAGES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "images")
 
-ocr_server = "localhost"
-llm_server = "localhost"
+# OCR and LLM run in-process or on the replicas, see OCR_BACKEND and LLM_BACKEND in backends.py
 
 def clear_images_directory():
     if os.path.exists(IMAGES_DIR):
@@ -28,120 +35,269 @@ def clear_images_directory():
 clear_images_directory()
 
 async def save_file(file: UploadFile, extension: str) -> str:
-    file_path = os.path.join(IMAGES_DIR, f"uploaded_{int(time.time())}.{extension}")
+    file_path = os.path.join(IMAGES_DIR, f"uploaded_{int(time.time())}_{uuid.uuid4().hex[:8]}.{extension}")
     file.file.seek(0)
     
-    async with aiofiles.open(file_path, "wb") as f:
-        await f.write(await file.read())
+    with span("save", extension=extension):
+        async with aiofiles.open(file_path, "wb") as f:
+            await f.write(await file.read())
     
     logger.info(f"File saved at {file_path}")
     return file_path
 
+ALLOWED_IMAGE_FORMATS = {"image/png": "png", "image/jpeg": "jpg"}
+
 async def save_image_file(file: UploadFile) -> str:
-    allowed_formats = {"image/png": "png", "image/jpeg": "jpg"}
-    extension = allowed_formats.get(file.content_type)
+    extension = ALLOWED_IMAGE_FORMATS.get(file.content_type)
     if not extension:
         logger.error(f"Unsupported image format: {file.content_type}")
         raise HTTPException(status_code=400, detail="Unsupported image format")
     return await save_file(file, extension)
 
-async def extract_text_from_image(image_path: str) -> str:
-    async with aiofiles.open(image_path, "rb") as f:
-        image_data = await f.read()
+async def open_image_file(file: UploadFile):
+    """
+    Decode an uploaded image in memory, for an OCR backend that takes
+    decoded pages.
+    """
+    if file.content_type not in ALLOWED_IMAGE_FORMATS:
+        logger.error(f"Unsupported image format: {file.content_type}")
+        raise HTTPException(status_code=400, detail="Unsupported image format")
+    file.file.seek(0)
+    data = await file.read()
+    try:
+        image = Image.open(io.BytesIO(data))
+        image.load()
+    except Exception as e:
+        logger.error(f"Uploaded file is not a valid image: {e}")
+        raise HTTPException(status_code=400, detail="Uploaded file is not a valid image.")
+    return image
+
+async def extract_text_from_image(page, document_type: str = None) -> dict:
+    """
+    OCR one page, a PNG path or a decoded image, through the configured
+    OCR backend.
+    """
+    async with stage_slot("ocr"):
+        return await ocr_backend.extract_page(page, document_type)
+
+async def extract_text_from_images(pages: list, document_types: list = None) -> list:
+    """
+    OCR several pages in one batch, results follow the order of pages.
+    document_types, aligned with pages, lets the OCR engine read fixed
+    layouts through their templates.
+    """
+    async with stage_slot("ocr"):
+        return await ocr_backend.extract_pages(pages, document_types)
 
-    async with httpx.AsyncClient(timeout=30.0) as client:
+async def extract_text_deduplicated(pages: list, document_types: list = None, batch_size: int = 1,
+                                    return_exceptions: bool = False) -> list:
+    """
+    OCR the pages of one upload, each distinct page once: copies within the
+    upload share the first copy's text and copies of pages OCR'd for earlier
+    uploads reuse the stored text, see page_hash.py.
+
+    document_types is aligned with pages. With a batch_size above 1 the
+    remaining pages are OCR'd in batches of that many. With
+    return_exceptions a failed batch does not stop the others: each of its
+    pages, and their copies, get the exception in place of a result.
+    """
+    document_types = document_types or [None] * len(pages)
+    with span("page_hash", pages=len(pages)):
+        hashes, grids = await asyncio.to_thread(page_signatures, pages)
+    representatives = duplicate_of(hashes, grids)
+
+    page_results = [None] * len(pages)
+    missing = []
+    for index in range(len(pages)):
+        representative = representatives[index]
+        # Some types are read through layout templates, a copy under another type is not reused
+        if representative != index and document_types[representative] == document_types[index]:
+            page_index.record_duplicate()
+            continue
+        representatives[index] = index
+        page_results[index] = page_index.find(hashes[index], grids[index], document_types[index])
+        if page_results[index] is None:
+            missing.append(index)
+
+    for start in range(0, len(missing), batch_size):
+        batch = missing[start:start + batch_size]
         try:
-            response = await client.post(
-                f"http://{ocr_server}:8001/extract-text",
-                files={"file": (os.path.basename(image_path), image_data, "image/png")}
-            )
-            response.raise_for_status()
-        except httpx.HTTPStatusError as e:
-            logger.error(f"API Error: {e.response.text}")
-            raise HTTPException(status_code=500, detail="Text extraction API failed")
+            if batch_size == 1:
+                with span("ocr.page", page=batch[0] + 1):
+                    results = [await extract_text_from_image(pages[batch[0]], document_types[batch[0]])]
+            else:
+                results = await extract_text_from_images([pages[index] for index in batch], [document_types[index] for index in batch])
         except Exception as e:
-            logger.error(f"HTTP request error: {e}")
-            raise HTTPException(status_code=500, detail="Unable to connect to text extraction API")
+            if not return_exceptions:
+                raise
+            logger.error(f"OCR of {len(batch)} pages failed: {getattr(e, 'detail', e)}")
+            results = [e] * len(batch)
+        for index, page_result in zip(batch, results):
+            page_results[index] = page_result
+            if not isinstance(page_result, Exception):
+                page_index.add(hashes[index], grids[index], document_types[index], page_result)
+
+    return [page_results[representative] for representative in representatives]
+
+def combine_pages(page_results: list) -> tuple:
+    """
+    Join per-page OCR results into the document text and its structured
+    lines, numbering pages from 1 in document order.
+    """
+    lines = []
+    for page, page_result in enumerate(page_results, start=1):
+        for line in page_result.get("lines", []):
+            lines.append({**line, "page": page})
+    combined_text = "\n\n".join(page_result["extracted_text"] for page_result in page_results)
+    return combined_text, lines
+
+async def request_extraction(raw_text: str, schema: dict, lines: list = None, document_type: str = None,
+                             expected: list = None, min_tier: str = None) -> dict:
+    """
+    Send OCR text and the field schema to the LLM service. With structured
+    lines the LLM service picks the schema-relevant context itself; with a
+    document type it answers in the compact, schema-constrained format,
+    starting from the cheapest model tier allowed for the type.
 
-        return response.json()
+    expected holds the applicant's values in schema order so an answer that
+    disagrees with them is escalated to the final tier; min_tier skips the
+    cheaper tiers altogether.
+    """
+    payload = {"raw_text": raw_text, "schema": schema}
+    if lines:
+        payload["lines"] = lines
+    if document_type:
+        payload["output"] = "compact"
+        payload["document_type"] = document_type
+        if expected:
+            payload["expected"] = expected
+        if min_tier:
+            payload["min_tier"] = min_tier
 
-async def convert_pdf_to_images(pdf_path: str) -> list:
+    async with stage_slot("llm"):
+        with span("llm", document_type=document_type, min_tier=min_tier):
+            return await llm_backend.process(payload)
+
+async def request_extraction_batch(documents: list, schema: dict, document_type: str) -> list:
+    """
+    Send several documents of one type to the LLM service, which answers
+    them in shared calls. Each document is a dict with raw_text, lines and
+    expected as for request_extraction.
+
+    Returns:
+        list: One response per document, as request_extraction returns them.
+    """
+    payload = {"schema": schema, "document_type": document_type, "documents": documents}
+    async with stage_slot("llm"):
+        with span("llm", document_type=document_type, documents=len(documents)):
+            return (await llm_backend.process_batch(payload))["answers"]
+
+async def convert_pdf_to_images(pdf_path: str, prefix: str = "page", in_memory: bool = False) -> list:
+    """
+    Rasterize a PDF into page PNG paths, or into decoded page images when
+    in_memory is set (for an OCR backend that takes them).
+    """
+    # Rasterizing blocks for seconds on large PDFs, keep it off the event loop
+    with span("rasterize", in_memory=in_memory) as current:
+        async with stage_slot("rasterize"):
+            pages = await asyncio.to_thread(rasterize_pdf, pdf_path, prefix, in_memory)
+        current.set(pages=len(pages))
+        return pages
+
+def rasterize_pdf(pdf_path: str, prefix: str = "page", in_memory: bool = False) -> list:
     images = convert_from_path(pdf_path, dpi=200)
+    if in_memory:
+        return [image.convert("RGB") for image in images]
     transform = transforms.ToTensor()
 
     def process_image(i, image):
         image_tensor = transform(image)
         output_image = transforms.ToPILImage()(image_tensor.cpu())
-        image_path = os.path.join(IMAGES_DIR, f'page_{i + 1}.png')
+        image_path = os.path.join(IMAGES_DIR, f'{prefix}_{i + 1}.png')
         output_image.save(image_path, quality=95)
         return image_path
 
+    # executor.map keeps page order, the combined text must read top to bottom
     with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
-        futures = [executor.submit(process_image, i, image) for i, image in enumerate(images)]
-        processed_images = [future.result() for future in concurrent.futures.as_completed(futures)]
+        processed_images = list(executor.map(process_image, range(len(images)), images))
 
     return processed_images
 
-async def process_pdf_file(file: UploadFile = File(...), schema: str = None):
+async def process_pdf_file(file: UploadFile = File(...), schema: str = None, timings: dict = None, document_type: str = None,
+                           expected: list = None, min_tier: str = None):
+    """
+    Extract the schema fields from an uploaded document. A document whose
+    content was already extracted with the same schema and model reuses the
+    stored result and skips OCR and the LLM.
+
+    When a timings dict is passed it receives the seconds spent per stage and
+    whether the stored extraction was reused ("cache_hit"). document_type
+    lets the OCR service use a layout template for fixed-layout documents;
+    expected and min_tier are passed on to the LLM service, and a min_tier
+    re-check always bypasses the stored result.
+    """
+    timings = {} if timings is None else timings
+    file.file.seek(0)
+    digest = content_hash(await file.read())
+    cached = None if min_tier else await asyncio.to_thread(find_extraction, digest, schema)
+    timings["cache_hit"] = cached is not None
+    if cached is not None:
+        logger.info(f"Reusing stored extraction for {digest[:12]}")
+        return cached
+
+    result = await run_extraction(file, schema, timings, document_type, expected, min_tier)
+    try:
+        parse_extracted(result)
+    except Exception:
+        # Malformed model output is not worth remembering
+        return result
+    save_extraction(digest, schema, result)
+    return result
+
+async def run_extraction(file: UploadFile, schema: dict, timings: dict, document_type: str = None,
+                         expected: list = None, min_tier: str = None):
 
-    processed_images = []
+    # Decoded pages go to an in-process OCR engine or through shared memory,
+    # nothing is written to disk
+    in_memory = ocr_backend.decoded_pages
+    pages = []
+    pdf_path = None
     image_path = None
     try:
         if file.content_type == "application/pdf":
             pdf_path = await save_file(file, "pdf")
-            processed_images = await convert_pdf_to_images(pdf_path)
-
-            extracted_texts = []
-            for image_path in processed_images:
-                text = await extract_text_from_image(image_path)
-                extracted_texts.append(text['extracted_text'])
-
-            combined_text = "\n\n".join(extracted_texts)
-
-            async with httpx.AsyncClient(timeout=30.0) as client:
-                try:
-                    response = await client.post(
-                        f"http://{llm_server}:8002/process-data",
-                        json={"raw_text": combined_text, "schema": schema}
-                    )
-                    response.raise_for_status()
-                except httpx.HTTPStatusError as e:
-                    logger.error(f"API Error: {e.response.text}")
-                    raise HTTPException(status_code=500, detail="Data processing API failed")
-                except Exception as e:
-                    logger.error(f"HTTP request error: {e}")
-                    raise HTTPException(status_code=500, detail="Unable to connect to data processing API")
-
-                return response.json()
+            start_time = time.perf_counter()
+            pages = await convert_pdf_to_images(pdf_path, f"page_{uuid.uuid4().hex[:8]}", in_memory)
+            timings["rasterize"] = time.perf_counter() - start_time
+
+            start_time = time.perf_counter()
+            page_results = await extract_text_deduplicated(pages, [document_type] * len(pages))
+            timings["ocr"] = time.perf_counter() - start_time
+
+            combined_text, lines = combine_pages(page_results)
+            start_time = time.perf_counter()
+            result = await request_extraction(combined_text, schema, lines, document_type, expected, min_tier)
+            timings["llm"] = time.perf_counter() - start_time
+            return result
 
         elif file.content_type.startswith("image/"):
-            image_path = await save_image_file(file)
-            text = await extract_text_from_image(image_path)
-            async with httpx.AsyncClient(timeout=30.0) as client:
-                try:
-                    response = await client.post(
-                        f"http://{llm_server}:8002/process-data",
-                        json={"raw_text": text['extracted_text'], "schema": schema}
-                    )
-                    response.raise_for_status()
-                except httpx.HTTPStatusError as e:
-                    logger.error(f"API Error: {e.response.text}")
-                    raise HTTPException(status_code=500, detail="Data processing API failed")
-                except Exception as e:
-                    logger.error(f"HTTP request error: {e}")
-                    raise HTTPException(status_code=500, detail="Unable to connect to data processing API")
-                
-                return response.json()
+            if in_memory:
+                page = await open_image_file(file)
+            else:
+                image_path = page = await save_image_file(file)
+            start_time = time.perf_counter()
+            text = (await extract_text_deduplicated([page], [document_type]))[0]
+            timings["ocr"] = time.perf_counter() - start_time
+
+            start_time = time.perf_counter()
+            result = await request_extraction(text['extracted_text'], schema, text.get('lines'), document_type, expected, min_tier)
+            timings["llm"] = time.perf_counter() - start_time
+            return result
 
         else:
             logger.error("Invalid file format")
             raise HTTPException(status_code=400, detail="Invalid file format. Only PDF or image files are allowed.")
     finally:
-        if file.content_type == "application/pdf" and processed_images:
-            for image_path in processed_images:
-                if os.path.exists(image_path):
-                    os.remove(image_path)
-            os.remove(pdf_path)
-        elif file.content_type.startswith("image/") and image_path:
-            if os.path.exists(image_path):
-                os.remove(image_path)
\ No newline at end of file
+        for path in [page for page in pages if isinstance(page, str)] + [pdf_path, image_path]:
+            if path and os.path.exists(path):
+                os.remove(path)
@@ -0,0 +1,13 @@
+"""
+Profiling for the orchestrator, shared with the other services in
+common/profiling.py.
+"""
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common.profiling import Profiler, profiles_directory
+
+# "torch" only captures with OCR_BACKEND=embedded, see the admin route
+profiler = Profiler(profiles_directory("poppler", os.path.dirname(os.path.abspath(__file__))))
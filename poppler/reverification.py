@@ -0,0 +1,182 @@
+import datetime
+import logging
+
+from pymongo import ASCENDING, UpdateOne
+from pymongo.errors import PyMongoError
+
+from mongodb_config import document_fields_collection
+from validators import FIELD_SOURCES
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def ensure_document_field_indexes():
+    document_fields_collection.create_index(
+        [("user_id", ASCENDING), ("application_id", ASCENDING), ("document_type", ASCENDING)],
+        unique=True,
+        name="document_owner",
+    )
+
+
+def changed_paths(old, new, prefix: str = "") -> set:
+    """
+    Dotted paths at which two application records differ, with list items
+    written as "[]" like FIELD_SOURCES. A list that changed length is
+    reported as a whole.
+    """
+    if isinstance(old, dict) and isinstance(new, dict):
+        paths = set()
+        for key in old.keys() | new.keys():
+            paths |= changed_paths(old.get(key), new.get(key), f"{prefix}.{key}" if prefix else key)
+        return paths
+    if isinstance(old, list) and isinstance(new, list) and len(old) == len(new):
+        paths = set()
+        for left, right in zip(old, new):
+            paths |= changed_paths(left, right, f"{prefix}[]")
+        return paths
+    return set() if old == new else {prefix}
+
+
+def _overlaps(source: str, path: str) -> bool:
+    return source == path or source.startswith((path + ".", path + "[]")) or path.startswith(source + ".")
+
+
+# Schema field -> the application paths its comparison reads
+FIELD_DEPENDENCIES = {field: set(sources) for field, sources in FIELD_SOURCES.items()}
+
+
+def affected_fields(paths: set) -> set:
+    return {
+        field for field, sources in FIELD_DEPENDENCIES.items()
+        if any(_overlaps(source, path) for source in sources for path in paths)
+    }
+
+
+def field_states(extracted: dict, comparison: dict) -> dict:
+    """
+    Per field outcome of a comparison: matched, mismatched (with the
+    expected value) or skipped.
+    """
+    checked, skipped = set(comparison["checked"]), set(comparison["skipped"])
+    mismatched = {mismatch["field"]: mismatch["expected"] for mismatch in comparison["mismatches"]}
+    states = {}
+    for field in extracted:
+        if field in mismatched:
+            states[field] = {"status": "mismatched", "expected": mismatched[field]}
+        elif field in checked:
+            states[field] = {"status": "matched"}
+        elif field in skipped:
+            states[field] = {"status": "skipped"}
+    return states
+
+
+def summarize(extracted: dict, states: dict) -> tuple:
+    mismatches = [
+        {"field": field, "extracted": extracted.get(field), "expected": state.get("expected")}
+        for field, state in states.items() if state["status"] == "mismatched"
+    ]
+    return ("mismatched" if mismatches else "matched"), mismatches
+
+
+def save_document_fields(user_id: str, application_id: str, document_type: str, extracted: dict, comparison: dict):
+    """
+    Keep a verified document's extracted fields and per field outcome, so
+    later biodata or education edits can be re-checked without OCR or the
+    LLM. Runs after the response is sent; failures are logged.
+    """
+    states = field_states(extracted, comparison)
+    status, mismatches = summarize(extracted, states)
+    now = datetime.datetime.now(datetime.timezone.utc)
+    try:
+        document_fields_collection.update_one(
+            {"user_id": user_id, "application_id": application_id, "document_type": document_type},
+            {"$set": {
+                "extracted": extracted,
+                "fields": states,
+                "status": status,
+                "mismatches": mismatches,
+                "verifiedAt": now,
+                "updatedAt": now,
+            }},
+            upsert=True,
+        )
+    except PyMongoError as e:
+        logger.error(f"Failed to store document fields: {e}")
+
+
+def reverify_application(user_id: str, application_id: str, old_details: dict, new_details: dict, validators: dict) -> list:
+    """
+    Re-compare the stored documents of an application after an edit, only
+    the fields whose sources changed and only on documents holding them.
+
+    Args:
+        old_details (dict): biodata and education before the edit.
+        new_details (dict): biodata and education after the edit.
+        validators (dict): DocumentValidator per document type.
+
+    Returns:
+        list: The re-checked documents with their new status and mismatches.
+    """
+    fields = affected_fields(changed_paths(old_details, new_details))
+    if not fields:
+        return []
+
+    try:
+        documents = list(document_fields_collection.find(
+            {
+                "user_id": user_id,
+                "application_id": application_id,
+                "$or": [{f"extracted.{field}": {"$exists": True}} for field in sorted(fields)],
+            },
+            {"document_type": 1, "extracted": 1, "fields": 1},
+        ))
+    except PyMongoError as e:
+        logger.error(f"Failed to load document fields: {e}")
+        return []
+
+    now = datetime.datetime.now(datetime.timezone.utc)
+    updates, results = [], []
+    for document in documents:
+        validator = validators.get(document["document_type"])
+        if validator is None:
+            continue
+        extracted = document["extracted"]
+        recheck = [field for field in validator.fields if field in fields and field in extracted]
+        comparison = validator.validate(extracted, new_details, recheck)
+        changed = field_states(extracted, comparison)
+        states = {**document.get("fields", {}), **changed}
+        status, mismatches = summarize(extracted, states)
+        updates.append(UpdateOne(
+            {"_id": document["_id"]},
+            {"$set": {
+                **{f"fields.{field}": state for field, state in changed.items()},
+                "status": status,
+                "mismatches": mismatches,
+                "updatedAt": now,
+            }},
+        ))
+        results.append({
+            "document_type": document["document_type"],
+            "status": status,
+            "mismatches": mismatches,
+            "rechecked": recheck,
+        })
+
+    if updates:
+        try:
+            document_fields_collection.bulk_write(updates, ordered=False)
+        except PyMongoError as e:
+            logger.error(f"Failed to update document fields: {e}")
+    logger.info(f"Re-verified {len(results)} documents of {application_id} for {sorted(fields)}")
+    return results
+
+
+def document_alerts(user_id: str, application_id: str) -> list:
+    """
+    Current verification status and mismatches of every stored document.
+    """
+    return list(document_fields_collection.find(
+        {"user_id": user_id, "application_id": application_id},
+        {"_id": 0, "document_type": 1, "status": 1, "mismatches": 1, "updatedAt": 1},
+    ))
@@ -0,0 +1,66 @@
+# Field schemas sent to the LLM for each supported document type.
+# The values are type hints for the model and drive the field validators.
+prompt_schema = {
+    "aadhaar": {
+        "name": "String",
+        "aadhaar_number": "Integer, format: 12 digit number",
+        "date_of_birth": "String format: DD-MM-YYYY",
+        "address": "String"
+    },
+    "birth_certificate": {
+        "name": "String",
+        "date_of_birth": "Date, format: DD-MM-YYYY"
+    },
+    "marksheet": {
+        "name": "String",
+        "date_of_birth": "Date, Format: DD-MM-YYYY"
+    },
+    "degree_certificate": {
+        "name": "String",
+        "university": "String",
+        "date_of_birth": "Date Format (DD-MM-YYYY)",
+        "degree": "String",
+        "cgpa": "Float",
+        "percentage": "Float",
+        "class": "String",
+        "qualification_degree": "String"
+    },
+    "proof_of_class": {
+        "name": "String",
+        "class": "String"
+    },
+    "provisional_certificate": {
+        "name": "String",
+        "degree": "String",
+        "university": "String",
+        "passing_year": "Integer",
+        "qualification_degree": "String"
+    },
+    "experience_certificate": {
+        "from_date": "String Format(YYYY-MM-DD)",
+        "to_date": "String Format(YYYY-MM-DD)"
+    },
+    "gate_score_card": {
+        "name": "String",
+        "year": "Integer(YYYY), Year of the GATE examination",
+        "marks_out_of_100": "Float, 0.0 to 100.0",
+        "all_india_rank_in_this_paper": "Integer",
+        "gate_score": "Integer, 0 to 1000"
+    },
+    "proof_of_category": {
+        "name": "String",
+        "category": "String"
+    },
+    "proof_of_address": {
+        "name": "String",
+        "address": "String"
+    },
+    "phd_certificate": {
+        "name": "String",
+        "university": "String",
+        "Date_of_reg": "String (YYYY-MM-DD)",
+        "title_of_project": "String",
+        "no_of_papers_published": "Integer",
+        "no_of_conference_attended": "Integer"
+    }
+}
@@ -0,0 +1,90 @@
+import logging
+import os
+import threading
+from multiprocessing import shared_memory
+from urllib.parse import urlsplit
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Page transport to the OCR service: "auto" uses shared memory when every
+# OCR replica runs on this host, "on" and "off" force the choice
+SHM_TRANSPORT = os.getenv("SHM_TRANSPORT", "auto")
+LOCAL_HOSTS = {"localhost", "127.0.0.1", "::1"}
+
+
+class SharedPages:
+    """
+    Raw page pixels in shared-memory segments, handed to the OCR service as
+    a small handle instead of PNG bytes.
+
+    Segments are reference counted: share() returns the page with one
+    reference held by the caller, and every request attempt carrying the
+    handle, hedged twins and retries included, retain()s its own. The last
+    release() unlinks the segment, so an attempt still in flight keeps its
+    pages after another one has answered. A reader that already attached
+    keeps its mapping after the unlink, and segments still held when the
+    process exits are reclaimed by multiprocessing's resource tracker.
+    """
+
+    def __init__(self):
+        self._segments = {}
+        self._lock = threading.Lock()
+        self.pages = 0
+        self.bytes = 0
+
+    def share(self, image) -> dict:
+        # Four bytes per pixel let the reader map the pixels without a copy
+        if image.mode != "RGBX":
+            image = image.convert("RGBX")
+        data = image.tobytes()
+        segment = shared_memory.SharedMemory(create=True, size=len(data))
+        segment.buf[:len(data)] = data
+        with self._lock:
+            self._segments[segment.name] = [segment, 1]
+            self.pages += 1
+            self.bytes += len(data)
+        return {"name": segment.name, "size": list(image.size), "mode": "RGBX"}
+
+    def retain(self, name: str):
+        with self._lock:
+            self._segments[name][1] += 1
+
+    def release(self, name: str):
+        with self._lock:
+            entry = self._segments.get(name)
+            if entry is None:
+                return
+            entry[1] -= 1
+            if entry[1] > 0:
+                return
+            del self._segments[name]
+        segment = entry[0]
+        segment.close()
+        try:
+            segment.unlink()
+        except FileNotFoundError:
+            pass
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"segments": len(self._segments), "pages_shared": self.pages, "bytes_shared": self.bytes}
+
+
+def co_located(addresses: str) -> bool:
+    """
+    Whether every replica in a host:port list runs on this host.
+    """
+    hosts = [urlsplit(f"//{address.strip()}").hostname for address in addresses.split(",") if address.strip()]
+    return bool(hosts) and all(host in LOCAL_HOSTS for host in hosts)
+
+
+def use_shared_memory(addresses: str) -> bool:
+    if SHM_TRANSPORT == "on":
+        return True
+    if SHM_TRANSPORT == "off":
+        return False
+    return co_located(addresses)
+
+
+shared_pages = SharedPages()
@@ -0,0 +1,56 @@
+"""
+Tracing for the orchestrator, shared with the other services in
+common/tracing.py, plus a span per Mongo command. Show traces from the
+services' span files:
+
+    python tracing.py traces.jsonl ../ocr/traces.jsonl ../llm/traces.jsonl
+"""
+import os
+import sys
+import time
+
+from pymongo import monitoring
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common.tracing import (
+    configure, current_span, current_trace_id, exporter, inject, parse_traceparent, record_span, span,
+    trace_request, critical_path, format_trace, load_spans, main, TRACE_BUFFER_SIZE
+)
+
+configure("poppler", os.path.dirname(os.path.abspath(__file__)), TRACE_BUFFER_SIZE)
+
+
+class MongoCommandSpans(monitoring.CommandListener):
+    """
+    A span per Mongo command issued while a span is current.
+    """
+
+    def __init__(self):
+        self._started = {}
+
+    def started(self, event):
+        parent = current_span.get()
+        if parent is not None:
+            collection = event.command.get(event.command_name)
+            self._started[event.request_id] = (time.time(), parent, collection if isinstance(collection, str) else None)
+
+    def succeeded(self, event):
+        self._record(event, "ok")
+
+    def failed(self, event):
+        self._record(event, "error")
+
+    def _record(self, event, status: str):
+        entry = self._started.pop(event.request_id, None)
+        if entry is None:
+            return
+        start, parent, collection = entry
+        record_span(
+            f"mongo.{event.command_name}", start, start + event.duration_micros / 1e6, parent, status,
+            collection=collection
+        )
+
+
+if __name__ == "__main__":
+    main()
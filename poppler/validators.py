@@ -0,0 +1,415 @@
+import ast
+import os
+import re
+import sys
+import datetime
+import logging
+from functools import lru_cache
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common.normalize import fold_text as _fold_text
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Where each schema field lives in the applicant's record. Paths are dotted,
+# a "[]" suffix fans out over a list (an applicant can hold several degrees).
+# Fields without a source are extracted but not compared.
+FIELD_SOURCES = {
+    "name": ("biodata.name", "biodata.fullName"),
+    "date_of_birth": ("biodata.dob", "biodata.dateOfBirth"),
+    "address": ("biodata.address",),
+    "aadhaar_number": ("biodata.aadhaar", "biodata.aadhaarNumber"),
+    "category": ("biodata.category",),
+    "university": ("education.degree[].university",),
+    "degree": ("education.degree[].degree",),
+    "qualification_degree": ("education.degree[].qualification", "education.degree[].qualificationDegree"),
+    "class": ("education.degree[].class",),
+    "cgpa": ("education.degree[].cgpa",),
+    "percentage": ("education.degree[].percentage",),
+    "passing_year": ("education.degree[].passingYear", "education.degree[].passing_year"),
+    "year": ("education.gateDetails.year",),
+    "marks_out_of_100": ("education.gateDetails.marks", "education.gateDetails.marksOutOf100"),
+    "all_india_rank_in_this_paper": ("education.gateDetails.rank", "education.gateDetails.air"),
+    "gate_score": ("education.gateDetails.score", "education.gateDetails.gateScore"),
+}
+
+# Fields every document of one applicant must agree on
+CONSISTENT_FIELDS = ("name", "date_of_birth")
+
+# Absolute tolerance for float fields, OCR and rounding on certificates
+# rarely agree to the last digit
+NUMERIC_TOLERANCE = {
+    "cgpa": 0.01,
+    "percentage": 0.5,
+    "marks_out_of_100": 0.01,
+}
+
+# Formats tried after the one named in the schema hint
+FALLBACK_DATE_FORMATS = (
+    "%d-%m-%Y", "%d/%m/%Y", "%d.%m.%Y", "%Y-%m-%d", "%Y/%m/%d",
+    "%d %B %Y", "%d %b %Y", "%B %d, %Y", "%b %d, %Y", "%d-%b-%Y",
+)
+
+_HINT_DATE_FORMATS = {
+    "DD-MM-YYYY": "%d-%m-%Y",
+    "YYYY-MM-DD": "%Y-%m-%d",
+    "DD/MM/YYYY": "%d/%m/%Y",
+}
+
+_WHITESPACE = re.compile(r"\s+")
+_NON_DIGITS = re.compile(r"\D")
+_NUMBER = re.compile(r"-?\d+(?:\.\d+)?")
+
+
+# Normalisation is memoised: names and values repeat across thousands of
+# stored applications, so each is folded or parsed once
+fold_text = lru_cache(maxsize=65536)(_fold_text)
+
+
+@lru_cache(maxsize=65536)
+def parse_number(value):
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    match = _NUMBER.search(str(value).replace(",", ""))
+    return float(match.group()) if match else None
+
+
+@lru_cache(maxsize=65536)
+def parse_date(value, formats):
+    if isinstance(value, datetime.datetime):
+        return value.date()
+    if isinstance(value, datetime.date):
+        return value
+    text = _WHITESPACE.sub(" ", str(value)).strip()
+    # Datetimes serialised by the frontend, e.g. 2001-03-12T00:00:00.000Z
+    text = text.split("T")[0] if re.match(r"\d{4}-\d{2}-\d{2}T", text) else text
+    for fmt in formats:
+        try:
+            return datetime.datetime.strptime(text, fmt).date()
+        except ValueError:
+            continue
+    return None
+
+
+class FieldValidator:
+    """
+    Compares one extracted field with the applicant's value.
+
+    Subclasses override normalize() and, where equality is too strict, matches().
+    """
+
+    def __init__(self, field: str, type_hint: str):
+        self.field = field
+        self.type_hint = type_hint
+        self.sources = [_compile_path(path) for path in FIELD_SOURCES.get(field, ())]
+
+    def normalize(self, value):
+        return fold_text(value)
+
+    def matches(self, extracted, expected) -> bool:
+        return extracted == expected
+
+    def expected_values(self, details: dict) -> list:
+        values = []
+        for source in self.sources:
+            values.extend(v for v in source(details) if _is_scalar(v) and not _is_empty(v))
+        return values
+
+    def check(self, extracted, details: dict):
+        """
+        Returns None when the field cannot be compared, otherwise a
+        (matched, expected) pair.
+        """
+        expected = self.expected_values(details)
+        if not expected:
+            return None
+        extracted = _comparable(extracted)
+        candidate = None if _is_empty(extracted) else self.normalize(extracted)
+        if candidate is None:
+            return False, expected[0]
+        for value in expected:
+            normalized = self.normalize(value)
+            if normalized is not None and self.matches(candidate, normalized):
+                return True, value
+        return False, expected[0]
+
+
+class TextValidator(FieldValidator):
+    pass
+
+
+class NameValidator(FieldValidator):
+    """
+    Names match regardless of token order ("KUMAR RAJESH" == "Rajesh Kumar").
+    """
+
+    def normalize(self, value):
+        return tuple(sorted(fold_text(value).split()))
+
+
+class AddressValidator(FieldValidator):
+    """
+    Addresses match when most tokens of the shorter one appear in the other.
+    """
+
+    threshold = 0.8
+
+    def normalize(self, value):
+        return frozenset(fold_text(value).split())
+
+    def matches(self, extracted, expected) -> bool:
+        shorter = min(len(extracted), len(expected))
+        if not shorter:
+            return False
+        return len(extracted & expected) / shorter >= self.threshold
+
+
+class DateValidator(FieldValidator):
+    def __init__(self, field: str, type_hint: str):
+        super().__init__(field, type_hint)
+        hinted = [fmt for hint, fmt in _HINT_DATE_FORMATS.items() if hint in type_hint.upper()]
+        self.formats = tuple(dict.fromkeys(hinted + list(FALLBACK_DATE_FORMATS)))
+
+    def normalize(self, value):
+        return parse_date(value, self.formats)
+
+
+class NumberValidator(FieldValidator):
+    def __init__(self, field: str, type_hint: str):
+        super().__init__(field, type_hint)
+        self.tolerance = NUMERIC_TOLERANCE.get(field, 0.0)
+
+    def normalize(self, value):
+        return parse_number(value)
+
+    def matches(self, extracted, expected) -> bool:
+        return abs(extracted - expected) <= self.tolerance + 1e-9
+
+
+class AadhaarValidator(FieldValidator):
+    """
+    Compares the 12 digits whatever the grouping; a masked number
+    (XXXX XXXX 1234) is compared on its visible last four digits.
+    """
+
+    def normalize(self, value):
+        text = str(value)
+        digits = _NON_DIGITS.sub("", text)
+        if len(digits) == 12:
+            return digits
+        if len(digits) == 4 and re.search(r"[xX*]", text):
+            return "masked:" + digits
+        return None
+
+    def matches(self, extracted, expected) -> bool:
+        if extracted.startswith("masked:") or expected.startswith("masked:"):
+            return extracted[-4:] == expected[-4:]
+        return extracted == expected
+
+
+def build_field_validator(field: str, type_hint: str) -> FieldValidator:
+    hint = type_hint.lower()
+    if field == "aadhaar_number":
+        return AadhaarValidator(field, type_hint)
+    if "date" in hint or "dd-mm-yyyy" in hint or "yyyy-mm-dd" in hint:
+        return DateValidator(field, type_hint)
+    if hint.startswith("integer") or hint.startswith("float"):
+        return NumberValidator(field, type_hint)
+    if field == "name":
+        return NameValidator(field, type_hint)
+    if field == "address":
+        return AddressValidator(field, type_hint)
+    return TextValidator(field, type_hint)
+
+
+class DocumentValidator:
+    """
+    The compiled validators for one prompt_schema entry.
+    """
+
+    def __init__(self, document_type: str, schema: dict):
+        self.document_type = document_type
+        self.fields = list(schema)
+        self.validators = [build_field_validator(field, hint) for field, hint in schema.items()]
+
+    def validate(self, extracted, details: dict, fields: list = None) -> dict:
+        """
+        Compare extracted values with the applicant's biodata and education.
+
+        Args:
+            extracted (list | dict): Values in schema order, or keyed by field.
+            details (dict): {"biodata": ..., "education": ...} of the applicant.
+            fields (list): Compare only these fields, all when None.
+
+        Returns:
+            dict: Match status, mismatched fields, and the fields that were
+                checked or skipped.
+        """
+        if not isinstance(extracted, dict):
+            extracted = dict(zip(self.fields, extracted))
+
+        results = {"status": "matched", "mismatches": [], "checked": [], "skipped": []}
+        for validator in self.validators:
+            if fields is not None and validator.field not in fields:
+                continue
+            outcome = validator.check(extracted.get(validator.field), details)
+            if outcome is None:
+                results["skipped"].append(validator.field)
+                continue
+            results["checked"].append(validator.field)
+            matched, expected = outcome
+            if not matched:
+                results["status"] = "mismatched"
+                results["mismatches"].append({
+                    "field": validator.field,
+                    "extracted": extracted.get(validator.field),
+                    "expected": expected,
+                })
+        return results
+
+    def needs_recheck(self, response, details: dict) -> bool:
+        """
+        A cheaper model tier's answer (possibly stored for another applicant)
+        is never reported as a mismatch before the final tier has read the
+        document.
+        """
+        if not isinstance(response, dict) or response.get("final", True):
+            return False
+        try:
+            result = parse_extracted(response)
+        except Exception:
+            return True
+        return result[0] != self.document_type or self.validate(result[1:], details)["status"] != "matched"
+
+    def expected_fields(self, details: dict) -> list:
+        """
+        The applicant's value per schema field, in schema order, for the LLM
+        service to check its answer against. Fields with no value, or with
+        several candidates (e.g. one per degree), are None.
+        """
+        expected = []
+        for validator in self.validators:
+            values = validator.expected_values(details)
+            value = values[0] if len(values) == 1 else None
+            if hasattr(value, "strftime"):
+                value = value.strftime("%Y-%m-%d")
+            expected.append(value)
+        return expected
+
+
+def consistency_issues(documents: list, validators: dict, fields: tuple = CONSISTENT_FIELDS) -> list:
+    """
+    Fields an applicant's documents disagree on among themselves, e.g. a
+    date of birth that differs between the Aadhaar card and the marksheet,
+    found even where the application holds no value to compare with.
+
+    Args:
+        documents (list): (label, document_type, extracted values in schema order).
+        validators (dict): DocumentValidator per document type.
+
+    Returns:
+        list: Per disagreeing field, the value read from each document.
+    """
+    issues = []
+    for field in fields:
+        readings = []
+        for label, document_type, extracted in documents:
+            validator = validators[document_type]
+            if field not in validator.fields:
+                continue
+            position = validator.fields.index(field)
+            value = extracted[position] if position < len(extracted) else None
+            field_validator = validator.validators[position]
+            comparable = _comparable(value)
+            normalized = None if _is_empty(comparable) else field_validator.normalize(comparable)
+            if normalized is not None:
+                readings.append((label, value, normalized, field_validator))
+        if not readings:
+            continue
+        reference = readings[0]
+        if all(reference[3].matches(normalized, reference[2]) for _, _, normalized, _ in readings[1:]):
+            continue
+        issues.append({
+            "field": field,
+            "values": [{"document": label, "value": value} for label, value, _, _ in readings],
+        })
+    return issues
+
+
+def compile_schemas(schemas: dict) -> dict:
+    """
+    Compile every prompt_schema entry into a DocumentValidator.
+    """
+    return {document_type: DocumentValidator(document_type, schema) for document_type, schema in schemas.items()}
+
+
+def application_details(application: dict) -> dict:
+    """
+    The part of a stored application the validators read.
+    """
+    application = application or {}
+    return {
+        "biodata": application.get("biodata") or {},
+        "education": application.get("education") or {"degree": [], "gateDetails": {}},
+    }
+
+
+def parse_extracted(result):
+    """
+    Turn the LLM service response into the list of extracted values.
+    """
+    if isinstance(result, dict):
+        result = result.get("result")
+    if isinstance(result, str):
+        result = ast.literal_eval(result.strip())
+    if not isinstance(result, (list, tuple)):
+        raise ValueError("Extraction result is not an array")
+    return list(result)
+
+
+def _is_empty(value) -> bool:
+    return value is None or (isinstance(value, str) and not value.strip())
+
+
+def _is_scalar(value) -> bool:
+    return isinstance(value, (str, int, float, datetime.date))
+
+
+def _comparable(value):
+    """
+    An extracted value the memoised normalizers can take: a list of scalars
+    (a name split in parts) is joined, any other non-scalar counts as missing.
+    """
+    if value is None or _is_scalar(value):
+        return value
+    if isinstance(value, (list, tuple)) and all(_is_scalar(item) for item in value):
+        return " ".join(str(item) for item in value)
+    return None
+
+
+def _compile_path(path: str):
+    """
+    Compile a dotted source path into a function returning every value found.
+    """
+    parts = [(part[:-2], True) if part.endswith("[]") else (part, False) for part in path.split(".")]
+
+    def resolve(details):
+        nodes = [details]
+        for key, fan_out in parts:
+            found = []
+            for node in nodes:
+                if not isinstance(node, dict) or key not in node:
+                    continue
+                value = node[key]
+                if fan_out:
+                    found.extend(value if isinstance(value, list) else [value])
+                else:
+                    found.append(value)
+            nodes = found
+        return nodes
+
+    return resolve
@@ -0,0 +1,200 @@
+import atexit
+import logging
+import os
+import queue
+import threading
+import time
+
+from bson import ObjectId, json_util
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, PyMongoError
+
+from mongodb_config import db
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# A batch is written once this many writes are waiting, or after the interval
+WRITE_BATCH_SIZE = int(os.getenv("WRITE_BATCH_SIZE", "200"))
+WRITE_FLUSH_INTERVAL = float(os.getenv("WRITE_FLUSH_INTERVAL", "1.0"))
+# Batches that could not be written while Mongo was unreachable, replayed later
+SPILL_FILE = os.getenv("WRITE_SPILL_FILE", os.path.join(os.path.dirname(os.path.abspath(__file__)), "write_behind.jsonl"))
+# Seconds between replay attempts while batches are spilled
+REPLAY_INTERVAL = float(os.getenv("WRITE_REPLAY_INTERVAL", "30"))
+# Writes waiting in memory and size of the spill file; past either, writes
+# are dropped and counted, so a long outage cannot exhaust memory or disk
+WRITE_QUEUE_SIZE = int(os.getenv("WRITE_QUEUE_SIZE", "10000"))
+SPILL_MAX_BYTES = int(os.getenv("WRITE_SPILL_MAX_BYTES", str(200 * 1024 * 1024)))
+
+DUPLICATE_KEY = 11000
+
+_STOP = object()
+
+
+class WriteBehind:
+    """
+    Takes writes off the request path: handlers enqueue inserts and upserts,
+    a background thread writes them in batches with unordered insert_many
+    and bulk_write calls per collection.
+
+    When Mongo cannot be reached a batch is appended to the spill file
+    (extended JSON, so dates survive) and replayed oldest first once a
+    replay attempt succeeds, also after a restart. Inserts get their _id
+    when enqueued, so a replay of a half-written batch skips the documents
+    already stored; upserted counters of such a batch may count twice.
+    Writes that find the queue full or the spill file at its size cap are
+    dropped and counted.
+    """
+
+    def __init__(self, spill_path: str = SPILL_FILE, batch_size: int = WRITE_BATCH_SIZE,
+                 interval: float = WRITE_FLUSH_INTERVAL, queue_size: int = WRITE_QUEUE_SIZE,
+                 spill_max_bytes: int = SPILL_MAX_BYTES):
+        self.spill_path = spill_path
+        self.batch_size = batch_size
+        self.interval = interval
+        self.spill_max_bytes = spill_max_bytes
+        self.written = 0
+        self.batches = 0
+        self.spilled = 0
+        self.replayed = 0
+        self.dropped = 0
+        self.last_error = None
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._next_replay = 0.0
+        self._thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def insert(self, collection: str, document: dict):
+        document.setdefault("_id", ObjectId())
+        self._enqueue(("insert", collection, document))
+
+    def upsert(self, collection: str, filter: dict, update: dict):
+        self._enqueue(("upsert", collection, (filter, update)))
+
+    def _enqueue(self, item: tuple):
+        # Never blocks a request: a full queue means the writer is far behind
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            self.dropped += 1
+            if self.dropped % 1000 == 1:
+                logger.warning(f"Write queue full, dropped {self.dropped} writes so far")
+
+    def close(self):
+        """
+        Write what is still queued, spilling it if Mongo is unreachable.
+        """
+        if self._thread.is_alive():
+            self._queue.put(_STOP)
+            self._thread.join(timeout=30)
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            pending = []
+            deadline = time.monotonic() + self.interval
+            while len(pending) < self.batch_size:
+                try:
+                    item = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    break
+                pending.append(item)
+
+            if os.path.exists(self.spill_path) and (stopping or time.monotonic() >= self._next_replay):
+                self._replay()
+            if pending:
+                self._flush(self._batch(pending))
+
+    @staticmethod
+    def _batch(items: list) -> dict:
+        batch = {"inserts": {}, "upserts": {}}
+        for kind, collection, payload in items:
+            batch[kind + "s"].setdefault(collection, []).append(payload)
+        return batch
+
+    def _write(self, batch: dict):
+        for collection, documents in batch["inserts"].items():
+            try:
+                db[collection].insert_many(documents, ordered=False)
+            except BulkWriteError as e:
+                errors = [error for error in e.details.get("writeErrors", []) if error.get("code") != DUPLICATE_KEY]
+                if errors:
+                    self.dropped += len(errors)
+                    logger.warning(f"Dropped {len(errors)} {collection} documents: {errors[0].get('errmsg')}")
+        for collection, updates in batch["upserts"].items():
+            operations = [UpdateOne(filter, update, upsert=True) for filter, update in updates]
+            try:
+                db[collection].bulk_write(operations, ordered=False)
+            except BulkWriteError as e:
+                self.dropped += len(e.details.get("writeErrors", []))
+                logger.warning(f"Dropped {collection} updates: {e.details.get('writeErrors', [{}])[0].get('errmsg')}")
+        self.written += sum(len(items) for kinds in batch.values() for items in kinds.values())
+        self.batches += 1
+
+    def _flush(self, batch: dict):
+        # While batches are spilled, new ones queue behind them in the file to keep their order
+        if os.path.exists(self.spill_path):
+            self._spill(batch)
+            return
+        try:
+            self._write(batch)
+        except PyMongoError as e:
+            self.last_error = str(e)
+            logger.warning(f"Mongo unavailable, spilling writes to {self.spill_path}: {e}")
+            self._next_replay = time.monotonic() + REPLAY_INTERVAL
+            self._spill(batch)
+
+    def _spill(self, batch: dict):
+        line = json_util.dumps(batch) + "\n"
+        size = os.path.getsize(self.spill_path) if os.path.exists(self.spill_path) else 0
+        if size + len(line.encode("utf-8")) > self.spill_max_bytes:
+            self.dropped += sum(len(items) for kinds in batch.values() for items in kinds.values())
+            logger.error(f"Spill file {self.spill_path} is full, dropping a batch")
+            return
+        try:
+            with open(self.spill_path, "a", encoding="utf-8") as f:
+                f.write(line)
+            self.spilled += 1
+        except OSError as e:
+            self.dropped += sum(len(items) for kinds in batch.values() for items in kinds.values())
+            logger.error(f"Failed to spill writes, dropping a batch: {e}")
+
+    def _replay(self):
+        with open(self.spill_path, "r", encoding="utf-8") as f:
+            lines = f.readlines()
+        for position, line in enumerate(lines):
+            try:
+                batch = json_util.loads(line)
+            except ValueError:
+                # A torn last line from a crash
+                continue
+            try:
+                self._write(batch)
+            except PyMongoError as e:
+                self.last_error = str(e)
+                self._next_replay = time.monotonic() + REPLAY_INTERVAL
+                with open(self.spill_path, "w", encoding="utf-8") as f:
+                    f.writelines(lines[position:])
+                return
+            self.replayed += 1
+        os.remove(self.spill_path)
+        logger.info(f"Replayed {len(lines)} spilled write batches")
+
+    def stats(self) -> dict:
+        return {
+            "queued": self._queue.qsize(),
+            "written": self.written,
+            "batches": self.batches,
+            "spilled_batches": self.spilled,
+            "replayed_batches": self.replayed,
+            "dropped": self.dropped,
+            "spill_pending": os.path.exists(self.spill_path),
+            "last_error": self.last_error,
+        }
+
+
+write_behind = WriteBehind()